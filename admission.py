@@ -0,0 +1,295 @@
+"""EventMan(ager) admission control
+
+Limit the number of requests to an endpoint served at the same time: the others wait
+in a FIFO queue, or are rejected when the queue is full.
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import time
+import collections
+import concurrent.futures
+
+import tornado.ioloop
+from tornado.concurrent import Future
+
+from metrics import metrics as default_metrics
+
+# Default limits, as {endpoint: (concurrency, queue size, seconds a request can wait in the queue)};
+# endpoints are named like the permission they require (e.g.: event:tickets-all|create to buy a ticket).
+LIMITS = {
+    'event:tickets-all|create': (4, 200, 10)
+}
+# Requests that were received more than this number of seconds ago (e.g.: because the server
+# is overloaded) are rejected at once, instead of being served too late.
+MAX_DELAY = 10
+# Seconds between two measures of the lag of the IOLoop: while the loop is busy, the new requests
+# wait in the buffers of the sockets, and this time is not included in their request_time().
+LAG_INTERVAL = 0.5
+# Seconds suggested to the rejected clients, before trying again, when the wait can't be estimated.
+RETRY_AFTER = 5
+# Weight of the last request in the moving average of the time needed to serve a request.
+SERVICE_TIME_WEIGHT = 0.2
+
+
+class Rejected(Exception):
+    """Raised when a request can't be served.
+
+    :param message: text message
+    :type message: str
+    :param position: position the request would have had in the queue
+    :type position: int
+    :param retry_after: seconds the client should wait before trying again
+    :type retry_after: int"""
+    def __init__(self, message, position=None, retry_after=RETRY_AFTER):
+        super(Rejected, self).__init__(message)
+        self.message = message
+        self.position = position
+        self.retry_after = retry_after
+
+
+def parse_limits(specs):
+    """Parse the limits of the endpoints, in the form endpoint=concurrency:queue_size:timeout.
+
+    :param specs: the limits
+    :type specs: list
+
+    :returns: the limits, as {endpoint: (concurrency, queue_size, timeout)}
+    :rtype: dict
+    """
+    limits = {}
+    for spec in specs or []:
+        spec = spec.strip()
+        if not spec:
+            continue
+        try:
+            endpoint, values = spec.rsplit('=', 1)
+            concurrency, queue_size, timeout = values.split(':')
+            limits[endpoint.strip()] = (int(concurrency), int(queue_size), float(timeout))
+        except ValueError:
+            raise ValueError('invalid limit: %s (use endpoint=concurrency:queue_size:timeout)' % spec)
+    return limits
+
+
+class Limiter(object):
+    """Limit the requests to an endpoint served at the same time.
+
+    The other requests wait in FIFO queues: one for the staff, always served first, and one for
+    everybody else. When a queue is full, or a request waits too long, the request is rejected."""
+    def __init__(self, endpoint, concurrency, queue_size, timeout, metrics=None):
+        """Initialize the instance.
+
+        :param endpoint: name of the endpoint
+        :type endpoint: str
+        :param concurrency: maximum number of requests served at the same time
+        :type concurrency: int
+        :param queue_size: maximum number of requests waiting in each queue
+        :type queue_size: int
+        :param timeout: seconds after which a waiting request is rejected
+        :type timeout: float
+        :param metrics: registry used to collect metrics
+        :type metrics: :class:`~metrics.Metrics`
+        """
+        self.endpoint = endpoint
+        self.concurrency = max(concurrency, 1)
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.metrics = metrics if metrics is not None else default_metrics
+        self.active = 0
+        # {priority: deque of [future, enqueued_at, timeout_handle]}
+        self.queues = {True: collections.deque(), False: collections.deque()}
+        self.service_time = None
+
+    def waiting(self):
+        """Return the number of waiting requests."""
+        return len(self.queues[True]) + len(self.queues[False])
+
+    def retry_after(self, position):
+        """Estimate the seconds needed to serve the requests before a position in the queue."""
+        if not self.service_time:
+            return RETRY_AFTER
+        return int(position * self.service_time / self.concurrency) + 1
+
+    def acquire(self, priority=False):
+        """Ask to serve a request.
+
+        :param priority: if True, the request is from the staff
+        :type priority: bool
+
+        :returns: a future, resolved with the seconds waited when the request can be served (or failing with
+                  :class:`Rejected`), and the position in the queue (0 if the request can be served at once)
+        :rtype: tuple
+        """
+        future = Future()
+        if self.active < self.concurrency and not self.waiting():
+            self.active += 1
+            future.set_result(0)
+            return future, 0
+        queue = self.queues[priority]
+        position = len(self.queues[True]) + (0 if priority else len(queue)) + 1
+        if len(queue) >= self.queue_size:
+            self.metrics.incr('admission_rejected', endpoint=self.endpoint, reason='queue_full')
+            raise Rejected('too many requests, try again later', position=position,
+                           retry_after=self.retry_after(position))
+        entry = [future, time.time(), None]
+        entry[2] = tornado.ioloop.IOLoop.current().call_later(self.timeout, self._expire, priority, entry)
+        queue.append(entry)
+        return future, position
+
+    def _expire(self, priority, entry):
+        try:
+            self.queues[priority].remove(entry)
+        except ValueError:
+            return
+        if not entry[0].done():
+            self.metrics.incr('admission_rejected', endpoint=self.endpoint, reason='timeout')
+            position = len(self.queues[priority]) + 1
+            entry[0].set_exception(Rejected('the server is busy, try again later', position=position,
+                                            retry_after=self.retry_after(position)))
+
+    def cancel(self, future):
+        """Remove a request from the queue (e.g.: because the client has gone away).
+
+        :param future: the future returned by `acquire`
+        :type future: :class:`~tornado.concurrent.Future`
+        """
+        for priority, queue in self.queues.items():
+            for entry in queue:
+                if entry[0] is future:
+                    queue.remove(entry)
+                    tornado.ioloop.IOLoop.current().remove_timeout(entry[2])
+                    if not future.done():
+                        future.set_exception(Rejected('connection closed'))
+                    return
+
+    def release(self, elapsed=None):
+        """Notify that a request was served, letting the next one in.
+
+        :param elapsed: seconds needed to serve the request
+        :type elapsed: float
+        """
+        self.active = max(self.active - 1, 0)
+        if elapsed is not None:
+            if self.service_time is None:
+                self.service_time = elapsed
+            else:
+                self.service_time += SERVICE_TIME_WEIGHT * (elapsed - self.service_time)
+        now = time.time()
+        while self.active < self.concurrency:
+            queue = self.queues[True] or self.queues[False]
+            if not queue:
+                break
+            future, enqueued_at, timeout_handle = queue.popleft()
+            tornado.ioloop.IOLoop.current().remove_timeout(timeout_handle)
+            if future.done():
+                continue
+            self.active += 1
+            self.metrics.observe('admission_wait_seconds', now - enqueued_at, endpoint=self.endpoint)
+            future.set_result(now - enqueued_at)
+
+
+class AdmissionControl(object):
+    """The limiters of the endpoints of this server process.
+
+    The admitted requests are served by a pool of threads, as large as the sum of the concurrency of
+    the endpoints: while they wait for the database, the IOLoop keeps serving the other requests."""
+    def __init__(self, limits=None, max_delay=MAX_DELAY, metrics=None):
+        """Initialize the instance.
+
+        :param limits: limits of the endpoints (see `LIMITS`)
+        :type limits: dict
+        :param max_delay: requests received more than this number of seconds ago are rejected
+        :type max_delay: float
+        :param metrics: registry used to collect metrics
+        :type metrics: :class:`~metrics.Metrics`
+        """
+        if limits is None:
+            limits = LIMITS
+        self.max_delay = max_delay
+        self.metrics = metrics if metrics is not None else default_metrics
+        self.limiters = dict([(endpoint, Limiter(endpoint, *limit, metrics=self.metrics))
+                              for endpoint, limit in limits.items()])
+        workers = sum([limiter.concurrency for limiter in self.limiters.values()]) or 1
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.loop_lag = 0
+        self._last_tick = None
+        self._lag_callback = None
+
+    def start(self, interval=LAG_INTERVAL):
+        """Start measuring the lag of the IOLoop.
+
+        :param interval: seconds between two measures
+        :type interval: float
+        """
+        self._interval = interval
+        self._last_tick = time.time()
+        self._lag_callback = tornado.ioloop.PeriodicCallback(self._measure_lag, interval * 1000)
+        self._lag_callback.start()
+
+    def stop(self):
+        """Stop measuring the lag of the IOLoop."""
+        if self._lag_callback is not None:
+            self._lag_callback.stop()
+            self._lag_callback = None
+
+    def _measure_lag(self):
+        now = time.time()
+        elapsed = now - self._last_tick
+        self._last_tick = now
+        lag = max(elapsed - self._interval, 0)
+        self.metrics.observe('ioloop_lag_seconds', lag)
+        # the requests received while the loop was blocked are served in the next seconds:
+        # the estimate decreases as time goes by.
+        self.loop_lag = max(lag, self.loop_lag - elapsed)
+
+    def run_in_executor(self, func, *args):
+        """Run a function in the pool of threads of the admitted requests.
+
+        :param func: the function
+        :type func: callable
+
+        :returns: a future, resolved with the result of the function
+        :rtype: :class:`~tornado.concurrent.Future`
+        """
+        return tornado.ioloop.IOLoop.current().run_in_executor(self.executor, func, *args)
+
+    def get(self, endpoint):
+        """Return the limiter of an endpoint, or None if it's not limited.
+
+        :param endpoint: name of the endpoint
+        :type endpoint: str
+
+        :returns: the limiter
+        :rtype: :class:`Limiter`
+        """
+        return self.limiters.get(endpoint)
+
+    def check_delay(self, endpoint, delay):
+        """Reject a request that was received too long ago; the current lag of the IOLoop is added to the delay.
+
+        :param endpoint: name of the endpoint
+        :type endpoint: str
+        :param delay: seconds since the request was parsed
+        :type delay: float
+        """
+        delay += self.loop_lag
+        if self.max_delay and delay > self.max_delay:
+            self.metrics.incr('admission_rejected', endpoint=endpoint, reason='delay')
+            raise Rejected('the server is busy, try again later')
+
+    def to_dict(self):
+        """Return the state of the limiters, in a form suitable to be serialized in JSON."""
+        return dict([(endpoint, {'active': limiter.active, 'waiting': limiter.waiting(),
+                                 'concurrency': limiter.concurrency, 'queue_size': limiter.queue_size})
+                     for endpoint, limiter in self.limiters.items()])
@@ -271,6 +271,53 @@ eventManControllers.controller('EventTicketsCtrl', ['$scope', '$state', 'Event',
                 }
             });
 
+            // Apply to the list of tickets an update received from the WebSocket.
+            $scope._processUpdate = function(data) {
+                $log.debug('received ' + data.action + ' action from websocket source ' + data.uuid + ' . Full data:');
+                $log.debug(data);
+                if (data.action == 'resync') {
+                    // too many messages were missed: reload the whole list.
+                    Event.get({id: $state.params.id}, function(event_) {
+                        $scope.event.tickets = event_.tickets || [];
+                    });
+                    return;
+                }
+                if ($rootScope.app_uuid == data.uuid) {
+                    $log.debug('do not process our own message');
+                    return false;
+                }
+                if (data.error && data.message) {
+                    toaster.pop({type: 'error', title: 'Error', body: data.message, timeout: 0, showCloseButton: true});
+                    return;
+                }
+                if (!$scope.event.tickets) {
+                    $scope.event.tickets = [];
+                }
+                var ticket_id = data._id || (data.ticket && data.ticket._id);
+                var ticket_idx = $scope.event.tickets.findIndex(function(el, idx, array) {
+                    return ticket_id && (ticket_id == el._id);
+                });
+                if (ticket_idx != -1) {
+                    $log.debug('_id ' + data._id + ' found');
+                } else {
+                    $log.debug('_id ' + data._id + ' not found');
+                }
+
+                if (data.action == 'update' && ticket_idx != -1 && $scope.event.tickets[ticket_idx] != data.ticket) {
+                    // if we're updating the 'attended' key and the action came from us (same user, possibly on
+                    // a different station), also show a message.
+                    if (data.ticket.attended != $scope.event.tickets[ticket_idx].attended &&
+                            $scope.info.user.username == data.username) {
+                        $scope.showAttendedMessage(data.ticket, data.ticket.attended);
+                    }
+                    $scope.event.tickets[ticket_idx] = data.ticket;
+                } else if (data.action == 'add' && ticket_idx == -1) {
+                    $scope._localAddTicket(data.ticket);
+                } else if (data.action == 'delete' && ticket_idx != -1) {
+                    $scope._localRemoveTicket({_id: data._id});
+                }
+            };
+
             // Managing the list of tickets.
             if ($state.is('event.tickets')) {
                 $scope.allPersons = Event.group_persons({id: $state.params.id});
@@ -281,47 +328,13 @@ eventManControllers.controller('EventTicketsCtrl', ['$scope', '$state', 'Event',
                 $scope.$watchCollection(function() {
                         return $scope.EventUpdates.data;
                     }, function(new_collection, old_collection) {
-                        if (!($scope.EventUpdates.data && $scope.EventUpdates.data.update)) {
+                        if (!($scope.EventUpdates.data && $scope.EventUpdates.data.updates)) {
                             $log.debug('no data received from the WebSocket');
                             return;
                         }
-                        var data = $scope.EventUpdates.data.update;
-                        $log.debug('received ' + data.action + ' action from websocket source ' + data.uuid + ' . Full data:');
-                        $log.debug(data);
-                        if ($rootScope.app_uuid == data.uuid) {
-                            $log.debug('do not process our own message');
-                            return false;
-                        }
-                        if (data.error && data.message) {
-                            toaster.pop({type: 'error', title: 'Error', body: data.message, timeout: 0, showCloseButton: true});
-                            return;
-                        }
-                        if (!$scope.event.tickets) {
-                            $scope.event.tickets = [];
-                        }
-                        var ticket_id = data._id || (data.ticket && data.ticket._id);
-                        var ticket_idx = $scope.event.tickets.findIndex(function(el, idx, array) {
-                            return ticket_id && (ticket_id == el._id);
+                        angular.forEach($scope.EventUpdates.data.updates, function(data, idx) {
+                            $scope._processUpdate(data);
                         });
-                        if (ticket_idx != -1) {
-                            $log.debug('_id ' + data._id + ' found');
-                        } else {
-                            $log.debug('_id ' + data._id + ' not found');
-                        }
-
-                        if (data.action == 'update' && ticket_idx != -1 && $scope.event.tickets[ticket_idx] != data.ticket) {
-                            // if we're updating the 'attended' key and the action came from us (same user, possibly on
-                            // a different station), also show a message.
-                            if (data.ticket.attended != $scope.event.tickets[ticket_idx].attended &&
-                                    $scope.info.user.username == data.username) {
-                                $scope.showAttendedMessage(data.ticket, data.ticket.attended);
-                            }
-                            $scope.event.tickets[ticket_idx] = data.ticket;
-                        } else if (data.action == 'add' && ticket_idx == -1) {
-                            $scope._localAddTicket(data.ticket);
-                        } else if (data.action == 'delete' && ticket_idx != -1) {
-                            $scope._localRemoveTicket({_id: data._id});
-                        }
                     }
                 );
             }
@@ -748,11 +761,22 @@ eventManControllers.controller('UsersCtrl', ['$scope', '$rootScope', '$state', '
 );
 
 
-eventManControllers.controller('FileUploadCtrl', ['$scope', '$log', '$upload', 'Event',
-    function ($scope, $log, $upload, Event) {
+eventManControllers.controller('FileUploadCtrl', ['$scope', '$log', '$upload', '$http', '$timeout', 'Event',
+    function ($scope, $log, $upload, $http, $timeout, Event) {
         $scope.file = null;
         $scope.reply = {};
         $scope.events = Event.all();
+
+        /* The import runs in background: follow its progress. */
+        $scope.followJob = function(url, job_id) {
+            $http.get(url + '/' + job_id).success(function(data) {
+                $scope.reply = data;
+                if (data.status == 'running') {
+                    $timeout(function() { $scope.followJob(url, job_id); }, 1000);
+                }
+            });
+        };
+
         $scope.upload = function(file, url) {
             $log.debug("FileUploadCtrl.upload");
             $upload.upload({
@@ -765,6 +789,9 @@ eventManControllers.controller('FileUploadCtrl', ['$scope', '$log', '$upload', '
             }).success(function(data, status, headers, config) {
                 $scope.file = null;
                 $scope.reply = angular.fromJson(data);
+                if ($scope.reply._id) {
+                    $scope.followJob(url, $scope.reply._id);
+                }
             });
         };
     }]
@@ -246,28 +246,86 @@ eventManServices.factory('User', ['$resource', '$rootScope',
 
 
 /* WebSocket collection used to update the list of tickets of an Event. */
-eventManApp.factory('EventUpdates', ['$websocket', '$location', '$log', '$rootScope',
-    function($websocket, $location, $log, $rootScope) {
+eventManApp.factory('EventUpdates', ['$websocket', '$location', '$log', '$rootScope', '$timeout',
+    function($websocket, $location, $log, $rootScope, $timeout) {
         var dataStream = null;
         var data = {};
+        var path = null;
+        var closing = false;
+        // last sequence number and epoch received; used to ask only for the missed messages, reconnecting.
+        var lastSeq = null;
+        var epoch = null;
 
         var methods = {
             data: data,
             close: function() {
                 $log.debug('close WebSocket connection');
+                closing = true;
                 dataStream.close();
             },
             open: function() {
                 var proto = $location.protocol() == 'https' ? 'wss' : 'ws';
+                if (path != $location.path()) {
+                    path = $location.path();
+                    lastSeq = null;
+                    epoch = null;
+                }
                 var url = proto + '://' + $location.host() + ':' + $location.port() +
-                          '/ws/' + $location.path() + '/updates?uuid=' + $rootScope.app_uuid;
+                          '/ws/' + path + '/updates?uuid=' + $rootScope.app_uuid;
+                if (lastSeq !== null) {
+                    url += '&since=' + lastSeq + '&epoch=' + epoch;
+                }
                 $log.debug('open WebSocket connection to ' + url);
                 //dataStream && dataStream.close();
+                closing = false;
                 dataStream = $websocket(url);
 
                 dataStream.onMessage(function(message) {
                     $log.debug('EventUpdates message received');
-                    data.update = angular.fromJson(message.data);
+                    // the server can coalesce multiple updates in a single list.
+                    var updates = angular.fromJson(message.data);
+                    if (!angular.isArray(updates)) {
+                        updates = [updates];
+                    }
+                    var newUpdates = [];
+                    // merged updates can make sequence numbers not ordered, inside a list.
+                    var prevSeq = lastSeq;
+                    angular.forEach(updates, function(update, idx) {
+                        if (update.seq === undefined) {
+                            newUpdates.push(update);
+                            return;
+                        }
+                        if (update.action == 'hello' || update.action == 'resync') {
+                            if (update.action == 'resync' || lastSeq === null || epoch != update.epoch) {
+                                lastSeq = prevSeq = update.seq;
+                            }
+                            epoch = update.epoch;
+                            if (update.action == 'resync') {
+                                newUpdates.push(update);
+                            }
+                            return;
+                        }
+                        // skip messages we've already seen.
+                        if (epoch == update.epoch && prevSeq !== null && update.seq <= prevSeq) {
+                            return;
+                        }
+                        if (epoch != update.epoch || lastSeq === null || update.seq > lastSeq) {
+                            lastSeq = update.seq;
+                        }
+                        epoch = update.epoch;
+                        newUpdates.push(update);
+                    });
+                    if (newUpdates.length) {
+                        data.updates = newUpdates;
+                    }
+                });
+
+                dataStream.onClose(function() {
+                    if (closing) {
+                        return;
+                    }
+                    $log.debug('WebSocket connection lost; reconnecting');
+                    $timeout(methods.open, 1000);
                 });
             }
         };
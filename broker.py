@@ -0,0 +1,673 @@
+"""EventMan(ager) broker
+
+Publish/subscribe of the messages sent to WebSocket clients.
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import time
+import uuid
+import logging
+import datetime
+import threading
+import collections
+
+import pymongo
+import pymongo.errors
+import tornado.ioloop
+from tornado import gen
+
+from metrics import metrics as default_metrics
+
+# Collection used to share the messages among server processes.
+MESSAGES_COLLECTION = 'ws_messages'
+# Maximum size (in bytes) and number of documents of the capped collection.
+MESSAGES_COLLECTION_SIZE = 16 * 1024 * 1024
+MESSAGES_COLLECTION_MAX = 10000
+
+# Default size (in seconds) of the time window used to coalesce the messages sent on a channel.
+BATCH_WINDOW = 0.05
+
+# Buckets of the histogram of the number of messages in a batch.
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Number of recent messages kept for each channel, to be replayed to reconnecting clients.
+REPLAY_BUFFER = 1000
+# Seconds to wait for a missing sequence number (e.g.: a message published by another process
+# that has yet to be read from the database), before asking the clients to resync.
+REORDER_TIMEOUT = 3
+
+# Collection used to store the sequences.
+COUNTERS_COLLECTION = 'counters'
+
+# Maximum number of messages waiting to be sent to a client.
+QUEUE_SIZE = 100
+# What to do when the queue of a client is full:
+# - drop_oldest: discard the oldest message
+# - collapse: discard every queued message, asking the client to reload everything (resync)
+# - disconnect: close the connection
+QUEUE_POLICY = 'collapse'
+QUEUE_POLICIES = ('drop_oldest', 'collapse', 'disconnect')
+
+
+class ClientQueue(object):
+    """Bounded queue of the messages to be sent to a WebSocket client.
+
+    A message is written only after the previous one was flushed, so that a slow client
+    can't make the write buffer grow without limits."""
+    def __init__(self, broker, client, max_size=QUEUE_SIZE, policy=QUEUE_POLICY):
+        """Initialize the instance.
+
+        :param broker: the broker
+        :type broker: :class:`LocalBroker`
+        :param client: the WebSocket handler
+        :type client: :class:`~tornado.websocket.WebSocketHandler`
+        :param max_size: maximum number of queued messages
+        :type max_size: int
+        :param policy: what to do when the queue is full (one of QUEUE_POLICIES)
+        :type policy: str
+        """
+        self.broker = broker
+        self.client = client
+        self.max_size = max_size
+        self.policy = policy
+        self.closed = False
+        self.writing = False
+        # (channel, message) items.
+        self.messages = collections.deque()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, channel, message):
+        """Queue a message, starting the writer if needed.
+
+        :param channel: name of the channel the message was published on
+        :type channel: str
+        :param message: the message
+        :type message: str
+        """
+        if self.closed:
+            return
+        metrics = self.broker.metrics
+        if len(self.messages) >= self.max_size:
+            metrics.incr('ws_queue_overflows', policy=self.policy)
+            if self.policy == 'disconnect':
+                logging.warning('broker: client too slow, disconnecting it')
+                metrics.incr('ws_messages_dropped', len(self.messages))
+                self.close()
+                return
+            elif self.policy == 'collapse':
+                channels = set([c for c, m in self.messages] + [channel])
+                metrics.incr('ws_messages_dropped', len(self.messages) + 1)
+                self.messages.clear()
+                for resync_channel in channels:
+                    self.messages.append((resync_channel, json.dumps([{'action': 'resync',
+                        'seq': self.broker.current_seq(resync_channel), 'epoch': self.broker.epoch}])))
+                self.flush()
+                return
+            else:
+                self.messages.popleft()
+                metrics.incr('ws_messages_dropped')
+        self.messages.append((channel, message))
+        self.flush()
+
+    def flush(self):
+        """Start writing the queued messages, if not already running."""
+        if not self.writing:
+            self.writing = True
+            tornado.ioloop.IOLoop.current().spawn_callback(self._write)
+
+    @gen.coroutine
+    def _write(self):
+        try:
+            frame = getattr(self.client, 'frame_message', None)
+            while self.messages and not self.closed:
+                channel, message = self.messages.popleft()
+                if frame is not None:
+                    message = frame(channel, message)
+                future = self.client.write_message(message)
+                if future is not None:
+                    yield future
+        except Exception as e:
+            logging.debug('broker: unable to write to the client: %s' % e)
+            self.close()
+        finally:
+            self.writing = False
+
+    def close(self):
+        """Discard the queued messages and close the connection."""
+        self.closed = True
+        self.messages.clear()
+        self.broker.unsubscribe_all(self.client)
+        try:
+            self.client.close()
+        except Exception:
+            pass
+
+
+class LocalBroker(object):
+    """In-process broker: request handlers publish messages on a channel (e.g.: event/:event_id/tickets/updates)
+    and they are sent to every WebSocket client subscribed to it.
+
+    If batch_window is set, the messages of a channel are collected for that number of seconds
+    and then sent as a single JSON list; multiple updates of the same ticket are merged, keeping only
+    the last one.
+
+    Every message is stamped with a "seq" key, monotonically increasing in each channel, and an "epoch"
+    key that changes if the sequences are reset; the last `replay_buffer` messages of each channel are
+    kept, so that a reconnecting client can receive only the messages it missed.
+
+    The messages of a channel are always delivered in order of sequence number: a message received
+    before the previous ones waits for them, for up to REORDER_TIMEOUT seconds; after that, the missing
+    messages are considered lost and the clients are asked to resync."""
+    def __init__(self, batch_window=BATCH_WINDOW, replay_buffer=REPLAY_BUFFER, queue_size=QUEUE_SIZE,
+            queue_policy=QUEUE_POLICY, metrics=None):
+        """Initialize the instance.
+
+        :param batch_window: seconds to wait, coalescing the messages of a channel (0 to disable)
+        :type batch_window: float
+        :param replay_buffer: number of recent messages kept for each channel
+        :type replay_buffer: int
+        :param queue_size: maximum number of messages waiting to be sent to a client
+        :type queue_size: int
+        :param queue_policy: what to do when the queue of a client is full (one of QUEUE_POLICIES)
+        :type queue_policy: str
+        :param metrics: registry used to collect metrics
+        :type metrics: :class:`~metrics.Metrics`
+        """
+        # clients subscribed to each channel, by UUID.
+        self.channels = {}
+        self.batch_window = batch_window
+        self.metrics = metrics or default_metrics
+        self.metrics.gauge('ws_batch_window', lambda: self.batch_window)
+        self.metrics.gauge('ws_clients', lambda: sum(len(c) for c in self.channels.values()))
+        self.metrics.gauge('ws_queued_messages', lambda: sum(len(self.queue(c)) for clients in
+                                                             self.channels.values() for c in clients.values()))
+        if queue_policy not in QUEUE_POLICIES:
+            raise ValueError('invalid queue policy: %s' % queue_policy)
+        self.queue_size = queue_size
+        self.queue_policy = queue_policy
+        # messages waiting to be sent on each channel, by merge key.
+        self._batches = {}
+        self.epoch = uuid.uuid4().hex
+        self.replay_buffer = replay_buffer
+        # last delivered sequence number and recent (seq, message) items of each channel.
+        self._seqs = {}
+        self._buffers = {}
+        # messages waiting for the previous sequence numbers, as {channel: {seq: message}},
+        # and the timeouts after which the missing ones are skipped.
+        self._pending = {}
+        self._gap_timeouts = {}
+
+    def start(self):
+        """Start the broker; must be called in the process that will serve the clients."""
+        pass
+
+    def stop(self):
+        """Stop the broker."""
+        pass
+
+    def subscribe(self, channel, client, uuid=None):
+        """Subscribe a client to a channel.
+
+        :param channel: name of the channel
+        :type channel: str
+        :param client: the WebSocket handler
+        :type client: :class:`~tornado.websocket.WebSocketHandler`
+        :param uuid: unique ID of the client (if None, the client itself is used as key)
+        :type uuid: str
+        """
+        self.channels.setdefault(channel, {})[uuid or id(client)] = client
+        logging.debug('broker: %d clients subscribed to %s' % (len(self.channels[channel]), channel))
+
+    def unsubscribe(self, channel, client):
+        """Remove a client from a channel.
+
+        :param channel: name of the channel
+        :type channel: str
+        :param client: the WebSocket handler
+        :type client: :class:`~tornado.websocket.WebSocketHandler`
+        """
+        clients = self.channels.get(channel) or {}
+        for key, value in list(clients.items()):
+            if value is client:
+                del clients[key]
+        if not clients and channel in self.channels:
+            del self.channels[channel]
+
+    def unsubscribe_all(self, client):
+        """Remove a client from every channel.
+
+        :param client: the WebSocket handler
+        :type client: :class:`~tornado.websocket.WebSocketHandler`
+        """
+        for channel in list(self.channels.keys()):
+            self.unsubscribe(channel, client)
+
+    def queue(self, client):
+        """Return the queue of the messages to be sent to a client.
+
+        :param client: the WebSocket handler
+        :type client: :class:`~tornado.websocket.WebSocketHandler`
+
+        :returns: the queue
+        :rtype: :class:`ClientQueue`
+        """
+        queue = getattr(client, '_broker_queue', None)
+        if queue is None:
+            queue = client._broker_queue = ClientQueue(self, client, max_size=self.queue_size,
+                                                       policy=self.queue_policy)
+        return queue
+
+    def send_to(self, client, channel, message):
+        """Send a message to a single client.
+
+        :param client: the WebSocket handler
+        :type client: :class:`~tornado.websocket.WebSocketHandler`
+        :param channel: name of the channel
+        :type channel: str
+        :param message: the message to send
+        :type message: str
+        """
+        self.queue(client).put(channel, message)
+
+    def publish(self, channel, message):
+        """Publish a message on a channel.
+
+        :param channel: name of the channel
+        :type channel: str
+        :param message: the message to send
+        :type message: str
+        """
+        seq = self.next_seq(channel)
+        self.deliver(channel, self.stamp(message, seq), seq=seq)
+
+    def next_seq(self, channel):
+        """Return the next sequence number of a channel.
+
+        :param channel: name of the channel
+        :type channel: str
+
+        :returns: the sequence number
+        :rtype: int
+        """
+        return self._seqs.get(channel, 0) + 1
+
+    def current_seq(self, channel):
+        """Return the last sequence number delivered on a channel.
+
+        :param channel: name of the channel
+        :type channel: str
+
+        :returns: the sequence number
+        :rtype: int
+        """
+        return self._seqs.get(channel, 0)
+
+    def stamp(self, message, seq):
+        """Add the sequence number and the epoch to a JSON message.
+
+        :param message: the message
+        :type message: str
+        :param seq: the sequence number
+        :type seq: int
+
+        :returns: the new message
+        :rtype: str
+        """
+        try:
+            data = json.loads(message)
+        except (TypeError, ValueError):
+            return message
+        if not isinstance(data, dict):
+            return message
+        data['seq'] = seq
+        data['epoch'] = self.epoch
+        return json.dumps(data)
+
+    def replay(self, channel, since, epoch=None):
+        """Return the messages published on a channel after a given sequence number.
+
+        :param channel: name of the channel
+        :type channel: str
+        :param since: the last sequence number seen by the client
+        :type since: int
+        :param epoch: the epoch seen by the client
+        :type epoch: str
+
+        :returns: the list of messages, or None if they are no more available (and the client has to resync)
+        :rtype: list
+        """
+        if epoch is not None and epoch != self.epoch:
+            return None
+        current = self.current_seq(channel)
+        if since >= current:
+            return [] if since == current else None
+        items = sorted([item for item in self._buffers.get(channel) or [] if item[0] > since])
+        if not items or items[0][0] > since + 1:
+            return None
+        return [message for seq, message in items]
+
+    def missed_messages(self, channel, since=None, epoch=None):
+        """Build the message sent to a client subscribing to a channel: a "hello" with the current
+        sequence number followed by the messages it missed or, if they are no more available, a "resync".
+
+        :param channel: name of the channel
+        :type channel: str
+        :param since: the last sequence number seen by the client, if reconnecting
+        :type since: int
+        :param epoch: the epoch seen by the client
+        :type epoch: str
+
+        :returns: a JSON list
+        :rtype: str
+        """
+        status = {'action': 'hello', 'seq': self.current_seq(channel), 'epoch': self.epoch}
+        messages = []
+        if since is not None:
+            messages = self.replay(channel, since, epoch)
+            if messages is None:
+                status['action'] = 'resync'
+                messages = []
+        return '[%s]' % ', '.join([json.dumps(status)] + messages)
+
+    def remember(self, channel, message, seq):
+        """Store a message in the replay buffer of a channel.
+
+        :param channel: name of the channel
+        :type channel: str
+        :param message: the message
+        :type message: str
+        :param seq: sequence number of the message
+        :type seq: int
+        """
+        if seq > self._seqs.get(channel, 0):
+            self._seqs[channel] = seq
+        if channel not in self._buffers:
+            self._buffers[channel] = collections.deque(maxlen=self.replay_buffer)
+        self._buffers[channel].append((seq, message))
+
+    @staticmethod
+    def _merge_key(message):
+        """Messages with the same key are merged: only the last one is sent."""
+        try:
+            data = json.loads(message)
+        except (TypeError, ValueError):
+            return None
+        if isinstance(data, dict) and data.get('action') == 'update' and not data.get('error'):
+            ticket_id = data.get('_id') or (data.get('ticket') or {}).get('_id')
+            if ticket_id:
+                return 'update:%s' % ticket_id
+        if isinstance(data, dict) and data.get('action') == 'stats':
+            return 'stats'
+        if isinstance(data, dict) and data.get('action') == 'import' and isinstance(data.get('job'), dict):
+            return 'import:%s' % data['job'].get('_id')
+        return None
+
+    def deliver(self, channel, message, seq=None):
+        """Send a message to the clients of this process subscribed to a channel, in order
+        of sequence number.
+
+        :param channel: name of the channel
+        :type channel: str
+        :param message: the message to send
+        :type message: str
+        :param seq: sequence number of the message
+        :type seq: int
+        """
+        if seq is None:
+            return self.dispatch(channel, message)
+        current = self._seqs.get(channel)
+        if current is not None and seq <= current:
+            buffer = self._buffers.get(channel) or []
+            if not any(item[0] == seq for item in buffer):
+                # arrived after its gap was skipped: the clients have already seen the next messages.
+                logging.warning('broker: message %d on %s arrived too late' % (seq, channel))
+                self.metrics.incr('ws_messages_late')
+                self.resync(channel)
+            return
+        if current is not None and seq > current + 1:
+            self._pending.setdefault(channel, {})[seq] = message
+            if channel not in self._gap_timeouts:
+                self._gap_timeouts[channel] = tornado.ioloop.IOLoop.current().call_later(
+                        REORDER_TIMEOUT, self.skip_gap, channel)
+            return
+        self.remember(channel, message, seq)
+        self.dispatch(channel, message)
+        self._deliver_pending(channel)
+
+    def _deliver_pending(self, channel):
+        """Deliver the waiting messages that are now in sequence."""
+        pending = self._pending.get(channel)
+        while pending:
+            seq = self._seqs.get(channel, 0) + 1
+            if seq not in pending:
+                return
+            message = pending.pop(seq)
+            self.remember(channel, message, seq)
+            self.dispatch(channel, message)
+        self._pending.pop(channel, None)
+        timeout = self._gap_timeouts.pop(channel, None)
+        if timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(timeout)
+
+    def skip_gap(self, channel):
+        """Give up waiting for the missing messages of a channel, asking the clients to resync.
+
+        :param channel: name of the channel
+        :type channel: str
+        """
+        self._gap_timeouts.pop(channel, None)
+        pending = self._pending.get(channel)
+        if not pending:
+            return
+        seq = min(pending) - 1
+        logging.warning('broker: messages %d-%d on %s lost' % (self._seqs.get(channel, 0) + 1, seq, channel))
+        self.metrics.incr('ws_messages_lost', seq - self._seqs.get(channel, 0))
+        message = json.dumps({'action': 'resync', 'seq': seq, 'epoch': self.epoch})
+        # reconnecting clients that missed the lost messages will receive the resync, too.
+        self.remember(channel, message, seq)
+        self.flush(channel)
+        self.send(channel, '[%s]' % message)
+        self._deliver_pending(channel)
+
+    def resync(self, channel):
+        """Ask the clients subscribed to a channel to reload everything.
+
+        :param channel: name of the channel
+        :type channel: str
+        """
+        self.flush(channel)
+        self.send(channel, json.dumps([{'action': 'resync', 'seq': self.current_seq(channel),
+                                        'epoch': self.epoch}]))
+
+    def dispatch(self, channel, message):
+        """Send a message to the clients of this process subscribed to a channel,
+        or add it to the current batch.
+
+        :param channel: name of the channel
+        :type channel: str
+        :param message: the message to send
+        :type message: str
+        """
+        if not self.batch_window:
+            return self.send(channel, message)
+        if channel not in self.channels:
+            return
+        batch = self._batches.get(channel)
+        if batch is None:
+            batch = self._batches[channel] = {'messages': [], 'keys': {}}
+            tornado.ioloop.IOLoop.current().call_later(self.batch_window, self.flush, channel)
+        key = self._merge_key(message)
+        if key is not None and key in batch['keys']:
+            batch['messages'][batch['keys'][key]] = message
+            self.metrics.incr('ws_messages_coalesced')
+            return
+        if key is not None:
+            batch['keys'][key] = len(batch['messages'])
+        batch['messages'].append(message)
+
+    def flush(self, channel):
+        """Send the current batch of a channel, as a JSON list.
+
+        :param channel: name of the channel
+        :type channel: str
+        """
+        batch = self._batches.pop(channel, None)
+        if not batch or not batch['messages']:
+            return
+        messages = batch['messages']
+        self.metrics.incr('ws_batches')
+        self.metrics.observe('ws_batch_messages', len(messages), buckets=BATCH_BUCKETS)
+        self.send(channel, '[%s]' % ', '.join(messages))
+
+    def send(self, channel, message):
+        """Immediately send a message to the clients of this process subscribed to a channel.
+
+        :param channel: name of the channel
+        :type channel: str
+        :param message: the message to send
+        :type message: str
+
+        :returns: the number of clients the message was queued for
+        :rtype: int
+        """
+        clients = self.channels.get(channel) or {}
+        count = 0
+        for key, client in list(clients.items()):
+            self.send_to(client, channel, message)
+            count += 1
+        self.metrics.incr('ws_messages_sent', count)
+        logging.debug('broker: queued message for %d clients on %s' % (count, channel))
+        return count
+
+
+class MongoBroker(LocalBroker):
+    """Broker that shares the messages among every server process (even on different hosts)
+    connected to the same database.
+
+    Published messages are sent to the local clients and stored in a capped collection;
+    every process tails the collection, sending to its own clients the messages published
+    by the other processes. The sequence numbers are shared, so a local message can be
+    delivered only after the messages published just before by the other processes."""
+    def __init__(self, db, collection=MESSAGES_COLLECTION, **kwargs):
+        """Initialize the instance.
+
+        :param db: the database connector
+        :type db: :class:`~monco.Monco`
+        :param collection: name of the capped collection used to share the messages
+        :type collection: str
+        """
+        super(MongoBroker, self).__init__(**kwargs)
+        self.db = db
+        # the sequences are shared among processes: so is the epoch.
+        self.epoch = None
+        self.collection_name = collection
+        self.origin = uuid.uuid4().hex
+        self.ioloop = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @property
+    def collection(self):
+        return self.db.connect()[self.collection_name]
+
+    def start(self):
+        db = self.db.connect()
+        if self.collection_name not in db.collection_names():
+            try:
+                db.create_collection(self.collection_name, capped=True, size=MESSAGES_COLLECTION_SIZE,
+                                     max=MESSAGES_COLLECTION_MAX)
+                # a tailable cursor on an empty collection is immediately closed.
+                self.collection.insert_one({'channel': None, 'origin': None,
+                                            'created_at': datetime.datetime.utcnow()})
+            except pymongo.errors.CollectionInvalid:
+                # created by another process in the meantime.
+                pass
+        self.epoch = self._increment('ws_epoch', 0).get('epoch')
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._tail, name='MongoBroker')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _increment(self, seq_name, increment=1):
+        """Increment a counter stored in the database, returning the whole document.
+
+        seq_name must have a unique index (see `ensure_indexes`), so that a counter created
+        at the same time by more processes is stored only once."""
+        collection = self.db.connect()[COUNTERS_COLLECTION]
+        for attempt in range(2):
+            try:
+                return collection.find_one_and_update({'seq_name': seq_name},
+                        {'$inc': {'seq': increment}, '$setOnInsert': {'epoch': uuid.uuid4().hex}},
+                        upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+            except pymongo.errors.DuplicateKeyError:
+                # created by another process in the meantime: now the update will match it.
+                if attempt:
+                    raise
+
+    @staticmethod
+    def ensure_indexes(db):
+        """Create the indexes used by the broker; to be called once, before forking the workers.
+
+        :param db: the database connector
+        :type db: :class:`~monco.Monco`
+        """
+        db.ensureIndex(COUNTERS_COLLECTION, [('seq_name', pymongo.ASCENDING)], unique=True)
+
+    def next_seq(self, channel):
+        return self._increment('ws:%s' % channel).get('seq')
+
+    def publish(self, channel, message):
+        seq = self.next_seq(channel)
+        message = self.stamp(message, seq)
+        self.deliver(channel, message, seq=seq)
+        self.collection.insert_one({'channel': channel, 'message': message, 'seq': seq, 'origin': self.origin,
+                                    'created_at': datetime.datetime.utcnow()})
+
+    def _tail(self):
+        """Follow the capped collection, running in a separate thread."""
+        collection = self.collection
+        last_id = None
+        # fill the replay buffers with the messages published before we started.
+        for doc in collection.find({'channel': {'$ne': None}}).sort('$natural', pymongo.ASCENDING):
+            last_id = doc['_id']
+            if doc.get('seq') is not None:
+                self.ioloop.add_callback(self.remember, doc['channel'], doc.get('message'), doc['seq'])
+        while not self._stopped.is_set():
+            try:
+                cursor = collection.find({}, cursor_type=pymongo.CursorType.TAILABLE_AWAIT).sort(
+                        '$natural', pymongo.ASCENDING)
+                # skip the documents we've already seen, in natural order (if last_id has
+                # already been removed from the capped collection, everything is new).
+                skipping = last_id is not None and collection.find_one({'_id': last_id}) is not None
+                while cursor.alive and not self._stopped.is_set():
+                    for doc in cursor:
+                        if skipping:
+                            if doc['_id'] == last_id:
+                                skipping = False
+                            continue
+                        last_id = doc['_id']
+                        if doc.get('channel') is None or doc.get('origin') == self.origin:
+                            continue
+                        self.ioloop.add_callback(self.deliver, doc['channel'], doc.get('message'), doc.get('seq'))
+            except pymongo.errors.PyMongoError as e:
+                logging.error('broker: error reading the %s collection: %s' % (self.collection_name, e))
+            time.sleep(1)
@@ -8,73 +8,225 @@ Copyright 2015-2013 Emiliano Mattioli <oloturia AT gmail.com>
 Licensed under the Apache License 2.0
 """
 
+import io
 import os
 import sys
-import cups
+import json
+import time
+import argparse
 import tempfile
+import functools
 from PIL import Image, ImageFont, ImageDraw
 
-KEEP_IMG = True
-LABEL_WIDTH = 13488
-LABEL_HEIGHT = 3744
+try:
+    import cups
+except ImportError:
+    cups = None
+
+# If set to a directory, a copy of every label is saved there (useful for debugging).
+KEEP_IMG = None
+
+# Size of the label, and resolution of the printer.
+LABEL_WIDTH_MM = 89
+LABEL_HEIGHT_MM = 25
+DPI = 300
+
+# The layout was designed on a LAYOUT_WIDTH x LAYOUT_HEIGHT canvas: sizes and offsets
+# below are scaled to the real resolution of the label.
+LAYOUT_WIDTH = 13488
+LAYOUT_HEIGHT = 3744
+LAYOUT_NAME_SIZE = 1100
+LAYOUT_NAME_OFFSET = -1300
+LAYOUT_COMPANY_SIZE = 780
+LAYOUT_COMPANY_OFFSET = -480
+LAYOUT_BARCODE_SIZE = 2000
+LAYOUT_BARCODE_OFFSET = 850
 
 FONT_TEXT = 'Ubuntu-C.ttf'
 FONT_TEXT = 'CONCIBB_.TTF'
+FONT_TEXT_FALLBACK = 'Ubuntu-C.ttf'
 FONT_TEXT_ENCODING = 'latin-1'
 FONT_BARCODE = 'free3of9.ttf'
 
+# Optional image (e.g.: a logo) drawn once and used as the background of every label.
+BACKGROUND = None
+
 PRINTER_NAME = None
 #PRINTER_NAME = 'DYMO_LabelWriter_450'
 
 
 def _get_resource(filename):
-    return os.path.join(os.path.dirname(sys.argv[0]), filename)
-
-
-def build_label(w, h, barcode_text, line1, line2, font_text=FONT_TEXT, font_barcode=FONT_BARCODE):
-    barcode_text = "*" + barcode_text + "*"
-    line1 = str(line1, 'utf-8').encode(FONT_TEXT_ENCODING, 'ignore')
-    line2 = str(line2, 'utf-8').encode(FONT_TEXT_ENCODING, 'ignore')
-    fontbar = ImageFont.truetype(_get_resource(font_barcode), 2000)
-    fontname = ImageFont.truetype(_get_resource(font_text), 1100)
-    fontjob = ImageFont.truetype(_get_resource(font_text), 780)
-    image = Image.new('RGB', (w, h), (255, 255, 255))
-    draw = ImageDraw.Draw(image)
-    wbar, hbar = draw.textsize(barcode_text, font=fontbar)
-    wnorm1, hnorm1 = draw.textsize(line1, font=fontname)
-    wnorm2, hnorm2 = draw.textsize(line2, font=fontjob)
-    draw.text(((w-wnorm1)/2, -1300+(h-hnorm1)/2), line1, (0, 0, 0), font=fontname)
-    draw.text(((w-wnorm2)/2, -480+(h-hnorm2)/2), line2, (0, 0, 0), font=fontjob)
-    draw.text(((w-wbar)/2, 850+(h-hbar)/2), barcode_text, (0, 0, 0), font=fontbar)
-    if not KEEP_IMG:
-        tmpfile = tempfile.NamedTemporaryFile(prefix='eventman_print_label_', suffix='.png')
-    else:
-        tmpfile = tempfile.mktemp(prefix='eventman_print_label_', suffix='.png')
-        tmpfile = open(tmpfile, 'wb')
-    image.save(tmpfile, dpi=[600, 300], format='png')
-    return tmpfile
-
-
-def print_label(label_file, name):
+    return os.path.join(os.path.dirname(os.path.realpath(__file__)), filename)
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(filename, size):
+    """Load a TrueType font only once for every size."""
+    path = _get_resource(filename)
+    if not os.path.isfile(path) and filename != FONT_BARCODE:
+        path = _get_resource(FONT_TEXT_FALLBACK)
+    return ImageFont.truetype(path, size)
+
+
+def label_size(dpi=DPI, width_mm=LABEL_WIDTH_MM, height_mm=LABEL_HEIGHT_MM):
+    """Return the size in pixels of a label."""
+    return int(round(width_mm * dpi / 25.4)), int(round(height_mm * dpi / 25.4))
+
+
+def _text_size(draw, text, font):
+    if hasattr(draw, 'textbbox'):
+        left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+        return right - left, bottom - top
+    return draw.textsize(text, font=font)
+
+
+def _clean_text(text):
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'ignore')
+    return text.encode(FONT_TEXT_ENCODING, 'ignore').decode(FONT_TEXT_ENCODING)
+
+
+class LabelRenderer(object):
+    """Render labels in 1-bit mode at the resolution of the printer.
+
+    Fonts and the background are loaded once, and reused for every label."""
+    def __init__(self, w=None, h=None, dpi=DPI, font_text=FONT_TEXT, font_barcode=FONT_BARCODE,
+                 background=BACKGROUND):
+        if w is None or h is None:
+            w, h = label_size(dpi)
+        self.w = w
+        self.h = h
+        self.dpi = dpi
+        scale = h / LAYOUT_HEIGHT
+        self.name_offset = LAYOUT_NAME_OFFSET * scale
+        self.company_offset = LAYOUT_COMPANY_OFFSET * scale
+        self.barcode_offset = LAYOUT_BARCODE_OFFSET * scale
+        self.font_name = load_font(font_text, max(int(LAYOUT_NAME_SIZE * scale), 1))
+        self.font_company = load_font(font_text, max(int(LAYOUT_COMPANY_SIZE * scale), 1))
+        self.font_barcode = load_font(font_barcode, max(int(LAYOUT_BARCODE_SIZE * scale), 1))
+        self.template = Image.new('1', (w, h), 1)
+        if background:
+            bg = Image.open(_get_resource(background)).convert('L').resize((w, h))
+            self.template.paste(bg.convert('1'))
+
+    def render(self, barcode_text, line1, line2):
+        """Return the image of a label."""
+        barcode_text = '*%s*' % barcode_text
+        line1 = _clean_text(line1)
+        line2 = _clean_text(line2)
+        w, h = self.w, self.h
+        image = self.template.copy()
+        draw = ImageDraw.Draw(image)
+        wbar, hbar = _text_size(draw, barcode_text, self.font_barcode)
+        wnorm1, hnorm1 = _text_size(draw, line1, self.font_name)
+        wnorm2, hnorm2 = _text_size(draw, line2, self.font_company)
+        draw.text(((w-wnorm1)/2, self.name_offset+(h-hnorm1)/2), line1, 0, font=self.font_name)
+        draw.text(((w-wnorm2)/2, self.company_offset+(h-hnorm2)/2), line2, 0, font=self.font_company)
+        draw.text(((w-wbar)/2, self.barcode_offset+(h-hbar)/2), barcode_text, 0, font=self.font_barcode)
+        return image
+
+    def render_png(self, barcode_text, line1, line2):
+        """Return a label, as PNG data."""
+        image = self.render(barcode_text, line1, line2)
+        buf = io.BytesIO()
+        image.save(buf, dpi=(self.dpi, self.dpi), format='png')
+        return buf.getvalue()
+
+
+@functools.lru_cache(maxsize=None)
+def get_renderer(w=None, h=None):
+    return LabelRenderer(w, h)
+
+
+def build_label(w, h, barcode_text, line1, line2):
+    """Return a label, as PNG data."""
+    return get_renderer(w, h).render_png(barcode_text, line1, line2)
+
+
+def print_label(label_data, name):
+    """Send PNG data to the print queue."""
+    if KEEP_IMG:
+        with tempfile.NamedTemporaryFile(dir=KEEP_IMG, prefix='eventman_print_label_', suffix='.png',
+                                         delete=False) as fd:
+            fd.write(label_data)
     conn = cups.Connection()
     printer = PRINTER_NAME or conn.getDefault()
-    conn.printFile(printer, label_file.name, name, {})
+    if hasattr(conn, 'createJob'):
+        # stream the data, without touching the disk.
+        job_id = conn.createJob(printer, name, {})
+        conn.startDocument(printer, job_id, name, cups.CUPS_FORMAT_AUTO, 1)
+        conn.writeRequestData(label_data, len(label_data))
+        conn.finishDocument(printer)
+        return
+    with tempfile.NamedTemporaryFile(prefix='eventman_print_label_', suffix='.png') as fd:
+        fd.write(label_data)
+        fd.flush()
+        conn.printFile(printer, fd.name, name, {})
+
+
+def label_from_env(env):
+    """Return the barcode text and the two lines of a label, from the environment of the trigger."""
+    name = ' '.join([env.get('NAME') or '', env.get('SURNAME') or ''])
+    company = env.get('COMPANY') or ''
+    # Print the decimal value SEQ as an hex of at least 6 digits.
+    seq = env.get('SEQ_HEX', '0')
+    return seq, name, company
 
 
 def run():
+    """Print the labels, returning the number of labels that were not printed and the number of labels."""
     # Always consume stdin.
-    sys.stdin.read()
-    name = ' '.join([os.environ.get('NAME') or '', os.environ.get('SURNAME') or ''])
-    company = os.environ.get('COMPANY') or ''
-    # Print the decimal value SEQ as an hex of at least 6 digits.
-    seq = os.environ.get('SEQ_HEX', '0')
-    label_file = build_label(LABEL_WIDTH, LABEL_HEIGHT, seq, name, company)
-    print_label(label_file, name)
+    data = sys.stdin.read()
+    envs = [os.environ]
+    try:
+        data = json.loads(data)
+        if isinstance(data, list):
+            # running in batch mode.
+            envs = [item.get('env') or {} for item in data]
+    except ValueError:
+        pass
+    failed = 0
+    for env in envs:
+        # in batch mode, a failure must not prevent the other labels from being printed.
+        try:
+            seq, name, company = label_from_env(env)
+            print_label(build_label(None, None, seq, name, company), name)
+        except Exception as e:
+            failed += 1
+            sys.stderr.write('print_label.  Exception raised: %s\n' % e)
+    return failed, len(envs)
+
+
+def benchmark(count):
+    """Measure the rendering throughput, without printing anything."""
+    t0 = time.time()
+    renderer = get_renderer()
+    t1 = time.time()
+    size = 0
+    for i in range(count):
+        size += len(renderer.render_png('%06X' % i, 'Name%d Surname%d' % (i, i), 'Company %d' % i))
+    t2 = time.time()
+    print('setup: %.3f seconds' % (t1 - t0))
+    print('rendered %d labels (%dx%d pixels, avg %d bytes) in %.3f seconds: %.1f labels/second' %
+          (count, renderer.w, renderer.h, size / (count or 1), t2 - t1, count / ((t2 - t1) or 1)))
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark', help='render N labels and report the throughput', type=int,
+                        metavar='N', action='store')
+    args = parser.parse_args()
+    if args.benchmark is not None:
+        benchmark(args.benchmark)
+        sys.exit(0)
+    # a non-zero exit code makes the triggers queue retry the job: in batch mode, that would print again
+    # every label of the batch, so the job fails only if no label was printed (e.g.: the printer is off).
     try:
-        run()
+        failed, count = run()
     except Exception as e:
         sys.stderr.write('print_label.  Exception raised: %s\n' % e)
-
+        sys.exit(1)
+    if failed:
+        sys.stderr.write('print_label.  %d of %d labels not printed\n' % (failed, count))
+        if failed == count:
+            sys.exit(1)
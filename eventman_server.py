@@ -17,19 +17,24 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import io
 import os
 import re
-import glob
+import sys
+import csv
 import json
 import time
 import string
 import random
 import logging
 import datetime
+import threading
+import concurrent.futures
 import dateutil.tz
 import dateutil.parser
 
 import tornado.httpserver
+import tornado.netutil
 import tornado.ioloop
 import tornado.options
 from tornado.options import define, options
@@ -39,18 +44,50 @@ from tornado import gen, escape, process
 
 import utils
 import monco
+import broker
+import admission
+import search
+import triggers
+from metrics import metrics
 import collections
 
 ENCODING = 'utf-8'
-PROCESS_TIMEOUT = 60
 
 API_VERSION = '1.0'
 
-re_env_key = re.compile('[^A-Z_]+')
-re_slashes = re.compile(r'//+')
+# Maximum number of channels a single multiplexed WebSocket can subscribe to.
+MAX_WS_SUBSCRIPTIONS = 100
+
+# Maximum number of items in a batch update of tickets.
+MAX_BATCH_ITEMS = 1000
+
+# Maximum size of an uploaded CSV file, and number of lines imported between two progress reports.
+MAX_IMPORT_SIZE = 1024 * 1024 * 1024
+IMPORT_PROGRESS_LINES = 500
+
+# Default columns of an export of the tickets, and bytes buffered before they are sent to the client.
+EXPORT_COLUMNS = ('seq_hex', 'name', 'surname', 'email', 'company', 'job title', 'ticket_kind',
+                  'attended', 'cancelled', 'ebqrcode', 'order_nr', 'created_at', 'updated_at')
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# How many times the update of a ticket is tried again, if the ticket is changed at the same time.
+UPDATE_TICKET_RETRIES = 3
+
+# Minimum version of the MongoDB server: the sequences of the versions of the tickets are reserved
+# with updates using an aggregation pipeline (4.2), and the capacity of the events is checked with $convert (4.0).
+MIN_MONGODB_VERSION = (4, 2)
+
+# Seconds after which a version reserved by a write of a ticket is no more considered in flight
+# (e.g.: because the process crashed before completing the write).
+TICKETS_VERSION_TIMEOUT = 60
+
+# How many times dead worker processes are restarted (see the --workers option).
+WORKERS_MAX_RESTARTS = 100
+
+# Seconds the information about a user (including the permissions) is cached by a process;
+# with more than one worker, changes made through another process are seen after this time.
+USERS_CACHE_TTL = 10
 
-# Keep track of WebSocket connections.
-_ws_clients = {}
 
 
 def authenticated(method):
@@ -69,6 +106,45 @@ def authenticated(method):
     return my_wrapper
 
 
+def on_ioloop(method):
+    """Decorator for methods that must run on the IOLoop (e.g.: because they publish messages or queue
+    triggers): if called from the threads of the admission control, the call is scheduled on the IOLoop
+    of the request, and nothing is returned."""
+    @tornado.web.functools.wraps(method)
+    def my_wrapper(self, *args, **kwargs):
+        ioloop, ioloop_thread = getattr(self, '_ioloop', None) or (None, None)
+        if ioloop is not None and threading.get_ident() != ioloop_thread:
+            ioloop.add_callback(method, self, *args, **kwargs)
+            return
+        return method(self, *args, **kwargs)
+    return my_wrapper
+
+
+def call_on_ioloop(handler, func, *args, **kwargs):
+    """Call a function on the IOLoop of a request and return its result, waiting for it if called from
+    the threads of the admission control (e.g.: to read objects that are updated only by the IOLoop,
+    like the search indexes).
+
+    :param handler: the request handler
+    :type handler: :class:`BaseHandler`
+    :param func: the function
+    :type func: callable
+
+    :returns: the result of the function
+    """
+    ioloop, ioloop_thread = getattr(handler, '_ioloop', None) or (None, None)
+    if ioloop is None or threading.get_ident() == ioloop_thread:
+        return func(*args, **kwargs)
+    future = concurrent.futures.Future()
+    def _call():
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+    ioloop.add_callback(_call)
+    return future.result()
+
+
 class BaseException(Exception):
     """Base class for EventMan custom exceptions.
 
@@ -91,6 +167,8 @@ class BaseHandler(tornado.web.RequestHandler):
     """Base class for request handlers."""
     permissions = {
         'event|read': True,
+        # only aggregated counters, without personal data: everybody can see how many tickets are left.
+        'event:stats-all|read': True,
         'event:tickets|read': True,
         'event:tickets|create': True,
         'event:tickets|update': True,
@@ -99,7 +177,7 @@ class BaseHandler(tornado.web.RequestHandler):
         'users|create': True
     }
 
-    # Cache currently connected users.
+    # Cache currently connected users, as {user_id: (timestamp, user_info)}.
     _users_cache = {}
 
     # A property to access the first value of each argument.
@@ -176,8 +254,9 @@ class BaseHandler(tornado.web.RequestHandler):
     def current_user_info(self):
         """Information about the current user, including their permissions."""
         current_user = self.current_user
-        if current_user in self._users_cache:
-            return self._users_cache[current_user]
+        cached = self._users_cache.get(current_user)
+        if cached and time.time() - cached[0] < USERS_CACHE_TTL:
+            return cached[1]
         permissions = set([k for (k, v) in self.permissions.items() if v is True])
         user_info = {'permissions': permissions}
         if current_user:
@@ -188,7 +267,7 @@ class BaseHandler(tornado.web.RequestHandler):
                 permissions.update(set(user.get('permissions') or []))
                 user_info['permissions'] = permissions
                 user_info['isRegistered'] = True
-        self._users_cache[current_user] = user_info
+        self._users_cache[current_user] = (time.time(), user_info)
         return user_info
 
     def add_access_info(self, doc):
@@ -297,21 +376,271 @@ class CollectionHandler(BaseHandler):
 
     _id_chars = string.ascii_lowercase + string.digits
 
-    def get_next_seq(self, seq):
+    # query arguments used to sort, paginate and select the fields of the results, instead of filtering them.
+    _query_options = ('_limit', '_skip', '_sort', '_fields', '_cursor')
+
+    # fields that can be used to sort the results, as {resource: fields} (None is the collection itself):
+    # the cursor to the next page contains the values of the sort fields of the last result, so only
+    # scalar fields returned to everybody who can read the list are allowed.
+    sort_fields = {None: ('_id', 'created_at', 'updated_at')}
+
+    # fields that can be used in the filters (see build_filters), as {resource: fields}; a field also allows
+    # its subfields, and None allows every field (e.g.: for the lists that only the staff can read).
+    filter_fields = {None: ('_id', 'created_by', 'created_at', 'updated_by', 'updated_at')}
+    # fields of the collection that can be used in the filters only with a permission, as {field: permission}.
+    filter_permissions = {}
+
+    _crud_methods = {'GET': 'read', 'POST': 'create', 'PUT': 'update', 'DELETE': 'delete'}
+
+    # the staff (e.g.: the check-in desks) has its own queue, served before the others.
+    staff_permission = 'event:tickets-all|update'
+
+    def admission_endpoint(self):
+        """Return the name of the endpoint of the request, used by the admission control:
+        the permission it requires, like event:tickets-all|create.
+
+        :returns: the name of the endpoint
+        :rtype: str
+        """
+        crud_method = self._crud_methods.get(self.request.method)
+        if crud_method is None:
+            return None
+        resource = self.path_kwargs.get('resource')
+        if resource:
+            return '%s:%s%s|%s' % (self.document, resource,
+                                   '-all' if self.path_kwargs.get('resource_id') is None else '', crud_method)
+        if self.path_kwargs.get('id_') is not None:
+            return '%s|%s' % (self.document, crud_method)
+        return '%s|%s' % (self.collection, crud_method)
+
+    @gen.coroutine
+    def prepare(self):
+        # Admission control: wait for a free slot, or reject the request if the server is too busy.
+        self._admission = None
+        self._ioloop = (tornado.ioloop.IOLoop.current(), threading.get_ident())
+        control = getattr(self, 'admission', None)
+        if control is None:
+            return
+        endpoint = self.admission_endpoint()
+        limiter = control.get(endpoint)
+        if limiter is None:
+            return
+        staff = self.has_permission(self.staff_permission)
+        try:
+            if not staff:
+                control.check_delay(endpoint, self.request.request_time())
+            future, position = limiter.acquire(priority=staff)
+            self._admission = (limiter, future, None)
+            waited = yield future
+        except admission.Rejected as e:
+            self._admission = None
+            self.set_status(503)
+            self.set_header('Retry-After', str(e.retry_after))
+            self.finish({'error': True, 'message': e.message, 'queue_position': e.position,
+                         'retry_after': e.retry_after})
+            return
+        self._admission = (limiter, future, time.time())
+        if position:
+            self.set_header('X-Queue-Position', str(position))
+            self.set_header('X-Queue-Wait', '%.3f' % waited)
+
+    @gen.coroutine
+    def call_admitted(self, func, *args):
+        """Call a function that does the work of the request; if the request was admitted by a limiter,
+        the function is run by the threads of the admission control, so that the admitted requests are
+        really served at the same time while the IOLoop serves the others.
+
+        :param func: the function
+        :type func: callable
+
+        :returns: the result of the function
+        """
+        limiter, future, started_at = getattr(self, '_admission', None) or (None, None, None)
+        if started_at is None:
+            raise gen.Return(func(*args))
+        result = yield self.admission.run_in_executor(func, *args)
+        raise gen.Return(result)
+
+    def on_finish(self):
+        limiter, future, started_at = getattr(self, '_admission', None) or (None, None, None)
+        if started_at is not None:
+            self._admission = None
+            limiter.release(time.time() - started_at)
+
+    def on_connection_close(self):
+        limiter, future, started_at = getattr(self, '_admission', None) or (None, None, None)
+        if limiter is not None and started_at is None:
+            # still waiting in the queue.
+            limiter.cancel(future)
+
+    def split_arguments(self, arguments=None, resource=None):
+        """Split the query arguments in filters and options.
+
+        Options are _limit and _skip (integers), _sort and _fields (comma-separated lists of fields;
+        to sort in descending order, prefix a field with "-"; only the sort_fields of the resource
+        can be used) and _cursor (returned as _next by a previous query with _limit).
+
+        :param arguments: the arguments to split (by default, the arguments of the request)
+        :type arguments: dict
+        :param resource: the resource whose items are listed (None for the collection itself)
+        :type resource: str
+
+        :returns: a tuple of (filters, options); options can be passed to Monco.query and Monco.queryList
+        :rtype: tuple
+        """
+        if arguments is None:
+            arguments = self.arguments
+        filters = dict([(k, v) for k, v in arguments.items() if k not in self._query_options])
+        options = {}
+        for key in ('_limit', '_skip'):
+            if arguments.get(key):
+                try:
+                    options[key[1:]] = int(arguments[key])
+                except ValueError:
+                    raise InputException('invalid value for %s: %s' % (key, arguments[key]))
+                if options[key[1:]] < 0:
+                    raise InputException('invalid value for %s: %s' % (key, arguments[key]))
+        for key in ('_sort', '_fields'):
+            if arguments.get(key):
+                options[key[1:]] = [f.strip() for f in arguments[key].split(',') if f.strip()]
+        sort_fields = self.sort_fields.get(resource) or ()
+        for field in options.get('sort') or []:
+            if field.lstrip('+-') not in sort_fields:
+                raise InputException('invalid value for _sort: %s' % field)
+        if arguments.get('_cursor'):
+            try:
+                monco.cursor_query(arguments['_cursor'], options.get('sort'))
+            except monco.MoncoError:
+                raise InputException('invalid value for _cursor')
+            options['cursor'] = arguments['_cursor']
+        return filters, options
+
+    # operators that can follow the name of a field in a query argument; e.g.: created_at[gte]=2017-05-01
+    _filter_operators = ('eq', 'ne', 'in', 'nin', 'gt', 'gte', 'lt', 'lte', 'exists')
+    _re_filter = re.compile(r'^(?P<field>[^\[\]$]+)(?:\[(?P<operator>\w+)\])?$')
+
+    def _filter_value(self, field, value):
+        """Convert the value used by a range operator: dates for the *_at fields, numbers when possible."""
+        if field.endswith('_at'):
+            try:
+                return dateutil.parser.parse(value)
+            except (ValueError, OverflowError):
+                raise InputException('invalid date for %s: %s' % (field, value))
+        for type_ in (int, float):
+            try:
+                return type_(value)
+            except ValueError:
+                pass
+        return value
+
+    def check_filter_field(self, field, resource=None):
+        """Raise an exception if a field can't be used in the filters (see filter_fields and filter_permissions).
+
+        :param field: the field (possibly a dotted path)
+        :type field: str
+        :param resource: the resource whose items are listed (None for the collection itself)
+        :type resource: str
+        """
+        fields = self.filter_fields.get(resource, ())
+        if fields is not None and not any(field == f or field.startswith(f + '.') for f in fields):
+            raise InputException('invalid filter: %s' % field)
+        permission = self.filter_permissions.get(field.split('.')[0]) if resource is None else None
+        if permission and not self.has_permission(permission):
+            raise InputException('insufficient permissions: %s' % permission, status=401)
+
+    def build_filters(self, filters, resource=None):
+        """Convert the filters from the query arguments to a MongoDB query.
+
+        field=value matches equal values; if the value is a boolean (see _bool_convert), a boolean is also
+        matched (and, if false and not "0", also a missing field).
+        field[op]=value uses an operator: eq (string equality), ne, in and nin (comma-separated values),
+        gt, gte, lt and lte (on dates for the fields ending with _at, otherwise numbers if possible),
+        exists (a boolean).
+        Only the filter_fields of the resource can be used.
+
+        :param filters: the filters
+        :type filters: dict
+        :param resource: the resource whose items are listed (None for the collection itself)
+        :type resource: str
+
+        :returns: the query
+        :rtype: dict
+        """
+        query = {}
+        for key, value in filters.items():
+            match = self._re_filter.match(key)
+            if not match:
+                raise InputException('invalid filter: %s' % key)
+            field, operator = match.group('field'), match.group('operator')
+            self.check_filter_field(field, resource)
+            if operator is None:
+                bool_value = self._bool_convert.get(value.lower())
+                if bool_value is None:
+                    condition = value
+                elif bool_value:
+                    condition = {'$in': [value, True]}
+                elif value.isdigit():
+                    condition = {'$in': [value, False]}
+                else:
+                    condition = {'$in': [value, False, None]}
+            elif operator not in self._filter_operators:
+                raise InputException('invalid filter operator: %s' % operator)
+            elif operator in ('in', 'nin'):
+                condition = {'$%s' % operator: value.split(',')}
+            elif operator == 'exists':
+                condition = {'$exists': self.tobool(value) is True}
+            elif operator in ('eq', 'ne'):
+                condition = {'$%s' % operator: value}
+            else:
+                condition = {'$%s' % operator: self._filter_value(field, value)}
+            previous = query.get(field)
+            if previous is not None:
+                # more conditions on the same field.
+                if not isinstance(previous, dict):
+                    previous = {'$eq': previous}
+                if not isinstance(condition, dict):
+                    condition = {'$eq': condition}
+                previous.update(condition)
+                condition = previous
+            query[field] = condition
+        return query
+
+    def add_next_cursor(self, output, results, options):
+        """If the page of results is full, add to the output (modified in place) the cursor to the next page.
+
+        :param output: the output
+        :type output: dict
+        :param results: the current page of results
+        :type results: list
+        :param options: options of the query
+        :type options: dict
+
+        :returns: the output
+        :rtype: dict
+        """
+        limit = options.get('limit')
+        if limit and results and len(results) >= limit:
+            output['_next'] = monco.encode_cursor(results[-1], options.get('sort'))
+        return output
+
+    def get_next_seq(self, seq, count=1):
         """Increment and return the new value of a ever-incrementing counter.
 
         :param seq: unique name of the sequence
         :type seq: str
+        :param count: reserve this number of values, returning the last one
+        :type count: int
 
         :returns: the next value of the sequence
         :rtype: int
         """
-        if not self.db.query(self.counters_collection, {'seq_name': seq}):
-            self.db.add(self.counters_collection, {'seq_name': seq, 'seq': 0})
+        # the counter is atomically created, if missing: safe with more than one process, thanks
+        # to the unique index on seq_name created at startup.
         merged, doc = self.db.update(self.counters_collection,
                 {'seq_name': seq},
-                {'seq': 1},
-                operation='increment')
+                {'seq': count},
+                operation='increment',
+                create=True)
         return doc.get('seq', 0)
 
     def gen_id(self, seq='ids', random_alpha=32):
@@ -365,25 +694,6 @@ class CollectionHandler(BaseHandler):
                     del data[key]
         return data
 
-    def _dict2env(self, data):
-        """Convert a dictionary into a form suitable to be passed as environment variables.
-
-        :param data: dictionary to convert
-        :type data: dict"""
-        ret = {}
-        for key, value in data.items():
-            if isinstance(value, (list, tuple, dict)):
-                continue
-            try:
-                key = key.upper().encode('ascii', 'ignore')
-                key = re_env_key.sub('', key)
-                if not key:
-                    continue
-                ret[key] = str(value).encode(ENCODING)
-            except:
-                continue
-        return ret
-
     def apply_filter(self, data, filter_name):
         """Apply a filter to the data.
 
@@ -405,7 +715,7 @@ class CollectionHandler(BaseHandler):
                 return self.build_error(status=401, message='insufficient permissions: %s' % permission)
             handler = getattr(self, 'handle_get_%s' % resource, None)
             if handler and isinstance(handler, collections.Callable):
-                output = handler(id_, resource_id, **kwargs) or {}
+                output = (yield self.call_admitted(lambda: handler(id_, resource_id, **kwargs))) or {}
                 output = self.apply_filter(output, 'get_%s' % resource)
                 self.write(output)
                 return
@@ -415,7 +725,7 @@ class CollectionHandler(BaseHandler):
             permission = '%s|read' % self.document
             if acl and not self.has_permission(permission):
                 return self.build_error(status=401, message='insufficient permissions: %s' % permission)
-            output = self.db.get(self.collection, id_)
+            output = yield self.call_admitted(self.db.get, self.collection, id_)
             output = self.apply_filter(output, 'get')
             self.write(output)
         else:
@@ -426,8 +736,12 @@ class CollectionHandler(BaseHandler):
             permission = '%s|read' % self.collection
             if acl and not self.has_permission(permission):
                 return self.build_error(status=401, message='insufficient permissions: %s' % permission)
-            output = {self.collection: self.db.query(self.collection, self.arguments)}
-            output = self.apply_filter(output, 'get_all')
+            filters, options = self.split_arguments()
+            results = yield self.call_admitted(lambda: self.db.query(self.collection, self.build_filters(filters),
+                                                                     **options))
+            # the cursor is built after the filters, from the values returned to this user.
+            output = self.apply_filter({self.collection: results}, 'get_all')
+            output = self.add_next_cursor(output, output.get(self.collection) or [], options)
             self.write(output)
 
     @gen.coroutine
@@ -451,7 +765,7 @@ class CollectionHandler(BaseHandler):
             handler = getattr(self, 'handle_%s_%s' % (method, resource), None)
             if handler and isinstance(handler, collections.Callable):
                 data = self.apply_filter(data, 'input_%s_%s' % (method, resource))
-                output = handler(id_, resource_id, data, **kwargs)
+                output = yield self.call_admitted(lambda: handler(id_, resource_id, data, **kwargs))
                 output = self.apply_filter(output, 'get_%s' % resource)
                 env['RESOURCE'] = resource
                 if resource_id:
@@ -466,7 +780,7 @@ class CollectionHandler(BaseHandler):
             if not self.has_permission(permission):
                 return self.build_error(status=401, message='insufficient permissions: %s' % permission)
             data = self.apply_filter(data, 'input_%s' % method)
-            merged, newData = self.db.update(self.collection, id_, data)
+            merged, newData = yield self.call_admitted(self.db.update, self.collection, id_, data)
             newData = self.apply_filter(newData, method)
             self.run_triggers('update_%s' % self.document, stdin_data=newData, env=env)
         else:
@@ -474,7 +788,7 @@ class CollectionHandler(BaseHandler):
             if not self.has_permission(permission):
                 return self.build_error(status=401, message='insufficient permissions: %s' % permission)
             data = self.apply_filter(data, 'input_%s_all' % method)
-            newData = self.db.add(self.collection, data, _id=self.gen_id())
+            newData = yield self.call_admitted(lambda: self.db.add(self.collection, data, _id=self.gen_id()))
             newData = self.apply_filter(newData, '%s_all' % method)
             self.run_triggers('create_%s' % self.document, stdin_data=newData, env=env)
         self.write(newData)
@@ -496,7 +810,7 @@ class CollectionHandler(BaseHandler):
                 return self.build_error(status=401, message='insufficient permissions: %s' % permission)
             method = getattr(self, 'handle_delete_%s' % resource, None)
             if method and isinstance(method, collections.Callable):
-                output = method(id_, resource_id, **kwargs)
+                output = yield self.call_admitted(lambda: method(id_, resource_id, **kwargs))
                 env['RESOURCE'] = resource
                 if resource_id:
                     env['%s_ID' % resource] = resource_id
@@ -508,55 +822,14 @@ class CollectionHandler(BaseHandler):
             permission = '%s|delete' % self.document
             if not self.has_permission(permission):
                 return self.build_error(status=401, message='insufficient permissions: %s' % permission)
-            howMany = self.db.delete(self.collection, id_)
+            howMany = yield self.call_admitted(self.db.delete, self.collection, id_)
             env['DELETED_ITEMS'] = howMany
             self.run_triggers('delete_%s' % self.document, stdin_data=env, env=env)
         else:
             self.write({'success': False})
         self.write({'success': True})
 
-    def on_timeout(self, cmd, pipe):
-        """Kill a process that is taking too long to complete."""
-        logging.debug('cmd %s is taking too long: killing it' % ' '.join(cmd))
-        try:
-            pipe.proc.kill()
-        except:
-            pass
-
-    def on_exit(self, returncode, cmd, pipe):
-        """Callback executed when a subprocess execution is over."""
-        self.ioloop.remove_timeout(self.timeout)
-        logging.debug('cmd: %s returncode: %d' % (' '.join(cmd), returncode))
-
-    @gen.coroutine
-    def run_subprocess(self, cmd, stdin_data=None, env=None):
-        """Execute the given action.
-
-        :param cmd: the command to be run with its command line arguments
-        :type cmd: list
-
-        :param stdin_data: data to be sent over stdin
-        :type stdin_data: str
-        :param env: environment of the process
-        :type env: dict
-        """
-        self.ioloop = tornado.ioloop.IOLoop.instance()
-        processed_env = self._dict2env(env)
-        p = process.Subprocess(cmd, close_fds=True, stdin=process.Subprocess.STREAM,
-                stdout=process.Subprocess.STREAM, stderr=process.Subprocess.STREAM, env=processed_env)
-        p.set_exit_callback(lambda returncode: self.on_exit(returncode, cmd, p))
-        self.timeout = self.ioloop.add_timeout(datetime.timedelta(seconds=PROCESS_TIMEOUT),
-                lambda: self.on_timeout(cmd, p))
-        yield gen.Task(p.stdin.write, stdin_data or '')
-        p.stdin.close()
-        out, err = yield [gen.Task(p.stdout.read_until_close),
-                gen.Task(p.stderr.read_until_close)]
-        logging.debug('cmd: %s' % ' '.join(cmd))
-        logging.debug('cmd stdout: %s' % out)
-        logging.debug('cmd strerr: %s' % err)
-        raise gen.Return((out, err))
-
-    @gen.coroutine
+    @on_ioloop
     def run_triggers(self, action, stdin_data=None, env=None):
         """Asynchronously execute triggers for the given action.
 
@@ -567,18 +840,26 @@ class CollectionHandler(BaseHandler):
         :param env: environment of the process
         :type stdin_data: dict
         """
-        if not hasattr(self, 'data_dir'):
+        if getattr(self, 'triggers', None) is None:
             return
-        logging.debug('running triggers for action "%s"' % action)
-        stdin_data = stdin_data or {}
         try:
-            stdin_data = json.dumps(stdin_data)
-        except:
-            stdin_data = '{}'
-        for script in glob.glob(os.path.join(self.data_dir, 'triggers', '%s.d' % action, '*')):
-            if not (os.path.isfile(script) and os.access(script, os.X_OK)):
-                continue
-            out, err = yield gen.Task(self.run_subprocess, [script], stdin_data, env)
+            self.triggers.run(action, stdin_data=stdin_data, env=env)
+        except Exception as e:
+            self.logger.error('unable to queue triggers for action "%s": %s', action, e)
+
+    @on_ioloop
+    def run_many_triggers(self, actions):
+        """Asynchronously execute triggers for many actions, queued at once.
+
+        :param actions: list of (action, stdin_data, env) tuples (see the `run_triggers` method)
+        :type actions: list
+        """
+        if getattr(self, 'triggers', None) is None or not actions:
+            return
+        try:
+            self.triggers.run_many(actions)
+        except Exception as e:
+            self.logger.error('unable to queue triggers for %d actions: %s', len(actions), e)
 
     def build_ws_url(self, path, proto='ws', host=None):
         """Return a WebSocket url from a path."""
@@ -588,19 +869,24 @@ class CollectionHandler(BaseHandler):
             args = ''
         return 'ws://127.0.0.1:%s/ws/%s%s' % (self.listen_port + 1, path, args)
 
+    @on_ioloop
     @gen.coroutine
     def send_ws_message(self, path, message):
         """Send a WebSocket message to all the connected clients.
 
-        :param path: partial path used to build the WebSocket url
+        :param path: partial path used to build the WebSocket url; also the name of the broker channel
         :type path: str
         :param message: message to send
         :type message: str
         """
         try:
-            ws = yield tornado.websocket.websocket_connect(self.build_ws_url(path))
-            ws.write_message(message)
-            ws.close()
+            if getattr(self, 'ws_loopback', False):
+                # compatibility mode: connect to our own WebSocket server, that relays the message.
+                ws = yield tornado.websocket.websocket_connect(self.build_ws_url(path))
+                ws.write_message(message)
+                ws.close()
+            else:
+                self.broker.publish(path, message)
         except Exception as e:
             self.logger.error('Error yielding WebSocket message: %s', e)
 
@@ -610,10 +896,70 @@ class EventsHandler(CollectionHandler):
     document = 'event'
     collection = 'events'
 
+    # deleted tickets, used by clients that ask only for the changes.
+    tombstones_collection = 'tickets_tombstones'
+
+    sort_fields = {
+        None: ('_id', 'title', 'where', 'group_id', 'begin_date', 'begin_time', 'end_date', 'end_time',
+               'number_of_tickets', 'created_at', 'updated_at'),
+        'tickets': ('_id', 'seq', 'seq_hex', 'name', 'surname', 'email', 'company', 'job title', 'ticket_kind',
+                    'attended', 'cancelled', 'order_nr', 'version', 'created_at', 'updated_at')
+    }
+    # the tickets can be filtered on any field (e.g.: the columns of an imported file), since reading them
+    # requires a permission; the same permission is required to filter the events on their tickets.
+    filter_fields = {
+        None: ('_id', 'title', 'where', 'group_id', 'begin_date', 'begin_time', 'end_date', 'end_time',
+               'number_of_tickets', 'ticket_sales_begin_date', 'ticket_sales_begin_time', 'ticket_sales_end_date',
+               'ticket_sales_end_time', 'created_by', 'created_at', 'updated_by', 'updated_at', 'tickets'),
+        'tickets': None
+    }
+    filter_permissions = {'tickets': 'event:tickets-all|read'}
+
+    def next_tickets_version(self, id_, count=1):
+        """Return a new version, stamped on a changed ticket (or the last of `count` versions).
+        The versions are in flight until `release_tickets_version` is called, after the write.
+
+        :param id_: the ID of the event
+        :type id_: str
+        :param count: number of versions to reserve
+        :type count: int
+
+        :returns: the new version
+        :rtype: int
+        """
+        return self.db.reserveSequence(self.counters_collection, {'seq_name': 'event_%s_tickets_version' % id_},
+                                       count=count, maxAge=TICKETS_VERSION_TIMEOUT)
+
+    def release_tickets_version(self, id_, version, count=1):
+        """Notify that the write of the tickets stamped with some versions is over (successful or not).
+
+        :param id_: the ID of the event
+        :type id_: str
+        :param version: the version returned by `next_tickets_version`
+        :type version: int
+        :param count: number of reserved versions
+        :type count: int
+        """
+        self.db.releaseSequence(self.counters_collection, {'seq_name': 'event_%s_tickets_version' % id_},
+                                version - count + 1)
+
+    def tickets_version_watermark(self, id_):
+        """Return the highest version such that every change with a lower or equal version was already
+        written: a client asking for the changes since this version can't miss a write still in flight.
+
+        :param id_: the ID of the event
+        :type id_: str
+
+        :returns: the version
+        :rtype: int
+        """
+        return self.db.sequenceWatermark(self.counters_collection, {'seq_name': 'event_%s_tickets_version' % id_},
+                                         maxAge=TICKETS_VERSION_TIMEOUT)
+
     def _mangle_event(self, event):
         # Some in-place changes to an event
         if 'tickets' in event:
-            event['tickets_sold'] = len([t for t in event['tickets'] if not t.get('cancelled')])
+            event['tickets_sold'] = self.event_stats(event)['registered']
             event['no_tickets_for_sale'] = False
             try:
                 self._check_sales_datetime(event)
@@ -627,6 +973,169 @@ class EventsHandler(CollectionHandler):
     def filter_get(self, output):
         return self._mangle_event(output)
 
+    # fields of an event read or returned together with one of its tickets, instead of the whole event.
+    ticket_event_fields = ('title', 'begin_date', 'begin_time', 'end_date', 'end_time', 'where', 'group_id',
+                           'number_of_tickets', 'ticket_sales_begin_date', 'ticket_sales_begin_time',
+                           'ticket_sales_end_date', 'ticket_sales_end_time', 'stats')
+
+    def ticket_projection(self, ticket_id):
+        """Return a projection of an event including a single ticket (and the ticket_event_fields).
+
+        :param ticket_id: the ID of the ticket
+        :type ticket_id: str
+
+        :returns: the projection
+        :rtype: dict
+        """
+        fields = dict([(field, True) for field in self.ticket_event_fields])
+        fields['tickets'] = {'$elemMatch': {'_id': ticket_id}}
+        return fields
+
+    @staticmethod
+    def _ticket_counters(ticket):
+        """Return the contribution of a ticket to the counters of its event, as {'dotted.name': value}."""
+        counters = {}
+        if not ticket:
+            return counters
+        kind = re.sub(r'[.$]', '_', str(ticket.get('ticket_kind') or 'default'))
+        if ticket.get('cancelled'):
+            counters['cancelled'] = 1
+            return counters
+        counters['registered'] = 1
+        counters['kinds.%s.registered' % kind] = 1
+        if ticket.get('attended'):
+            counters['attended'] = 1
+            counters['kinds.%s.attended' % kind] = 1
+        return counters
+
+    @staticmethod
+    def _checkin_bucket(date):
+        """Name of the counter of the check-ins in the minute of a date."""
+        return 'checkins.%s' % date.strftime('%Y%m%d%H%M')
+
+    def stats_increment(self, old_ticket, new_ticket):
+        """Return how the counters of an event change, when a ticket changes.
+
+        :param old_ticket: the ticket before the change (None if it was created)
+        :type old_ticket: dict
+        :param new_ticket: the ticket after the change (None if it was deleted)
+        :type new_ticket: dict
+
+        :returns: the increments, suitable for the $inc operator of MongoDB
+        :rtype: dict
+        """
+        old_counters = self._ticket_counters(old_ticket)
+        new_counters = self._ticket_counters(new_ticket)
+        increment = {}
+        for key in set(old_counters) | set(new_counters):
+            delta = new_counters.get(key, 0) - old_counters.get(key, 0)
+            if delta:
+                increment['stats.%s' % key] = delta
+        if 'attended' in new_counters and 'attended' not in old_counters:
+            increment['stats.%s' % self._checkin_bucket(datetime.datetime.utcnow())] = 1
+        return increment
+
+    def compute_stats(self, tickets):
+        """Compute from scratch the counters of an event.
+        The check-ins are counted in the minute of the last update of each attended ticket.
+
+        :param tickets: the tickets of the event
+        :type tickets: list
+
+        :returns: the counters
+        :rtype: dict
+        """
+        stats = {'initialized': True, 'registered': 0, 'cancelled': 0, 'attended': 0, 'kinds': {}, 'checkins': {}}
+        for ticket in tickets:
+            counters = self._ticket_counters(ticket)
+            if 'attended' in counters and isinstance(ticket.get('updated_at'), datetime.datetime):
+                counters[self._checkin_bucket(ticket['updated_at'])] = 1
+            for key, value in counters.items():
+                node = stats
+                path = key.split('.')
+                for name in path[:-1]:
+                    node = node.setdefault(name, {})
+                node[path[-1]] = node.get(path[-1], 0) + value
+        return stats
+
+    def event_stats(self, event):
+        """Return the statistics about the tickets of an event: number of registered (not cancelled),
+        cancelled and attended tickets, the same numbers for every kind of ticket and the check-ins of every minute.
+
+        :param event: the event
+        :type event: dict
+
+        :returns: the counters
+        :rtype: dict
+        """
+        stats = event.get('stats')
+        if stats and stats.get('initialized'):
+            return stats
+        if 'tickets' not in event and event.get('_id') is not None:
+            # the event was read without its tickets.
+            return self.get_event_stats(event['_id']) or self.compute_stats([])
+        return self.compute_stats(event.get('tickets') or [])
+
+    def get_event_stats(self, id_):
+        """Read the statistics of an event, without reading its tickets
+        (they are counted only the first time, if the counters are missing).
+
+        :param id_: the ID of the event
+        :type id_: str
+
+        :returns: the counters, or None if the event doesn't exist
+        :rtype: dict
+        """
+        event = self.db.query('events', {'_id': id_}, fields=['stats'])
+        if not event:
+            return None
+        stats = event[0].get('stats') or {}
+        for attempt in range(UPDATE_TICKET_RETRIES):
+            if stats.get('initialized'):
+                break
+            # the tickets and the (missing or partial) counters are read at once.
+            event = self.db.query('events', {'_id': id_}, fields=['stats', 'tickets'])
+            if not event:
+                return None
+            old_stats = event[0].get('stats')
+            computed = self.compute_stats(event[0].get('tickets') or [])
+            # store the counters only if they are still the ones read with the tickets: a ticket written
+            # in the meantime has also incremented them, and they must be computed again.
+            merged, doc = self.db.update('events',
+                    {'_id': id_, 'stats': {'$exists': False} if old_stats is None else old_stats},
+                    {'stats': computed}, create=False, fields=['stats'])
+            if doc:
+                return computed
+            stats = (self.db.query('events', {'_id': id_}, fields=['stats']) or [{}])[0].get('stats') or {}
+        else:
+            if not stats.get('initialized'):
+                # too many concurrent writes: the counters will be stored next time.
+                return computed
+        return stats
+
+    def handle_get_stats(self, id_, resource_id=None):
+        stats = self.get_event_stats(id_)
+        if stats is None:
+            raise InputException('event not found', status=404)
+        return {'stats': stats}
+
+    @on_ioloop
+    def send_event_stats(self, id_, event):
+        """Publish the statistics of an event to the clients subscribed to its stats channel.
+
+        :param id_: the ID of the event
+        :type id_: str
+        :param event: the event
+        :type event: dict
+        """
+        if not event or getattr(self, 'broker', None) is None:
+            return
+        message = {'action': 'stats', 'event_id': id_, 'stats': self.event_stats(event)}
+        try:
+            self.broker.publish('event/%s/stats' % id_, json.dumps(message))
+        except Exception as e:
+            self.logger.error('Error publishing the stats of event %s: %s', id_, e)
+
     def filter_get_all(self, output):
         for event in output.get('events') or []:
             self._mangle_event(event)
@@ -636,11 +1145,17 @@ class EventsHandler(CollectionHandler):
         # Auto-generate the group_id, if missing.
         if 'group_id' not in data:
             data['group_id'] = self.gen_id()
+        # The counters are only updated with the tickets.
+        data.pop('stats', None)
         return data
 
-    filter_input_post_all = filter_input_post
     filter_input_put = filter_input_post
 
+    def filter_input_post_all(self, data):
+        data = self.filter_input_post(data)
+        data['stats'] = self.compute_stats(data.get('tickets') or [])
+        return data
+
     def filter_input_post_tickets(self, data):
         # Avoid users to be able to auto-update their 'attendee' status.
         if not self.has_permission('event|update'):
@@ -692,11 +1207,55 @@ class EventsHandler(CollectionHandler):
     def handle_get_tickets(self, id_, resource_id=None):
         # Return every ticket registered at this event, or the information
         # about a specific ticket.
-        query = {'_id': id_}
-        event = self.db.query('events', query)[0]
+        if resource_id == 'search':
+            return self.search_tickets(id_)
         if resource_id:
-            return {'ticket': self._get_ticket_data(resource_id, event.get('tickets') or [])}
-        tickets = self._filter_results(event.get('tickets') or [], self.arguments)
+            event = self.db.get('events', id_, fields={'tickets': {'$elemMatch': {'_id': resource_id}}})
+            return {'ticket': (event.get('tickets') or [{}])[0]}
+        arguments = self.arguments
+        since = arguments.pop('since', None)
+        filters, options = self.split_arguments(arguments, resource='tickets')
+        query = self.build_filters(filters, resource='tickets')
+        # read before the tickets: a change made while they are read is returned again by the next request,
+        # and so is a change whose version was already reserved but is not yet written.
+        version = self.tickets_version_watermark(id_)
+        output = {'version': version}
+        if since:
+            # only the tickets changed since a version (or a date), and the deleted ones.
+            try:
+                since_query = {'version': {'$gt': int(since)}}
+                tombstones_query = {'event_id': id_, 'version': {'$gt': int(since)}}
+            except ValueError:
+                try:
+                    since = dateutil.parser.parse(since)
+                except (ValueError, OverflowError):
+                    raise InputException('invalid value for since: %s' % since)
+                since_query = {'$or': [{'updated_at': {'$gte': since}}, {'created_at': {'$gte': since}}]}
+                tombstones_query = {'event_id': id_, 'deleted_at': {'$gte': since}}
+            query = {'$and': [query, since_query]} if query else since_query
+            output['deleted'] = [t['ticket_id'] for t in self.db.query(self.tombstones_collection, tombstones_query,
+                                                                     fields=['ticket_id'], sort=['version'])]
+        tickets = self.db.queryList('events', id_, 'tickets', query, **options)
+        output['tickets'] = tickets
+        return self.add_next_cursor(output, tickets, options)
+
+    def search_tickets(self, id_):
+        # Search the tickets of this event, matching the beginning of the words
+        # of name, surname, email, company and seq_hex.
+        if not self.has_permission('event:tickets-all|read'):
+            self.set_status(401)
+            return {'error': True, 'message': 'insufficient permissions: event:tickets-all|read'}
+        query = self.get_argument('q', '')
+        try:
+            limit = int(self.get_argument('_limit', search.SEARCH_LIMIT))
+        except ValueError:
+            raise InputException('invalid value for _limit')
+        if limit < 1:
+            raise InputException('invalid value for _limit')
+        t0 = time.time()
+        # the indexes are updated by the broker on the IOLoop: search them there.
+        tickets = call_on_ioloop(self, self.search_indexes.search, id_, query, limit=limit)
+        metrics.observe('search_seconds', time.time() - t0)
         return {'tickets': tickets}
 
     def _check_number_of_tickets(self, event):
@@ -709,11 +1268,26 @@ class EventsHandler(CollectionHandler):
             number_of_tickets = int(number_of_tickets)
         except ValueError:
             return
-        tickets = event.get('tickets') or []
-        tickets = [t for t in tickets if not t.get('cancelled')]
-        if len(tickets) >= event['number_of_tickets']:
+        if self.event_stats(event)['registered'] >= number_of_tickets:
             raise InputException('no more tickets available')
 
+    def capacity_condition(self):
+        """Return a condition on an event that matches only if it has tickets available (i.e.: if the
+        stats.registered counter is lower than number_of_tickets), to be used in the same write that adds
+        a ticket or restores a cancelled one, so that concurrent requests can't sell too many tickets.
+
+        :returns: the condition, or None if the number of tickets is not limited for the current user
+        :rtype: dict
+        """
+        if self.has_permission('admin|all'):
+            return None
+        max_tickets = {'$convert': {'input': '$number_of_tickets', 'to': 'int', 'onError': None, 'onNull': None}}
+        return {'$expr': {'$let': {
+            'vars': {'max_tickets': max_tickets},
+            'in': {'$or': [{'$eq': ['$$max_tickets', None]},
+                           {'$lt': [{'$ifNull': ['$stats.registered', 0]}, '$$max_tickets']}]}
+        }}}
+
     def _check_sales_datetime(self, event):
         if self.has_permission('admin|all'):
             return
@@ -760,7 +1334,9 @@ class EventsHandler(CollectionHandler):
             raise InputException('ticket sales has ended')
 
     def handle_post_tickets(self, id_, resource_id, data):
-        event = self.db.query('events', {'_id': id_})[0]
+        if resource_id == 'batch':
+            return self.batch_update_tickets(id_, data)
+        event = self.db.query('events', {'_id': id_}, fields=self.ticket_event_fields)[0]
         self._check_sales_datetime(event)
         self._check_number_of_tickets(event)
         uuid, arguments = self.uuid_arguments
@@ -770,14 +1346,31 @@ class EventsHandler(CollectionHandler):
         data['_id'] = ticket_id = self.gen_id()
         self.add_access_info(data)
         ret = {'action': 'add', 'ticket': data, 'uuid': uuid}
-        merged, doc = self.db.update('events',
-                {'_id': id_},
-                {'tickets': data},
-                operation='appendUnique',
-                create=False)
+        query = {'_id': id_}
+        increment = self.stats_increment(None, data)
+        condition = None
+        if increment.get('stats.registered', 0) > 0:
+            condition = self.capacity_condition()
+        if condition:
+            query.update(condition)
+        data['version'] = self.next_tickets_version(id_)
+        try:
+            merged, doc = self.db.update('events',
+                    query,
+                    {'tickets': data},
+                    operation='appendUnique',
+                    create=False,
+                    increment=increment,
+                    fields=self.ticket_projection(ticket_id))
+        finally:
+            self.release_tickets_version(id_, data['version'])
+        if not doc and condition:
+            # sold out while the ticket was being added.
+            raise InputException('no more tickets available')
         if doc:
+            ticket = (doc.pop('tickets', None) or [{}])[0]
             self.send_ws_message('event/%s/tickets/updates' % id_, json.dumps(ret))
-            ticket = self._get_ticket_data(ticket_id, doc.get('tickets') or [])
+            self.send_event_stats(id_, doc)
             env = dict(ticket)
             env.update({'PERSON_ID': ticket_id, 'TICKED_ID': ticket_id, 'EVENT_ID': id_,
                 'EVENT_TITLE': doc.get('title', ''), 'WEB_USER': self.current_user_info.get('username', ''),
@@ -797,52 +1390,80 @@ class EventsHandler(CollectionHandler):
         if '_errorMessage' in arguments:
             _errorMessage = arguments['_errorMessage']
             del arguments['_errorMessage']
-        query = dict([('tickets.%s' % k, v) for k, v in arguments.items()])
-        query['_id'] = id_
         if ticket_id is not None:
-            query['tickets._id'] = ticket_id
             ticket_query = {'_id': ticket_id}
         else:
-            ticket_query = arguments
-        old_ticket_data = {}
-        current_event = self.db.query(self.collection, query)
-        if current_event:
-            current_event = current_event[0]
+            ticket_query = self.build_filters(arguments, resource='tickets')
+        query = dict([('tickets.%s' % k, v) for k, v in ticket_query.items()])
+        query['_id'] = id_
+        username = self.current_user_info.get('username', '')
+        for attempt in range(UPDATE_TICKET_RETRIES):
+            # the event (without the tickets) and the matching tickets are read at once; the matching is done
+            # by the database, and two matches are enough to know that the query is ambiguous.
+            current_event, matching_tickets = self.db.getWithListItems(self.collection, id_, 'tickets',
+                                                                       ticket_query, limit=2)
+            current_event = current_event or {}
+            self._check_sales_datetime(current_event)
+            nr_matches = len(matching_tickets)
+            if nr_matches > 1:
+                ret = {'error': True, 'message': 'more than one ticket matched. %s' % _errorMessage, 'query': query,
+                       'uuid': uuid, 'username': username}
+                self.send_ws_message('event/%s/tickets/updates' % id_, json.dumps(ret))
+                self.set_status(400)
+                return ret
+            elif nr_matches == 0:
+                ret = {'error': True, 'message': 'no ticket matched. %s' % _errorMessage, 'query': query,
+                       'uuid': uuid, 'username': username}
+                self.send_ws_message('event/%s/tickets/updates' % id_, json.dumps(ret))
+                self.set_status(400)
+                return ret
+            old_ticket_data = matching_tickets[0]
+            new_ticket_data = dict(old_ticket_data)
+            new_ticket_data.update(data)
+            if new_ticket_data == old_ticket_data:
+                # nothing to change (e.g.: a ticket scanned twice at the check-in): don't write anything.
+                ret = {'action': 'update', '_id': str(old_ticket_data['_id']), 'ticket': old_ticket_data,
+                       'unchanged': True, 'uuid': uuid, 'username': username}
+                if data.get('attended'):
+                    ret['already_attended'] = True
+                return ret
+
+            # We have changed the "cancelled" status of a ticket to False; check if we still have a ticket available
+            if 'number_of_tickets' in current_event and old_ticket_data.get('cancelled') and not data.get('cancelled'):
+                self._check_number_of_tickets(current_event)
+
+            update_data = self.add_access_info(dict(data))
+            update_data['version'] = self.next_tickets_version(id_)
+            new_ticket_data = dict(old_ticket_data)
+            new_ticket_data.update(update_data)
+            increment = self.stats_increment(old_ticket_data, new_ticket_data)
+            # update the ticket only if it was not changed since it was read (e.g.: by another check-in desk):
+            # otherwise, read it again.
+            update_query = {'_id': id_, 'tickets': {'$elemMatch': {'_id': old_ticket_data['_id'],
+                                                                   'version': old_ticket_data.get('version')}}}
+            if increment.get('stats.registered', 0) > 0:
+                # a cancelled ticket is restored: also check, in the same write, that it's still available.
+                update_query.update(self.capacity_condition() or {})
+            try:
+                merged, doc = self.db.update('events', update_query,
+                        update_data, updateList='tickets', listFilter={'_id': old_ticket_data['_id']}, create=False,
+                        increment=increment,
+                        fields=self.ticket_projection(old_ticket_data['_id']))
+            finally:
+                self.release_tickets_version(id_, update_data['version'])
+            if doc:
+                break
         else:
-            current_event = {}
-        self._check_sales_datetime(current_event)
-        tickets = current_event.get('tickets') or []
-        matching_tickets = self._get_ticket_data(ticket_query, tickets, only_one=False)
-        nr_matches = len(matching_tickets)
-        if nr_matches > 1:
-            ret = {'error': True, 'message': 'more than one ticket matched. %s' % _errorMessage, 'query': query,
-                   'uuid': uuid, 'username': self.current_user_info.get('username', '')}
-            self.send_ws_message('event/%s/tickets/updates' % id_, json.dumps(ret))
-            self.set_status(400)
+            ret = {'error': True, 'message': 'the ticket was changed while updating it. %s' % _errorMessage,
+                   'query': query, 'uuid': uuid, 'username': username}
+            self.set_status(409)
             return ret
-        elif nr_matches == 0:
-            ret = {'error': True, 'message': 'no ticket matched. %s' % _errorMessage, 'query': query,
-                   'uuid': uuid, 'username': self.current_user_info.get('username', '')}
-            self.send_ws_message('event/%s/tickets/updates' % id_, json.dumps(ret))
-            self.set_status(400)
-            return ret
-        else:
-            old_ticket_data = matching_tickets[0]
-
-        # We have changed the "cancelled" status of a ticket to False; check if we still have a ticket available
-        if 'number_of_tickets' in current_event and old_ticket_data.get('cancelled') and not data.get('cancelled'):
-            self._check_number_of_tickets(current_event)
-
-        self.add_access_info(data)
-        merged, doc = self.db.update('events', query,
-                data, updateList='tickets', create=False)
-        new_ticket_data = self._get_ticket_data(ticket_query,
-                doc.get('tickets') or [])
+        new_ticket_data = (doc.pop('tickets', None) or [{}])[0]
         env = dict(new_ticket_data)
         # always takes the ticket_id from the new ticket
         ticket_id = str(new_ticket_data.get('_id'))
         env.update({'PERSON_ID': ticket_id, 'TICKED_ID': ticket_id, 'EVENT_ID': id_,
-            'EVENT_TITLE': doc.get('title', ''), 'WEB_USER': self.current_user_info.get('username', ''),
+            'EVENT_TITLE': doc.get('title', ''), 'WEB_USER': username,
             'WEB_REMOTE_IP': self.request.remote_ip})
         stdin_data = {'old': old_ticket_data,
             'new': new_ticket_data,
@@ -855,34 +1476,200 @@ class EventsHandler(CollectionHandler):
                 self.run_triggers('attends', stdin_data=stdin_data, env=env)
 
         ret = {'action': 'update', '_id': ticket_id, 'ticket': new_ticket_data,
-               'uuid': uuid, 'username': self.current_user_info.get('username', '')}
+               'uuid': uuid, 'username': username}
         if old_ticket_data != new_ticket_data:
             self.send_ws_message('event/%s/tickets/updates' % id_, json.dumps(ret))
+            if (old_ticket_data.get('cancelled') != new_ticket_data.get('cancelled') or
+                    old_ticket_data.get('attended') != new_ticket_data.get('attended')):
+                self.send_event_stats(id_, doc)
         return ret
 
+    def _lookup_tickets(self, query, tickets, lookups):
+        """Return the tickets matching all the keys of a query, using (and filling) a dictionary
+        of lookup tables, one for every field used by the queries."""
+        field = sorted(query)[0]
+        if field not in lookups:
+            lookup = lookups[field] = {}
+            for ticket in tickets:
+                try:
+                    lookup.setdefault(ticket.get(field), []).append(ticket)
+                except TypeError:
+                    # unhashable value.
+                    continue
+        try:
+            candidates = lookups[field].get(query[field]) or []
+        except TypeError:
+            return []
+        return [t for t in candidates if all(t.get(k) == v for k, v in query.items())]
+
+    def batch_update_tickets(self, id_, data):
+        # Update many tickets of this event (e.g.: the check-ins buffered by a scanner that was offline)
+        # with a single read and a single write; every ticket is written only if it didn't change since
+        # it was read (otherwise its items get a "conflict" result, and can be sent again).
+        # data is like {"items": [{"query": {"seq_hex": "00002A"}, "data": {"attended": true}}, ...]}
+        if not self.has_permission('event:tickets-all|update'):
+            self.set_status(401)
+            return {'error': True, 'message': 'insufficient permissions: event:tickets-all|update'}
+        uuid, arguments = self.uuid_arguments
+        items = data.get('items')
+        if not isinstance(items, list):
+            raise InputException('missing list of items')
+        if len(items) > MAX_BATCH_ITEMS:
+            raise InputException('too many items: at most %d are allowed' % MAX_BATCH_ITEMS)
+        event = self.db.query(self.collection, {'_id': id_})
+        if not event:
+            raise InputException('event not found')
+        event = event[0]
+        self._check_sales_datetime(event)
+        tickets = event.get('tickets') or []
+        capacity = self.capacity_condition()
+        available = None
+        if event.get('number_of_tickets') is not None and not self.has_permission('admin|all'):
+            try:
+                available = int(event['number_of_tickets']) - self.event_stats(event)['registered']
+            except ValueError:
+                pass
+        user_id = self.current_user
+        now = datetime.datetime.utcnow()
+        lookups = {}
+        # ticket_id: (ticket before the changes, ticket)
+        changes = collections.OrderedDict()
+        # ticket_id: indexes of the results of the items that changed it
+        ticket_results = {}
+        results = []
+        for item in items:
+            query = item.get('query') if isinstance(item, dict) else None
+            if not isinstance(query, dict) or not query:
+                results.append({'result': 'error', 'message': 'invalid item'})
+                continue
+            matches = self._lookup_tickets(query, tickets, lookups)
+            if not matches:
+                results.append({'result': 'no_match', 'query': query})
+                continue
+            if len(matches) > 1:
+                results.append({'result': 'multiple_matches', 'query': query})
+                continue
+            ticket = matches[0]
+            update = self._clean_dict(dict(item.get('data') or {}))
+            if ticket.get('cancelled') and 'cancelled' in update and not update['cancelled']:
+                # the ticket is no more cancelled; check if we still have a ticket available.
+                if available is not None and available <= 0:
+                    results.append({'result': 'error', 'message': 'no more tickets available', 'query': query})
+                    continue
+            if available is not None and 'cancelled' in update and bool(ticket.get('cancelled')) != bool(update['cancelled']):
+                available += 1 if update['cancelled'] else -1
+            ticket_id = str(ticket['_id'])
+            if ticket_id not in changes:
+                changes[ticket_id] = (dict(ticket), ticket)
+            ticket.update(update)
+            ticket['updated_by'] = user_id
+            ticket['updated_at'] = now
+            for key in update:
+                # the lookup tables of the changed fields are no more valid.
+                lookups.pop(key, None)
+            ticket_results.setdefault(ticket_id, []).append(len(results))
+            results.append({'result': 'ok', 'query': query, 'ticket': ticket})
+        updates = []
+        version = self.next_tickets_version(id_, count=len(changes)) - len(changes) if changes else 0
+        for ticket_id, (old_ticket, ticket) in changes.items():
+            version += 1
+            ticket['version'] = version
+            increment = self.stats_increment(old_ticket, ticket)
+            # the check on the available tickets, done above, is repeated atomically by the write.
+            condition = capacity if increment.get('stats.registered', 0) > 0 else None
+            updates.append((ticket['_id'], dict([(k, v) for k, v in ticket.items()
+                                                  if k not in old_ticket or old_ticket[k] != v]),
+                            increment, {'version': old_ticket.get('version')}, condition))
+        try:
+            updated = self.db.updateListItems(self.collection, id_, 'tickets', updates)
+        finally:
+            if changes:
+                self.release_tickets_version(id_, version, count=len(changes))
+        if updated < len(updates):
+            # some tickets were changed by someone else in the meantime (or sold out): find them.
+            current = dict([(str(t['_id']), t) for t in self.db.queryList(self.collection, id_, 'tickets',
+                    {'_id': {'$in': [old_ticket['_id'] for old_ticket, ticket in changes.values()]}},
+                    fields=['_id', 'version'])])
+            for ticket_id, (old_ticket, ticket) in list(changes.items()):
+                current_version = (current.get(ticket_id) or {}).get('version')
+                if current_version == ticket['version']:
+                    continue
+                del changes[ticket_id]
+                for idx in ticket_results[ticket_id]:
+                    if current_version == old_ticket.get('version'):
+                        results[idx] = {'result': 'error', 'message': 'no more tickets available',
+                                        'query': results[idx]['query']}
+                    else:
+                        results[idx] = {'result': 'conflict', 'message': 'the ticket was changed while updating it',
+                                        'query': results[idx]['query']}
+
+        # Coalesce triggers (queued with a single write) and WebSocket messages (merged by the broker).
+        event_info = dict([(k, v) for k, v in event.items() if k != 'tickets'])
+        actions = []
+        stats_changed = False
+        for ticket_id, (old_ticket, ticket) in changes.items():
+            env = dict(ticket)
+            env.update({'PERSON_ID': ticket_id, 'TICKED_ID': ticket_id, 'EVENT_ID': id_,
+                'EVENT_TITLE': event.get('title', ''), 'WEB_USER': self.current_user_info.get('username', ''),
+                'WEB_REMOTE_IP': self.request.remote_ip})
+            stdin_data = {'old': old_ticket, 'new': ticket, 'event': event_info, 'merged': True}
+            actions.append(('update_ticket_in_event', stdin_data, env))
+            if ticket.get('attended') and not old_ticket.get('attended'):
+                actions.append(('attends', stdin_data, env))
+            if (old_ticket.get('cancelled') != ticket.get('cancelled') or
+                    old_ticket.get('attended') != ticket.get('attended')):
+                stats_changed = True
+            ret = {'action': 'update', '_id': ticket_id, 'ticket': ticket,
+                   'uuid': uuid, 'username': self.current_user_info.get('username', '')}
+            self.send_ws_message('event/%s/tickets/updates' % id_, json.dumps(ret))
+        self.run_many_triggers(actions)
+        if stats_changed:
+            self.send_event_stats(id_, {'stats': self.get_event_stats(id_)})
+        return {'results': results, 'updated': updated}
+
     def handle_delete_tickets(self, id_, ticket_id):
         # Remove a specific ticket from the list of tickets registered at this event.
         uuid, arguments = self.uuid_arguments
-        doc = self.db.query('events',
-                {'_id': id_, 'tickets._id': ticket_id})
         ret = {'action': 'delete', '_id': ticket_id, 'uuid': uuid}
-        if doc:
-            ticket = self._get_ticket_data(ticket_id, doc[0].get('tickets') or [])
+        for attempt in range(UPDATE_TICKET_RETRIES):
+            doc = self.db.query('events',
+                    {'_id': id_, 'tickets._id': ticket_id}, fields=self.ticket_projection(ticket_id))
+            if not doc:
+                # the event or the ticket doesn't exist (e.g.: already deleted by another request).
+                return ret
+            ticket = (doc[0].get('tickets') or [{}])[0]
+            # remove the ticket only if it was not changed since it was read, so that the counters are
+            # decremented only once and by the right amounts: otherwise, read it again.
             merged, rdoc = self.db.update('events',
-                    {'_id': id_},
+                    {'_id': id_, 'tickets': {'$elemMatch': {'_id': ticket_id, 'version': ticket.get('version')}}},
                     {'tickets': {'_id': ticket_id}},
                     operation='delete',
-                    create=False)
-            self.send_ws_message('event/%s/tickets/updates' % id_, json.dumps(ret))
-            env = dict(ticket)
-            env.update({'PERSON_ID': ticket_id, 'TICKED_ID': ticket_id, 'EVENT_ID': id_,
-                'EVENT_TITLE': rdoc.get('title', ''), 'WEB_USER': self.current_user_info.get('username', ''),
-                'WEB_REMOTE_IP': self.request.remote_ip})
-            stdin_data = {'old': ticket,
-                'event': rdoc,
-                'merged': merged
-            }
-            self.run_triggers('delete_ticket_in_event', stdin_data=stdin_data, env=env)
+                    create=False,
+                    increment=self.stats_increment(ticket, None),
+                    fields=self.ticket_event_fields)
+            if rdoc:
+                break
+        else:
+            self.set_status(409)
+            return {'error': True, 'message': 'the ticket was changed while deleting it', '_id': ticket_id,
+                    'uuid': uuid}
+        version = self.next_tickets_version(id_)
+        try:
+            self.db.add(self.tombstones_collection, {'event_id': id_, 'ticket_id': ticket_id,
+                        'version': version, 'deleted_at': datetime.datetime.utcnow()})
+        finally:
+            self.release_tickets_version(id_, version)
+        self.send_ws_message('event/%s/tickets/updates' % id_, json.dumps(ret))
+        self.send_event_stats(id_, rdoc)
+        env = dict(ticket)
+        env.update({'PERSON_ID': ticket_id, 'TICKED_ID': ticket_id, 'EVENT_ID': id_,
+            'EVENT_TITLE': rdoc.get('title', ''), 'WEB_USER': self.current_user_info.get('username', ''),
+            'WEB_REMOTE_IP': self.request.remote_ip})
+        stdin_data = {'old': ticket,
+            'event': rdoc,
+            'merged': merged
+        }
+        self.run_triggers('delete_ticket_in_event', stdin_data=stdin_data, env=env)
         return ret
 
 
@@ -891,6 +1678,9 @@ class UsersHandler(CollectionHandler):
     document = 'user'
     collection = 'users'
 
+    sort_fields = {None: ('_id', 'username', 'email', 'created_at', 'updated_at')}
+    filter_fields = {None: ('_id', 'username', 'email', 'created_at', 'updated_at')}
+
     def filter_get(self, data):
         if 'password' in data:
             del data['password']
@@ -923,7 +1713,7 @@ class UsersHandler(CollectionHandler):
         if id_ is not None:
             if (self.has_permission('user|read') or self.current_user == id_):
                 acl = False
-        super(UsersHandler, self).get(id_, resource, resource_id, acl=acl, **kwargs)
+        yield super(UsersHandler, self).get(id_, resource, resource_id, acl=acl, **kwargs)
 
     def filter_input_post_all(self, data):
         username = (data.get('username') or '').strip()
@@ -974,11 +1764,15 @@ class UsersHandler(CollectionHandler):
             return self.build_error(status=404, message='unable to access the resource')
         if not (self.has_permission('user|update') or self.current_user == id_):
             return self.build_error(status=401, message='insufficient permissions: user|update or current user')
-        super(UsersHandler, self).put(id_, resource, resource_id, **kwargs)
+        yield super(UsersHandler, self).put(id_, resource, resource_id, **kwargs)
 
 
+@tornado.web.stream_request_body
 class EbCSVImportPersonsHandler(BaseHandler):
-    """Importer for CSV files exported from Eventbrite."""
+    """Importer for CSV files exported from Eventbrite.
+
+    The upload is parsed while it's received (the files are kept on disk) and the tickets
+    are added by a background job, whose progress can be read at /ebcsvpersons/:job_id."""
     csvRemap = {
         'Nome evento': 'event_title',
         'ID evento': 'event_id',
@@ -1011,37 +1805,149 @@ class EbCSVImportPersonsHandler(BaseHandler):
         'Company': 'company'
     }
 
+    # collection of the import jobs, shared by all the server processes.
+    jobs_collection = 'import_jobs'
+
+    def prepare(self):
+        self.parser = None
+        if self.request.method != 'POST':
+            return
+        if self.authentication and not self.current_user:
+            self.build_error(status=401, message='authentication required')
+            self.finish()
+            return
+        self.request.connection.set_max_body_size(MAX_IMPORT_SIZE)
+        content_type = self.request.headers.get('Content-Type', '')
+        boundary = re.search(r'boundary=([^;]+)', content_type)
+        if not content_type.startswith('multipart/form-data') or not boundary:
+            self.build_error('invalid upload')
+            self.finish()
+            return
+        self.parser = utils.MultipartStreamParser(boundary.group(1).strip())
+
+    def data_received(self, chunk):
+        if self.parser is None or self._finished:
+            return
+        try:
+            self.parser.feed(chunk)
+        except ValueError as e:
+            self.parser.close()
+            self.parser = None
+            self.build_error('invalid upload: %s' % e)
+            self.finish()
+
+    def on_connection_close(self):
+        if self.parser is not None:
+            self.parser.close()
+
+    @gen.coroutine
+    @authenticated
+    def get(self, job_id=None, **kwargs):
+        if job_id is None:
+            return self.build_error('missing job ID')
+        job = self.db.query(self.jobs_collection, {'_id': job_id})
+        if not job:
+            return self.build_error(status=404, message='import job not found')
+        permission = 'event:tickets-all|update'
+        if job[0].get('created_by') != self.current_user and not self.has_permission(permission):
+            return self.build_error(status=401, message='insufficient permissions: %s' % permission)
+        self.write(job[0])
+
     @gen.coroutine
     @authenticated
     def post(self, **kwargs):
-        # import a CSV list of persons
-        event_handler = EventsHandler(self.application, self.request)
-        event_handler.db = self.db
-        event_handler.logger = self.logger
-        event_id = None
-        try:
-            event_id = self.get_body_argument('targetEvent')
-        except:
-            pass
-        if event_id is None:
+        # import a CSV list of persons, in background.
+        parser = self.parser
+        if parser is None or not parser.done:
+            if parser is not None:
+                parser.close()
+            return self.build_error('invalid upload')
+        event_id = parser.fields.get('targetEvent') or self.get_argument('targetEvent', None)
+        if not event_id or not self.db.query('events', {'_id': event_id}, fields=['_id']):
+            parser.close()
             return self.build_error('invalid event')
-        reply = dict(total=0, valid=0, merged=0, new_in_event=0)
-        event_details = event_handler.db.query('events', {'_id': event_id})
-        if not event_details:
-            return self.build_error('invalid event')
-        all_emails = set()
-        #[x.get('email') for x in (event_details[0].get('tickets') or []) if x.get('email')])
-        for ticket in (event_details[0].get('tickets') or []):
-            all_emails.add('%s_%s_%s' % (ticket.get('name'), ticket.get('surname'), ticket.get('email')))
-        for fieldname, contents in self.request.files.items():
-            for content in contents:
-                filename = content['filename']
-                parseStats, persons = utils.csvParse(content['body'], remap=self.csvRemap)
-                reply['total'] += parseStats['total']
+        event_handler = EventsHandler(self.application, self.request, db=self.db, logger=self.logger,
+                data_dir=self.data_dir, listen_port=self.listen_port, authentication=self.authentication,
+                triggers=self.triggers, broker=self.broker)
+        now = datetime.datetime.utcnow()
+        job = dict(event_id=event_id, status='running', total=0, valid=0, new_in_event=0, errors=0,
+                   files=[part['filename'] for part in parser.files], created_by=self.current_user,
+                   created_at=now, updated_at=now)
+        job['_id'] = self.db.add(self.jobs_collection, job)['_id']
+        tornado.ioloop.IOLoop.current().spawn_callback(self.run_import, job, event_handler, parser)
+        self.set_status(202)
+        self.write(job)
+
+    def update_job(self, job):
+        """Store the progress of an import job, and send it to the subscribers of the imports channel of the event.
+
+        :param job: the job
+        :type job: dict
+        """
+        job['updated_at'] = datetime.datetime.utcnow()
+        data = dict([(k, v) for k, v in job.items() if k != '_id'])
+        self.db.update(self.jobs_collection, {'_id': job['_id']}, data, create=False)
+        # a copy: the job is still updated by the thread of the import.
+        self.publish_job(dict(job))
+
+    @on_ioloop
+    def publish_job(self, job):
+        """Send the progress of an import job to the subscribers of the imports channel of the event.
+
+        :param job: the job
+        :type job: dict
+        """
+        if getattr(self, 'broker', None) is None:
+            return
+        try:
+            self.broker.publish('event/%s/imports' % job['event_id'], json.dumps({'action': 'import', 'job': job}))
+        except Exception as e:
+            self.logger.error('Error publishing the progress of import job %s: %s', job['_id'], e)
+
+    @gen.coroutine
+    def run_import(self, job, event_handler, parser):
+        """Import the uploaded files in a separate thread, to let the server answer other requests.
+
+        :param job: the job
+        :type job: dict
+        :param event_handler: the handler used to add the tickets
+        :type event_handler: :class:`EventsHandler`
+        :param parser: the parser of the upload, with the files
+        :type parser: :class:`~utils.MultipartStreamParser`
+        """
+        ioloop = tornado.ioloop.IOLoop.current()
+        # the WebSocket messages and the triggers are sent from the IOLoop (see on_ioloop).
+        self._ioloop = event_handler._ioloop = (ioloop, threading.get_ident())
+        yield ioloop.run_in_executor(None, self.import_files, job, event_handler, parser)
+
+    def import_files(self, job, event_handler, parser):
+        """Import the uploaded files, updating the progress of the job every IMPORT_PROGRESS_LINES lines.
+
+        :param job: the job
+        :type job: dict
+        :param event_handler: the handler used to add the tickets
+        :type event_handler: :class:`EventsHandler`
+        :param parser: the parser of the upload, with the files
+        :type parser: :class:`~utils.MultipartStreamParser`
+        """
+        event_id = job['event_id']
+        try:
+            all_emails = set()
+            for ticket in self.db.queryList('events', event_id, 'tickets', fields=['name', 'surname', 'email']):
+                all_emails.add('%s_%s_%s' % (ticket.get('name'), ticket.get('surname'), ticket.get('email')))
+            count = 0
+            for part in parser.files:
+                filename = part['filename']
+                total = job['total']
+                parseStats, persons = utils.csvParse(part['fd'], remap=self.csvRemap)
                 for person in persons:
+                    count += 1
+                    if count % IMPORT_PROGRESS_LINES == 0:
+                        job['total'] = total + parseStats['total']
+                        self.update_job(job)
                     if not person:
                         continue
-                    reply['valid'] += 1
+                    job['valid'] += 1
                     person['attended'] = False
                     person['from_file'] = filename
                     self.add_access_info(person)
@@ -1049,9 +1955,90 @@ class EbCSVImportPersonsHandler(BaseHandler):
                     if duplicate_check in all_emails:
                         continue
                     all_emails.add(duplicate_check)
-                    event_handler.handle_post_tickets(event_id, None, person)
-                    reply['new_in_event'] += 1
-        self.write(reply)
+                    try:
+                        event_handler.handle_post_tickets(event_id, None, person)
+                    except InputException as e:
+                        job['errors'] += 1
+                        job['error'] = e.message
+                        continue
+                    job['new_in_event'] += 1
+                job['total'] = total + parseStats['total']
+            job['status'] = 'done'
+        except Exception as e:
+            self.logger.error('Error running import job %s: %s', job['_id'], e)
+            job['status'] = 'error'
+            job['error'] = str(e)
+        finally:
+            parser.close()
+        self.update_job(job)
+
+
+class TicketsExportHandler(EventsHandler):
+    """Export the tickets of an event, as CSV or NDJSON (one JSON object per line).
+
+    Tickets are read from the database in batches and sent in chunks, so that the memory used
+    doesn't depend on the number of tickets."""
+    # column names understood by the importer; when a field has more names, the last one (in English) is used.
+    export_headers = dict([(v, k) for k, v in EbCSVImportPersonsHandler.csvRemap.items()])
+
+    @staticmethod
+    def _csv_value(value):
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return str(value)
+
+    @gen.coroutine
+    @authenticated
+    def get(self, id_, **kwargs):
+        if not self.has_permission('event:tickets-all|read'):
+            return self.build_error(status=401, message='insufficient permissions: event:tickets-all|read')
+        arguments = self.arguments
+        format_ = arguments.pop('_format', None) or 'csv'
+        if format_ not in ('csv', 'ndjson'):
+            return self.build_error(message='invalid value for _format: %s' % format_)
+        remap = self.tobool(arguments.pop('_remap', None) or False) is True
+        filters, options = self.split_arguments(arguments, resource='tickets')
+        options.pop('cursor', None)
+        columns = options.pop('fields', None)
+        if format_ == 'csv' and not columns:
+            columns = list(EXPORT_COLUMNS)
+        if not self.db.query(self.collection, {'_id': id_}, fields=['_id']):
+            return self.build_error(status=404, message='event not found')
+        tickets = self.db.iterList(self.collection, id_, 'tickets', self.build_filters(filters, resource='tickets'),
+                                   fields=columns, **options)
+        buf = io.StringIO()
+        if format_ == 'csv':
+            self.set_header('Content-Type', 'text/csv; charset=UTF-8')
+            writer = csv.writer(buf)
+            if remap:
+                writer.writerow([self.export_headers.get(c, c) for c in columns])
+            else:
+                writer.writerow(columns)
+        else:
+            self.set_header('Content-Type', 'application/x-ndjson; charset=UTF-8')
+        self.set_header('Content-Disposition', 'attachment; filename="tickets-%s.%s"' % (id_, format_))
+        count = 0
+        for ticket in tickets:
+            if format_ == 'csv':
+                writer.writerow([self._csv_value(ticket.get(c)) for c in columns])
+            else:
+                buf.write(json.dumps(ticket))
+                buf.write('\n')
+            count += 1
+            if buf.tell() >= EXPORT_CHUNK_SIZE:
+                self.write(buf.getvalue())
+                buf = io.StringIO()
+                if format_ == 'csv':
+                    writer = csv.writer(buf)
+                # wait for the client to receive the data, and let the IOLoop serve other requests.
+                yield self.flush()
+        self.write(buf.getvalue())
+        metrics.incr('exported_tickets', count)
+        self.finish()
 
 
 class SettingsHandler(BaseHandler):
@@ -1076,45 +2063,143 @@ class InfoHandler(BaseHandler):
         self.write({'info': info})
 
 
+class TriggersHandler(BaseHandler):
+    """Handle requests for information about the queue of triggers."""
+    @gen.coroutine
+    @authenticated
+    def get(self, **kwargs):
+        if not self.has_permission('triggers|read'):
+            return self.build_error(status=401, message='insufficient permissions: triggers|read')
+        self.write({'triggers': self.triggers.depth()})
+
+
+class MetricsHandler(BaseHandler):
+    """Handle requests for the metrics of this server process."""
+    @gen.coroutine
+    @authenticated
+    def get(self, **kwargs):
+        if not self.has_permission('metrics|read'):
+            return self.build_error(status=401, message='insufficient permissions: metrics|read')
+        output = {'metrics': metrics.to_dict()}
+        if getattr(self, 'admission', None) is not None:
+            output['admission'] = self.admission.to_dict()
+        self.write(output)
+
+
 class WebSocketEventUpdatesHandler(tornado.websocket.WebSocketHandler):
     """Manage WebSockets."""
-    def _clean_url(self, url):
-        url = re_slashes.sub('/', url)
-        ridx = url.rfind('?')
-        if ridx != -1:
-            url = url[:ridx]
-        return url
+    # if True, the connection is only used to relay messages (see the ws_loopback option).
+    relay_only = False
+
+    def initialize(self, **kwargs):
+        """Add every passed (key, value) as attributes of the instance."""
+        for key, value in kwargs.items():
+            setattr(self, key, value)
 
     def open(self, event_id, *args, **kwargs):
         try:
             self.uuid = self.get_argument('uuid')
         except:
             self.uuid = None
-        url = self._clean_url(self.request.uri)
-        logging.debug('WebSocketEventUpdatesHandler.on_open event_id:%s url:%s' % (event_id, url))
-        _ws_clients.setdefault(url, {})
-        if self.uuid and self.uuid not in _ws_clients[url]:
-            _ws_clients[url][self.uuid] = self
-        logging.debug('WebSocketEventUpdatesHandler.on_open %s clients connected' % len(_ws_clients[url]))
+        self.channel = 'event/%s/tickets/updates' % event_id
+        logging.debug('WebSocketEventUpdatesHandler.on_open event_id:%s channel:%s' % (event_id, self.channel))
+        if self.uuid and not self.relay_only:
+            self.broker.subscribe(self.channel, self, uuid=self.uuid)
+            self.send_missed_messages()
+
+    def send_missed_messages(self):
+        """Send to a reconnecting client the messages it missed, or ask it to reload everything."""
+        try:
+            since = int(self.get_argument('since'))
+        except (tornado.web.MissingArgumentError, ValueError):
+            since = None
+        epoch = self.get_argument('epoch', None)
+        self.broker.send_to(self, self.channel, self.broker.missed_messages(self.channel, since, epoch))
 
     def on_message(self, message):
-        url = self._clean_url(self.request.uri)
-        logging.debug('WebSocketEventUpdatesHandler.on_message url:%s' % url)
-        count = 0
-        _to_delete = set()
-        for uuid, client in _ws_clients.get(url, {}).items():
-            try:
-                client.write_message(message)
-            except:
-                _to_delete.add(uuid)
-                continue
-            count += 1
-        for uuid in _to_delete:
+        logging.debug('WebSocketEventUpdatesHandler.on_message channel:%s' % self.channel)
+        self.broker.publish(self.channel, message)
+
+    def on_close(self):
+        self.broker.unsubscribe_all(self)
+
+
+class WebSocketUpdatesHandler(BaseHandler, tornado.websocket.WebSocketHandler):
+    """Multiplexed WebSocket: a single connection can subscribe to many channels.
+
+    The client sends JSON messages like:
+        {"action": "subscribe", "channel": "event/<event_id>/tickets/updates", "since": 42, "epoch": "..."}
+        {"action": "unsubscribe", "channel": "event/<event_id>/stats"}
+    and receives messages like:
+        {"channel": "event/<event_id>/tickets/updates", "messages": [...]}
+    """
+    _re_channel = re.compile(r'^event/(?P<event_id>[\w\d_-]+)/(?P<kind>tickets/updates|stats|imports)$')
+
+    # permission required to subscribe to each kind of channel.
+    channel_permissions = {
+        'tickets/updates': 'event:tickets-all|read',
+        'stats': 'event:stats-all|read',
+        # the import jobs carry the names of the files and of the users who uploaded them.
+        'imports': 'event:tickets-all|update'
+    }
+
+    # maximum number of channels a single connection can subscribe to.
+    max_subscriptions = MAX_WS_SUBSCRIPTIONS
+
+    def open(self, *args, **kwargs):
+        if self.authentication and not self.current_user:
+            self.close(code=4001, reason='authentication required')
+            return
+        # permissions are checked only once, when the connection is opened.
+        self.allowed = dict([(kind, self.has_permission(permission))
+                             for kind, permission in self.channel_permissions.items()])
+        self.subscriptions = set()
+        logging.debug('WebSocketUpdatesHandler.open user:%s' % self.current_user)
+
+    def frame_message(self, channel, message):
+        """Wrap a message in an envelope carrying the name of its channel."""
+        if not message.startswith('['):
+            message = '[%s]' % message
+        return '{"channel": %s, "messages": %s}' % (json.dumps(channel), message)
+
+    def send_channel_error(self, channel, message):
+        self.broker.send_to(self, channel, json.dumps([{'error': True, 'message': message}]))
+
+    def on_message(self, message):
+        try:
+            data = json.loads(message)
+            action = data.get('action')
+            channel = data.get('channel') or ''
+        except (ValueError, AttributeError):
+            self.send_channel_error(None, 'invalid message')
+            return
+        match = self._re_channel.match(channel)
+        if not match:
+            self.send_channel_error(channel, 'unknown channel')
+            return
+        if action == 'subscribe':
+            permission = self.channel_permissions[match.group('kind')]
+            if not self.allowed.get(match.group('kind')):
+                self.send_channel_error(channel, 'insufficient permissions: %s' % permission)
+                return
+            if channel not in self.subscriptions and len(self.subscriptions) >= self.max_subscriptions:
+                self.send_channel_error(channel, 'too many subscriptions')
+                return
             try:
-                del _ws_clients[url][uuid]
-            except KeyError:
-                pass
-        logging.debug('WebSocketEventUpdatesHandler.on_message sent message to %d clients' % count)
+                since = int(data['since'])
+            except (KeyError, TypeError, ValueError):
+                since = None
+            self.subscriptions.add(channel)
+            self.broker.subscribe(channel, self)
+            self.broker.send_to(self, channel, self.broker.missed_messages(channel, since, data.get('epoch')))
+        elif action == 'unsubscribe':
+            self.subscriptions.discard(channel)
+            self.broker.unsubscribe(channel, self)
+        else:
+            self.send_channel_error(channel, 'unknown action')
+
+    def on_close(self):
+        self.broker.unsubscribe_all(self)
 
 
 class LoginHandler(RootHandler):
@@ -1181,6 +2266,47 @@ def run():
             help="URL to MongoDB server", type=str)
     define("db_name", default='eventman',
             help="Name of the MongoDB database to use", type=str)
+    define("trigger_batch_window", default=triggers.BATCH_WINDOW, type=float,
+            help="seconds to wait, coalescing actions for triggers in batch mode")
+    define("trigger_batch_size", default=triggers.BATCH_SIZE, type=int,
+            help="maximum number of actions sent to a trigger in batch mode")
+    define("trigger_concurrency", default=triggers.CONCURRENCY, type=int,
+            help="maximum number of trigger scripts running at the same time")
+    define("trigger_max_attempts", default=triggers.MAX_ATTEMPTS, type=int,
+            help="how many times a failing trigger script is run, before giving up")
+    define("trigger_high_water", default=triggers.HIGH_WATER, type=int,
+            help="number of queued triggers over which low-priority actions are shed or delayed")
+    define("trigger_overflow_policy", default=triggers.OVERFLOW_POLICY, type=str,
+            help="what to do with low-priority actions over the high-water mark: delay or shed")
+    define("trigger_high_priority", default=list(triggers.HIGH_PRIORITY_ACTIONS), type=str, multiple=True,
+            help="comma-separated list of actions that are never shed or delayed")
+    define("trigger_slow_threshold", default=triggers.SLOW_THRESHOLD, type=float,
+            help="log trigger scripts running for more than this number of seconds")
+    define("ws_broker", default='local', type=str,
+            help="how WebSocket messages are shared: local (only the clients of the same process) or mongo (every process using the same database)")
+    define("ws_batch_window", default=broker.BATCH_WINDOW, type=float,
+            help="seconds to wait, coalescing the WebSocket messages sent on a channel (0 to disable)")
+    define("ws_replay_buffer", default=broker.REPLAY_BUFFER, type=int,
+            help="number of recent WebSocket messages kept for each channel, to be sent to reconnecting clients")
+    define("ws_queue_size", default=broker.QUEUE_SIZE, type=int,
+            help="maximum number of messages waiting to be sent to a WebSocket client")
+    define("ws_queue_policy", default=broker.QUEUE_POLICY, type=str,
+            help="what to do when the queue of a WebSocket client is full: drop_oldest, collapse (ask the client to reload everything) or disconnect")
+    define("ws_ping_interval", default=20, type=int,
+            help="seconds between two pings sent to WebSocket clients (0 to disable)")
+    define("ws_ping_timeout", default=60, type=int,
+            help="close WebSocket connections that haven't answered a ping in this number of seconds")
+    define("ws_loopback", default=False,
+            help="send WebSocket messages connecting to a local server on port+1, like older versions did")
+    define("workers", default=1, type=int,
+            help="number of worker processes sharing the listening socket (0: one for each CPU core)")
+    define("workers_max_restarts", default=WORKERS_MAX_RESTARTS, type=int,
+            help="how many times dead worker processes are restarted, before giving up")
+    _admission_limits = ['%s=%d:%d:%d' % ((endpoint,) + limit) for endpoint, limit in admission.LIMITS.items()]
+    define("admission", default=_admission_limits, type=str, multiple=True,
+            help="limit the requests to an endpoint served at the same time, as endpoint=concurrency:queue_size:timeout; endpoints are named like the permission they require (default: %s)" % ','.join(_admission_limits))
+    define("admission_max_delay", default=admission.MAX_DELAY, type=float,
+            help="reject the requests to a limited endpoint received more than this number of seconds ago; 0 to disable (default: %s)" % admission.MAX_DELAY)
     define("authentication", default=False, help="if set to true, authentication is required")
     define("debug", default=False, help="run in debug mode")
     define("config", help="read configuration file",
@@ -1198,8 +2324,11 @@ def run():
 
     # database backend connector
     db_connector = monco.Monco(url=options.mongo_url, dbName=options.db_name)
-    init_params = dict(db=db_connector, data_dir=options.data_dir, listen_port=options.port,
-            authentication=options.authentication, logger=logger, ssl_options=ssl_options)
+    server_version = db_connector.serverVersion()
+    if server_version < MIN_MONGODB_VERSION:
+        logger.error('MongoDB %s or later is required (the server is running version %s)',
+                     '.'.join(map(str, MIN_MONGODB_VERSION)), '.'.join(map(str, server_version)))
+        sys.exit(1)
 
     # If not present, we store a user 'admin' with password 'eventman' into the database.
     if not db_connector.query('users', {'username': 'admin'}):
@@ -1217,19 +2346,83 @@ def run():
         db_connector.add('settings',
                 {'setting': 'server_cookie_secret', 'cookie_secret': cookie_secret})
 
-    _ws_handler = (r"/ws/+event/+(?P<event_id>[\w\d_-]+)/+tickets/+updates/?", WebSocketEventUpdatesHandler)
+    # Used to fetch the tickets deleted since a version.
+    db_connector.ensureIndex(EventsHandler.tombstones_collection, [('event_id', 1), ('version', 1)])
+    # Counters are created by upserts: without a unique index, workers creating the same counter
+    # at the same time would store it twice (giving away the same seq, used in the QR codes).
+    try:
+        db_connector.ensureIndex(EventsHandler.counters_collection, [('seq_name', 1)], unique=True)
+        broker.MongoBroker.ensure_indexes(db_connector)
+    except Exception as e:
+        logger.error('unable to create the unique index on seq_name of the counters (duplicated counters '
+                     'must be removed by hand): %s', e)
+
+    # The sockets are bound before forking, so that every worker shares them.
+    sockets = tornado.netutil.bind_sockets(options.port, options.address)
+    ws_sockets = []
+    if options.ws_loopback:
+        # Also listen on options.port+1 for our local ws connection.
+        ws_sockets = tornado.netutil.bind_sockets(options.port+1, '127.0.0.1')
+    if options.workers != 1:
+        if options.ws_broker != 'mongo':
+            logger.warning('more than one worker: using --ws_broker=mongo to share WebSocket messages')
+            options.ws_broker = 'mongo'
+        # MongoClient instances must not be shared with forked processes.
+        db_connector.disconnect()
+        # Returns only in the children; dead children are restarted by the parent.
+        task_id = process.fork_processes(options.workers or None, max_restarts=options.workers_max_restarts)
+        logger.info('worker %d started (pid %d)', task_id, os.getpid())
+        db_connector.connect()
+
+    # scripts run in response to actions
+    triggers_runner = triggers.Triggers(data_dir=options.data_dir, db=db_connector,
+            batch_window=options.trigger_batch_window, batch_size=options.trigger_batch_size,
+            concurrency=options.trigger_concurrency, max_attempts=options.trigger_max_attempts,
+            high_water=options.trigger_high_water, overflow_policy=options.trigger_overflow_policy,
+            high_priority=options.trigger_high_priority, slow_threshold=options.trigger_slow_threshold,
+            metrics=metrics)
+    metrics.gauge('triggers_queue', triggers_runner.depth)
+    # publish/subscribe of WebSocket messages
+    broker_params = dict(batch_window=options.ws_batch_window, replay_buffer=options.ws_replay_buffer,
+            queue_size=options.ws_queue_size, queue_policy=options.ws_queue_policy, metrics=metrics)
+    if options.ws_broker == 'mongo':
+        ws_broker = broker.MongoBroker(db_connector, **broker_params)
+    else:
+        ws_broker = broker.LocalBroker(**broker_params)
+    # in-memory indexes used to search the tickets
+    search_indexes = search.SearchIndexes(db_connector, ws_broker, metrics=metrics)
+    # limits of the requests served at the same time
+    admission_control = admission.AdmissionControl(admission.parse_limits(options.admission),
+            max_delay=options.admission_max_delay, metrics=metrics)
+    init_params = dict(db=db_connector, data_dir=options.data_dir, listen_port=options.port,
+            authentication=options.authentication, logger=logger, ssl_options=ssl_options,
+            triggers=triggers_runner, broker=ws_broker, search_indexes=search_indexes, ws_loopback=options.ws_loopback,
+            admission=admission_control)
+
+    _ws_handler = (r"/ws/+event/+(?P<event_id>[\w\d_-]+)/+tickets/+updates/?", WebSocketEventUpdatesHandler,
+                   dict(broker=ws_broker))
+    _ws_updates_path = r"/ws/+updates/?"
     _events_path = r"/events/?(?P<id_>[\w\d_-]+)?/?(?P<resource>[\w\d_-]+)?/?(?P<resource_id>[\w\d_-]+)?"
     _users_path = r"/users/?(?P<id_>[\w\d_-]+)?/?(?P<resource>[\w\d_-]+)?/?(?P<resource_id>[\w\d_-]+)?"
+    _export_path = r"/events/+(?P<id_>[\w\d_-]+)/+tickets/+export/?"
     application = tornado.web.Application([
+            (_export_path, TicketsExportHandler, init_params),
+            (r'/v%s%s' % (API_VERSION, _export_path), TicketsExportHandler, init_params),
             (_events_path, EventsHandler, init_params),
             (r'/v%s%s' % (API_VERSION, _events_path), EventsHandler, init_params),
             (_users_path, UsersHandler, init_params),
             (r'/v%s%s' % (API_VERSION, _users_path), UsersHandler, init_params),
             (r"/(?:index.html)?", RootHandler, init_params),
-            (r"/ebcsvpersons", EbCSVImportPersonsHandler, init_params),
+            (r"/ebcsvpersons/?(?P<job_id>[\w\d_-]+)?", EbCSVImportPersonsHandler, init_params),
             (r"/settings", SettingsHandler, init_params),
             (r"/info", InfoHandler, init_params),
+            (r"/triggers", TriggersHandler, init_params),
+            (r'/v%s/triggers' % API_VERSION, TriggersHandler, init_params),
+            (r"/metrics", MetricsHandler, init_params),
+            (r'/v%s/metrics' % API_VERSION, MetricsHandler, init_params),
             _ws_handler,
+            (_ws_updates_path, WebSocketUpdatesHandler, init_params),
+            (r'/v%s%s' % (API_VERSION, _ws_updates_path), WebSocketUpdatesHandler, init_params),
             (r'/login', LoginHandler, init_params),
             (r'/v%s/login' % API_VERSION, LoginHandler, init_params),
             (r'/logout', LogoutHandler),
@@ -1240,18 +2433,27 @@ def run():
         static_path=os.path.join(os.path.dirname(__file__), "static"),
         cookie_secret=cookie_secret,
         login_url='/login',
+        websocket_ping_interval=options.ws_ping_interval or None,
+        websocket_ping_timeout=options.ws_ping_timeout,
+        # the autoreload feature can't be used with more than one worker.
+        autoreload=options.debug and options.workers == 1,
         debug=options.debug)
     http_server = tornado.httpserver.HTTPServer(application, ssl_options=ssl_options or None)
     logger.info('Start serving on %s://%s:%d', 'https' if ssl_options else 'http',
                                                  options.address if options.address else '127.0.0.1',
                                                  options.port)
-    http_server.listen(options.port, options.address)
-
-    # Also listen on options.port+1 for our local ws connection.
-    ws_application = tornado.web.Application([_ws_handler], debug=options.debug)
-    ws_http_server = tornado.httpserver.HTTPServer(ws_application)
-    ws_http_server.listen(options.port+1, address='127.0.0.1')
-    logger.debug('Starting WebSocket on ws://127.0.0.1:%d', options.port+1)
+    http_server.add_sockets(sockets)
+
+    if ws_sockets:
+        ws_application = tornado.web.Application([(_ws_handler[0], WebSocketEventUpdatesHandler,
+                                                   dict(broker=ws_broker, relay_only=True))],
+                                                 debug=options.debug)
+        ws_http_server = tornado.httpserver.HTTPServer(ws_application)
+        ws_http_server.add_sockets(ws_sockets)
+        logger.debug('Starting WebSocket on ws://127.0.0.1:%d', options.port+1)
+    triggers_runner.start()
+    ws_broker.start()
+    admission_control.start()
     tornado.ioloop.IOLoop.instance().start()
 
 
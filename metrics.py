@@ -0,0 +1,143 @@
+"""EventMan(ager) metrics
+
+Simple in-process counters and histograms, used to monitor the server.
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import time
+import threading
+
+# Upper bounds (in seconds) of the buckets of latency histograms.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(object):
+    """Count observed values in buckets, keeping track of their sum and maximum."""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        """Add a value to the histogram.
+
+        :param value: the observed value
+        :type value: int or float
+        """
+        idx = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                idx = i
+                break
+        self.counts[idx] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def to_dict(self):
+        """Return a representation of the histogram suitable to be serialized in JSON.
+
+        :returns: count, sum, maximum, average and number of values in each bucket
+        :rtype: dict
+        """
+        buckets = dict([(str(bound), count) for bound, count in zip(self.buckets, self.counts)])
+        buckets['+inf'] = self.counts[-1]
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'avg': self.sum / self.count if self.count else 0, 'buckets': buckets}
+
+
+class Metrics(object):
+    """A registry of counters, gauges and histograms, identified by a name and a set of labels.
+
+    Counters and histograms can also be updated by other threads (e.g.: the requests served by the
+    threads of the admission control)."""
+    def __init__(self):
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    @staticmethod
+    def _key(labels):
+        return ','.join('%s=%s' % (k, v) for k, v in sorted(labels.items()))
+
+    def incr(self, name, value=1, **labels):
+        """Increment a counter.
+
+        :param name: name of the counter
+        :type name: str
+        :param value: the increment
+        :type value: int or float
+        """
+        key = self._key(labels)
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """Add a value to a histogram.
+
+        :param name: name of the histogram
+        :type name: str
+        :param value: the observed value
+        :type value: int or float
+        :param buckets: upper bounds of the buckets, used if the histogram is created
+        :type buckets: tuple
+        """
+        key = self._key(labels)
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            if key not in histograms:
+                histograms[key] = Histogram(buckets)
+            histograms[key].observe(value)
+
+    def gauge(self, name, func):
+        """Register a function whose return value is read every time the metrics are collected.
+
+        :param name: name of the gauge
+        :type name: str
+        :param func: function without arguments
+        :type func: callable
+        """
+        self._gauges[name] = func
+
+    def to_dict(self):
+        """Return all the metrics, in a form suitable to be serialized in JSON.
+
+        :returns: counters, gauges and histograms
+        :rtype: dict
+        """
+        gauges = {}
+        for name, func in self._gauges.items():
+            try:
+                gauges[name] = func()
+            except Exception:
+                gauges[name] = None
+        with self._lock:
+            histograms = {}
+            for name, values in self._histograms.items():
+                histograms[name] = dict([(k, h.to_dict()) for k, h in values.items()])
+            counters = dict([(name, dict(values)) for name, values in self._counters.items()])
+        return {'pid': os.getpid(), 'uptime': time.time() - self.started_at,
+                'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+
+# Metrics of this process.
+metrics = Metrics()
@@ -17,7 +17,12 @@ limitations under the License.
 """
 
 import re
+import base64
+import datetime
 import pymongo
+import pymongo.errors
+from bson import json_util
+from bson.son import SON
 from bson.objectid import ObjectId
 
 re_objectid = re.compile(r'[0-9a-f]{24}')
@@ -59,7 +64,7 @@ def convert(seq):
     if isinstance(seq, dict):
         d = {}
         for key, item in seq.items():
-            if key in _force_conversion:
+            if key in _force_conversion and not isinstance(item, dict):
                 try:
                     d[key] = _force_conversion[key](item)
                 except:
@@ -72,6 +77,113 @@ def convert(seq):
     return convert_obj(seq)
 
 
+def sort_spec(sort):
+    """Normalize a sort specification.
+
+    :param sort: list of field names (prefixed by "-" for a descending order) or (field, direction) tuples
+    :type sort: list or None
+
+    :returns: list of (field, direction) tuples; "_id" is always the last field, to have a stable order
+    :rtype: list
+    """
+    spec = []
+    for item in sort or []:
+        if isinstance(item, (list, tuple)):
+            spec.append((item[0], item[1]))
+        elif item.startswith('-'):
+            spec.append((item[1:], pymongo.DESCENDING))
+        else:
+            spec.append((item.lstrip('+'), pymongo.ASCENDING))
+    if '_id' not in [field for field, direction in spec]:
+        spec.append(('_id', pymongo.ASCENDING))
+    return spec
+
+
+def _get_path(doc, path):
+    for key in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
+
+
+def encode_cursor(doc, sort=None):
+    """Return an opaque cursor pointing after a document, used to fetch the next page of results.
+
+    :param doc: the last document of the current page
+    :type doc: dict
+    :param sort: the sort specification used for the query
+    :type sort: list or None
+
+    :returns: the cursor
+    :rtype: str
+    """
+    values = [_get_path(doc, field) for field, direction in sort_spec(sort)]
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def cursor_query(cursor, sort=None):
+    """Return a query matching the documents that follow a cursor.
+
+    :param cursor: a cursor returned by `encode_cursor`
+    :type cursor: str
+    :param sort: the sort specification used for the query
+    :type sort: list or None
+
+    :returns: the query
+    :rtype: dict
+    """
+    spec = sort_spec(sort)
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (TypeError, ValueError):
+        raise MoncoError('invalid cursor')
+    if not isinstance(values, list) or len(values) != len(spec):
+        raise MoncoError('invalid cursor')
+    # a document comes after the cursor if the first N-1 fields are equal and the Nth follows it.
+    # Null and missing values are sorted before everything else, but $gt and $lt never match
+    # them (nor match anything, comparing with null): they are handled explicitly.
+    conditions = []
+    for idx, (field, direction) in enumerate(spec):
+        condition = dict([(f, v) for (f, d), v in zip(spec[:idx], values[:idx])])
+        value = values[idx]
+        if direction == pymongo.ASCENDING:
+            if value is None:
+                condition[field] = {'$ne': None}
+            else:
+                condition[field] = {'$gt': value}
+        else:
+            if value is None:
+                # nothing follows a null value, in descending order.
+                continue
+            condition['$or'] = [{field: {'$lt': value}}, {field: None}]
+        conditions.append(condition)
+    return {'$or': conditions}
+
+
+def projection(fields, sort=None):
+    """Return a projection including only some fields (and the ones used to sort the results).
+
+    :param fields: names of the fields to include, or a projection (that can also use operators
+                   like $elemMatch, to return only some items of a list)
+    :type fields: list or dict or None
+    :param sort: the sort specification used for the query
+    :type sort: list or None
+
+    :returns: the projection, or None to include every field
+    :rtype: dict
+    """
+    if not fields:
+        return None
+    if isinstance(fields, dict):
+        proj = convert(fields)
+    else:
+        proj = dict([(field, True) for field in fields if field and not field.startswith('$')])
+    for field, direction in sort_spec(sort):
+        proj[field] = True
+    return proj
+
+
 class MoncoError(Exception):
     """Base class for Monco exceptions."""
     pass
@@ -131,40 +243,89 @@ class Monco(object):
         self.db = self.connection[self._dbName]
         return self.db
 
-    def getOne(self, collection, query=None):
+    def disconnect(self):
+        """Close the connection to the database; the next operation will open a new one.
+
+        Useful before forking a process: connections must not be shared with the children.
+        """
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+        self.db = None
+
+    def serverVersion(self):
+        """Return the version of the MongoDB server.
+
+        :returns: the version, as a tuple of integers (e.g.: (4, 2, 1))
+        :rtype: tuple
+        """
+        db = self.connect()
+        version = db.client.server_info().get('version') or ''
+        return tuple([int(x) for x in re.findall(r'\d+', version)[:3]])
+
+    def ensureIndex(self, collection, keys, **kwargs):
+        """Create an index, if it doesn't exist.
+
+        :param collection: create the index on this collection
+        :type collection: str
+        :param keys: list of (field, direction) tuples
+        :type keys: list
+
+        :returns: the name of the index
+        :rtype: str
+        """
+        db = self.connect()
+        return db[collection].create_index(keys, **kwargs)
+
+    def getOne(self, collection, query=None, fields=None):
         """Get a single document with the specified `query`.
 
         :param collection: search the document in this collection
         :type collection: str
         :param query: query to filter the documents
         :type query: dict or None
+        :param fields: return only these fields (see `projection`)
+        :type fields: list or dict or None
 
         :returns: the first document matching the query
         :rtype: dict
         """
-        results = self.query(collection, convert(query))
+        results = self.query(collection, convert(query), fields=fields, limit=1)
         return results and results[0] or {}
 
-    def get(self, collection, _id):
+    def get(self, collection, _id, fields=None):
         """Get a single document with the specified `_id`.
 
         :param collection: search the document in this collection
         :type collection: str
         :param _id: unique ID of the document
         :type _id: str or :class:`~bson.objectid.ObjectId`
+        :param fields: return only these fields (see `projection`)
+        :type fields: list or dict or None
 
         :returns: the document with the given `_id`
         :rtype: dict
         """
-        return self.getOne(collection, {'_id': _id})
+        return self.getOne(collection, {'_id': _id}, fields=fields)
 
-    def query(self, collection, query=None, condition='or'):
+    def query(self, collection, query=None, condition='or', fields=None, sort=None, skip=None, limit=None,
+              cursor=None):
         """Get multiple documents matching a query.
 
         :param collection: search for documents in this collection
         :type collection: str
         :param query: search for documents with those attributes
         :type query: dict, list or None
+        :param fields: return only these fields
+        :type fields: list or None
+        :param sort: sort the documents (see `sort_spec`)
+        :type sort: list or None
+        :param skip: skip this number of documents
+        :type skip: int or None
+        :param limit: return at most this number of documents
+        :type limit: int or None
+        :param cursor: return the documents following this cursor (see `encode_cursor`)
+        :type cursor: str or None
 
         :returns: list of matching documents
         :rtype: list
@@ -173,7 +334,123 @@ class Monco(object):
         query = convert(query or {})
         if isinstance(query, (list, tuple)):
             query = {'$%s' % condition: query}
-        return list(db[collection].find(query))
+        if cursor:
+            query = {'$and': [query, cursor_query(cursor, sort)]}
+        results = db[collection].find(query, projection(fields, sort))
+        # pages must always be sorted like the cursors that point to the next ones.
+        if sort or cursor or skip or limit:
+            results = results.sort(sort_spec(sort))
+        if skip:
+            results = results.skip(skip)
+        if limit:
+            results = results.limit(limit)
+        return list(results)
+
+    def _listPipeline(self, _id, listName, query=None, fields=None, sort=None, skip=None, limit=None,
+                      cursor=None):
+        """Return the aggregation pipeline used to get the items of a list (see `queryList`)."""
+        query = convert(query or {})
+        match = {'_id': convert_obj(_id)}
+        if query:
+            # skip the document if no item matches, possibly using an index on the fields of the items.
+            match[listName] = {'$elemMatch': query}
+        pipeline = [
+            {'$match': match},
+            {'$unwind': '$%s' % listName},
+            {'$replaceRoot': {'newRoot': '$%s' % listName}}
+        ]
+        if query:
+            pipeline.append({'$match': query})
+        if cursor:
+            pipeline.append({'$match': cursor_query(cursor, sort)})
+        # pages must always be sorted like the cursors that point to the next ones.
+        if sort or cursor or skip or limit:
+            pipeline.append({'$sort': SON(sort_spec(sort))})
+        if skip:
+            pipeline.append({'$skip': skip})
+        if limit:
+            pipeline.append({'$limit': limit})
+        proj = projection(fields, sort)
+        if proj:
+            pipeline.append({'$project': proj})
+        return pipeline
+
+    def queryList(self, collection, _id, listName, query=None, fields=None, sort=None, skip=None, limit=None,
+                  cursor=None):
+        """Get the items of a list stored in a document, matching a query.
+        Filtering, sorting and paging are executed by the database.
+
+        :param collection: search the document in this collection
+        :type collection: str
+        :param _id: unique ID of the document
+        :type _id: str or :class:`~bson.objectid.ObjectId`
+        :param listName: name of the list
+        :type listName: str
+        :param query: search for items with those attributes
+        :type query: dict or None
+        :param fields: return only these fields of the items
+        :type fields: list or None
+        :param sort: sort the items (see `sort_spec`); if not set, items are returned in their order
+                     (or sorted by _id, using skip, limit or cursor)
+        :type sort: list or None
+        :param skip: skip this number of items
+        :type skip: int or None
+        :param limit: return at most this number of items
+        :type limit: int or None
+        :param cursor: return the items following this cursor (see `encode_cursor`)
+        :type cursor: str or None
+
+        :returns: list of matching items
+        :rtype: list
+        """
+        db = self.connect()
+        pipeline = self._listPipeline(_id, listName, query=query, fields=fields, sort=sort, skip=skip,
+                                      limit=limit, cursor=cursor)
+        return list(db[collection].aggregate(pipeline, allowDiskUse=True))
+
+    def iterList(self, collection, _id, listName, query=None, fields=None, sort=None, skip=None, limit=None,
+                 batchSize=1000):
+        """Iterate over the items of a list stored in a document, matching a query.
+        Like `queryList`, but the items are fetched from the database in batches, while they are consumed.
+
+        :param batchSize: number of items fetched from the database at once
+        :type batchSize: int
+
+        :returns: the matching items
+        :rtype: iterator
+        """
+        db = self.connect()
+        pipeline = self._listPipeline(_id, listName, query=query, fields=fields, sort=sort, skip=skip,
+                                      limit=limit)
+        return db[collection].aggregate(pipeline, allowDiskUse=True, batchSize=batchSize)
+
+    def getWithListItems(self, collection, _id, listName, query=None, limit=None):
+        """Get a document, without a list it contains, and the items of the list matching a query,
+        with a single request to the database.
+
+        :param collection: search the document in this collection
+        :type collection: str
+        :param _id: unique ID of the document
+        :type _id: str or :class:`~bson.objectid.ObjectId`
+        :param listName: name of the list
+        :type listName: str
+        :param query: search for items with those attributes
+        :type query: dict or None
+        :param limit: return at most this number of items
+        :type limit: int or None
+
+        :returns: the document (None if it doesn't exist) and the list of matching items
+        :rtype: tuple of (dict, list)
+        """
+        db = self.connect()
+        items = self._listPipeline(_id, listName, query=query, limit=limit)[1:]
+        pipeline = [
+            {'$match': {'_id': convert_obj(_id)}},
+            {'$facet': {'document': [{'$project': {listName: False}}], 'items': items}}
+        ]
+        for res in db[collection].aggregate(pipeline):
+            return (res['document'] or [None])[0], res['items']
+        return None, []
 
     def add(self, collection, data, _id=None):
         """Insert a new document.
@@ -222,7 +499,7 @@ class Monco(object):
         return _or
 
     def update(self, collection, _id_or_query, data, operation='update',
-            updateList=None, create=True):
+            updateList=None, create=True, increment=None, listFilter=None, fields=None):
         """Update an existing document or create it, if requested.
         _id_or_query can be an ID, a dict representing a query or a list of tuples.
         In the latter case, the tuples are put in OR; a tuple match if all of its
@@ -240,6 +517,14 @@ class Monco(object):
         :type updateList: str
         :param create: if True, the document is created if no document matches
         :type create: bool
+        :param increment: other fields of the document to increment, in the same update
+        :type increment: dict
+        :param listFilter: with updateList, update the items of the list matching this query
+                           (using array filters) instead of the first item matched by _id_or_query
+        :type listFilter: dict
+        :param fields: return only these fields of the document (see `projection`); e.g.: to return only
+                       the updated item of a list, use {'listName': {'$elemMatch': {'_id': item_id}}}
+        :type fields: list or dict or None
 
         :returns: a boolean (True if an existing document was updated) and the document after the update
         :rtype: tuple of (bool, dict)
@@ -254,16 +539,148 @@ class Monco(object):
         if '_id' in data:
             del data['_id']
         operator = self._operations.get(operation)
+        kwargs = {}
+        if fields:
+            kwargs['fields'] = projection(fields)
         if updateList:
+            position = '$'
+            if listFilter:
+                position = '$[item]'
+                kwargs['arrayFilters'] = [dict([('item.%s' % key, value)
+                                                for key, value in convert(listFilter).items()])]
             newData = {}
             for key, value in data.items():
-                newData['%s.$.%s' % (updateList, key)] = value
+                newData['%s.%s.%s' % (updateList, position, key)] = value
             data = newData
-        res = db[collection].find_and_modify(query=_id_or_query,
-                update={operator: data}, full_response=True, new=True, upsert=create)
+        update = {operator: data}
+        if increment:
+            update.setdefault('$inc', {}).update(increment)
+        try:
+            res = db[collection].find_and_modify(query=_id_or_query,
+                    update=update, full_response=True, new=True, upsert=create, **kwargs)
+        except pymongo.errors.DuplicateKeyError:
+            if not create:
+                raise
+            # another client inserted the same document (on a unique key) in the meantime: now it matches.
+            res = db[collection].find_and_modify(query=_id_or_query,
+                    update=update, full_response=True, new=True, upsert=create, **kwargs)
         lastErrorObject = res.get('lastErrorObject') or {}
         return lastErrorObject.get('updatedExisting', False), res.get('value') or {}
 
+    def updateListItems(self, collection, _id, listName, updates):
+        """Update many items of a list stored in a document, with a single bulk write.
+
+        :param collection: update a document in this collection
+        :type collection: str
+        :param _id: unique ID of the document
+        :type _id: str or :class:`~bson.objectid.ObjectId`
+        :param listName: name of the list
+        :type listName: str
+        :param updates: list of (item_id, data[, increment[, itemQuery[, query]]]) tuples; the fields in data
+                        are set in the item with the given _id, the ones in increment are incremented in the document;
+                        the item is updated only if it also matches itemQuery (e.g.: its version didn't change)
+                        and the document matches query
+        :type updates: list
+
+        :returns: the number of modified items
+        :rtype: int
+        """
+        db = self.connect()
+        _id = convert_obj(_id)
+        operations = []
+        for update in updates:
+            item_id, data = update[:2]
+            increment, itemQuery, query = (tuple(update[2:]) + (None, None, None))[:3]
+            data = convert(data or {})
+            data.pop('_id', None)
+            if not data:
+                continue
+            operation = {'$set': dict([('%s.$.%s' % (listName, key), value) for key, value in data.items()])}
+            if increment:
+                operation['$inc'] = increment
+            itemMatch = {'_id': item_id}
+            itemMatch.update(convert(itemQuery or {}))
+            match = {'_id': _id, listName: {'$elemMatch': itemMatch}}
+            match.update(query or {})
+            operations.append(pymongo.UpdateOne(match, operation))
+        if not operations:
+            return 0
+        return db[collection].bulk_write(operations, ordered=False).modified_count
+
+    def reserveSequence(self, collection, query, count=1, maxAge=None):
+        """Increment a counter, recording the reserved values as pending until `releaseSequence` is called:
+        `sequenceWatermark` never goes past a pending value.
+
+        :param collection: the collection of the counters
+        :type collection: str
+        :param query: query matching the counter (created if missing)
+        :type query: dict
+        :param count: number of values to reserve
+        :type count: int
+        :param maxAge: seconds after which pending values are forgotten (e.g.: left by a crashed process)
+        :type maxAge: float or None
+
+        :returns: the last reserved value
+        :rtype: int
+        """
+        db = self.connect()
+        now = datetime.datetime.utcnow()
+        pending = {'$ifNull': ['$pending', []]}
+        if maxAge:
+            pending = {'$filter': {'input': pending,
+                                   'cond': {'$gte': ['$$this.at', now - datetime.timedelta(seconds=maxAge)]}}}
+        # a pipeline update, so that the reserved values are known while recording them, in the same write.
+        pipeline = [
+            {'$set': {'seq': {'$add': [{'$ifNull': ['$seq', 0]}, count]}, 'pending': pending}},
+            {'$set': {'pending': {'$concatArrays': ['$pending', [{'seq': {'$subtract': ['$seq', count - 1]},
+                                                                   'at': now}]]}}}
+        ]
+        query = convert(query)
+        try:
+            doc = db[collection].find_one_and_update(query, pipeline, upsert=True,
+                                                     return_document=pymongo.ReturnDocument.AFTER)
+        except pymongo.errors.DuplicateKeyError:
+            doc = db[collection].find_one_and_update(query, pipeline, upsert=True,
+                                                     return_document=pymongo.ReturnDocument.AFTER)
+        return doc['seq']
+
+    def releaseSequence(self, collection, query, first):
+        """Mark some values reserved by `reserveSequence` as no more pending.
+
+        :param collection: the collection of the counters
+        :type collection: str
+        :param query: query matching the counter
+        :type query: dict
+        :param first: the first of the reserved values
+        :type first: int
+        """
+        db = self.connect()
+        db[collection].update_one(convert(query), {'$pull': {'pending': {'seq': first}}})
+
+    def sequenceWatermark(self, collection, query, maxAge=None):
+        """Return the highest value of a counter such that it and every previous value are no more pending.
+
+        :param collection: the collection of the counters
+        :type collection: str
+        :param query: query matching the counter
+        :type query: dict
+        :param maxAge: seconds after which pending values are ignored
+        :type maxAge: float or None
+
+        :returns: the value
+        :rtype: int
+        """
+        doc = self.getOne(collection, query)
+        if not doc:
+            return 0
+        pending = doc.get('pending') or []
+        if maxAge:
+            oldest = datetime.datetime.utcnow() - datetime.timedelta(seconds=maxAge)
+            pending = [p for p in pending if p.get('at') and p['at'] >= oldest]
+        if pending:
+            return min([p['seq'] for p in pending]) - 1
+        return doc.get('seq', 0)
+
     def updateMany(self, collection, query, data):
         """Update multiple existing documents.
 
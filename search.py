@@ -0,0 +1,289 @@
+"""EventMan(ager) search
+
+In-memory prefix index of the tickets of an event, used to quickly find attendees at the check-in desk.
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import re
+import json
+import bisect
+import logging
+import unicodedata
+import collections
+
+# Fields of a ticket that are indexed.
+SEARCH_FIELDS = ('name', 'surname', 'email', 'company', 'seq_hex')
+# Other fields of a ticket that are kept in the index, and returned with the results.
+EXTRA_FIELDS = ('_id', 'attended', 'cancelled')
+# Default and maximum number of results.
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 200
+# Maximum number of events whose index is kept in memory.
+MAX_INDEXES = 16
+
+re_split = re.compile(r'[\W_]+', re.UNICODE)
+
+# Upper bound of all the strings starting with a given prefix.
+_MAX_CHAR = '\U0010ffff'
+
+
+def normalize(text):
+    """Return a lowercase version of a text, without accents.
+
+    :param text: the text to normalize
+    :type text: str
+
+    :returns: the normalized text
+    :rtype: str
+    """
+    text = str(text)
+    try:
+        text.encode('ascii')
+    except UnicodeEncodeError:
+        # decompose accented characters, and remove the accents.
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join([c for c in text if not unicodedata.combining(c)])
+    return text.casefold()
+
+
+def tokenize(text):
+    """Split a text in normalized words.
+
+    :param text: the text to split
+    :type text: str
+
+    :returns: list of words
+    :rtype: list
+    """
+    if not text:
+        return []
+    return [token for token in re_split.split(normalize(text)) if token]
+
+
+class TicketsIndex(object):
+    """Prefix index of the tickets of an event.
+
+    The index is kept updated subscribing it, like a WebSocket client, to the channel of the updates
+    of the tickets of the event: it receives the messages published by every server process."""
+    def __init__(self, event_id):
+        self.event_id = event_id
+        self.channel = 'event/%s/tickets/updates' % event_id
+        # if True, the index has missed some updates and must be rebuilt.
+        self.stale = False
+        # sorted list of (token, ticket_id) tuples.
+        self.entries = []
+        # ticket_id: indexed information about the ticket.
+        self.tickets = {}
+        # ticket_id: list of tokens.
+        self.tokens = {}
+
+    def __len__(self):
+        return len(self.tickets)
+
+    def build(self, tickets):
+        """Index a list of tickets, from scratch.
+
+        :param tickets: the tickets
+        :type tickets: list
+        """
+        self.entries = []
+        self.tickets = {}
+        self.tokens = {}
+        for ticket in tickets:
+            ticket_id = ticket.get('_id')
+            if ticket_id is None:
+                continue
+            ticket_id = str(ticket_id)
+            tokens = self._ticket_tokens(ticket)
+            self.tickets[ticket_id] = self._ticket_info(ticket)
+            self.tokens[ticket_id] = tokens
+            self.entries.extend([(token, ticket_id) for token in tokens])
+        self.entries.sort()
+
+    @staticmethod
+    def _ticket_tokens(ticket):
+        text = ' '.join([str(ticket[field]) for field in SEARCH_FIELDS if ticket.get(field)])
+        return sorted(set(tokenize(text)))
+
+    @staticmethod
+    def _ticket_info(ticket):
+        info = dict([(field, ticket.get(field)) for field in SEARCH_FIELDS + EXTRA_FIELDS if field in ticket])
+        info['_id'] = str(info['_id'])
+        return info
+
+    def remove(self, ticket_id):
+        """Remove a ticket from the index.
+
+        :param ticket_id: the ID of the ticket
+        :type ticket_id: str
+        """
+        ticket_id = str(ticket_id)
+        for token in self.tokens.pop(ticket_id, []):
+            idx = bisect.bisect_left(self.entries, (token, ticket_id))
+            if idx < len(self.entries) and self.entries[idx] == (token, ticket_id):
+                del self.entries[idx]
+        self.tickets.pop(ticket_id, None)
+
+    def update(self, ticket):
+        """Add a ticket to the index, or update it.
+
+        :param ticket: the ticket
+        :type ticket: dict
+        """
+        if not ticket or ticket.get('_id') is None:
+            return
+        ticket_id = str(ticket['_id'])
+        tokens = self._ticket_tokens(ticket)
+        if self.tokens.get(ticket_id) != tokens:
+            self.remove(ticket_id)
+            for token in tokens:
+                bisect.insort(self.entries, (token, ticket_id))
+            self.tokens[ticket_id] = tokens
+        self.tickets[ticket_id] = self._ticket_info(ticket)
+
+    def _range(self, prefix):
+        return (bisect.bisect_left(self.entries, (prefix,)),
+                bisect.bisect_left(self.entries, (prefix + _MAX_CHAR,)))
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Return the tickets having a word starting with every word of the query.
+
+        :param query: the searched text
+        :type query: str
+        :param limit: maximum number of results
+        :type limit: int
+
+        :returns: list of tickets, sorted by the matching word
+        :rtype: list
+        """
+        prefixes = tokenize(query)
+        if not prefixes or limit < 1:
+            return []
+        # scan the smallest range of entries, checking the other prefixes on the words of each ticket.
+        ranges = sorted([(hi - lo, lo, hi, prefix) for prefix, (lo, hi) in
+                         [(prefix, self._range(prefix)) for prefix in set(prefixes)]])
+        size, lo, hi, prefix = ranges[0]
+        others = [r[3] for r in ranges[1:]]
+        results = []
+        seen = set()
+        for idx in range(lo, hi):
+            ticket_id = self.entries[idx][1]
+            if ticket_id in seen:
+                continue
+            seen.add(ticket_id)
+            tokens = self.tokens[ticket_id]
+            if all(any(token.startswith(other) for token in tokens) for other in others):
+                results.append(self.tickets[ticket_id])
+                if len(results) >= limit:
+                    break
+        return results
+
+    def write_message(self, message):
+        """Receive the messages published on the channel of the updates of the tickets."""
+        try:
+            data = json.loads(message)
+        except (TypeError, ValueError):
+            return
+        if not isinstance(data, list):
+            data = [data]
+        for item in data:
+            if not isinstance(item, dict) or item.get('error'):
+                continue
+            action = item.get('action')
+            if action in ('add', 'update'):
+                self.update(item.get('ticket'))
+            elif action == 'delete':
+                self.remove(item.get('_id'))
+            elif action == 'resync':
+                self.stale = True
+
+    def close(self):
+        """Called by the broker when the index can't keep up with the updates."""
+        self.stale = True
+
+
+class SearchIndexes(object):
+    """Keep the indexes of the most recently searched events."""
+    def __init__(self, db, broker, max_indexes=MAX_INDEXES, metrics=None):
+        """Initialize the instance.
+
+        :param db: the database connector
+        :type db: :class:`~monco.Monco`
+        :param broker: the broker of the WebSocket messages, used to receive the updates of the tickets
+        :type broker: :class:`~broker.LocalBroker`
+        :param max_indexes: maximum number of indexes kept in memory
+        :type max_indexes: int
+        :param metrics: where to record metrics
+        :type metrics: :class:`~metrics.Metrics`
+        """
+        self.db = db
+        self.broker = broker
+        self.max_indexes = max_indexes
+        self.metrics = metrics
+        self.indexes = collections.OrderedDict()
+
+    def get(self, event_id):
+        """Return the index of an event, building it if needed.
+
+        :param event_id: the ID of the event
+        :type event_id: str
+
+        :returns: the index
+        :rtype: :class:`TicketsIndex`
+        """
+        index = self.indexes.get(event_id)
+        if index is not None and index.stale:
+            self.drop(event_id)
+            index = None
+        if index is not None:
+            self.indexes.move_to_end(event_id)
+            return index
+        index = TicketsIndex(event_id)
+        # subscribe before reading the tickets, to not miss any update.
+        self.broker.subscribe(index.channel, index)
+        tickets = self.db.queryList('events', event_id, 'tickets', fields=SEARCH_FIELDS + EXTRA_FIELDS)
+        index.build(tickets)
+        logging.debug('search: indexed %d tickets of event %s' % (len(index), event_id))
+        if self.metrics is not None:
+            self.metrics.incr('search_index_builds')
+        self.indexes[event_id] = index
+        while len(self.indexes) > self.max_indexes:
+            self.drop(next(iter(self.indexes)))
+        return index
+
+    def drop(self, event_id):
+        """Remove the index of an event.
+
+        :param event_id: the ID of the event
+        :type event_id: str
+        """
+        index = self.indexes.pop(event_id, None)
+        if index is not None:
+            self.broker.unsubscribe_all(index)
+
+    def search(self, event_id, query, limit=SEARCH_LIMIT):
+        """Search the tickets of an event (see :meth:`TicketsIndex.search`).
+
+        :param event_id: the ID of the event
+        :type event_id: str
+        :param query: the searched text
+        :type query: str
+        :param limit: maximum number of results
+        :type limit: int
+
+        :returns: list of tickets
+        :rtype: list
+        """
+        return self.get(event_id).search(query, limit=min(limit, MAX_SEARCH_LIMIT))
@@ -0,0 +1,164 @@
+"""EventMan(ager) tests of the admission control
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import time
+import threading
+import unittest
+
+import tornado.testing
+from tornado import gen
+
+import admission
+from metrics import Metrics
+
+
+class TestParseLimits(unittest.TestCase):
+    def test_parse(self):
+        limits = admission.parse_limits(['event:tickets-all|create=4:200:10', ' ', 'users|create = 1:2:0.5'])
+        self.assertEqual(limits, {'event:tickets-all|create': (4, 200, 10.0), 'users|create': (1, 2, 0.5)})
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, admission.parse_limits, ['event:tickets-all|create=4:200'])
+        self.assertRaises(ValueError, admission.parse_limits, ['event:tickets-all|create'])
+
+
+class TestLimiter(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(TestLimiter, self).setUp()
+        self.metrics = Metrics()
+        self.limiter = admission.Limiter('endpoint', 2, 2, 10, metrics=self.metrics)
+
+    def counters(self, name):
+        return self.metrics.to_dict()['counters'].get(name, {})
+
+    def test_free_slots(self):
+        for i in range(2):
+            future, position = self.limiter.acquire()
+            self.assertEqual(position, 0)
+            self.assertEqual(future.result(), 0)
+        self.assertEqual(self.limiter.active, 2)
+
+    def test_fifo(self):
+        self.limiter.acquire()
+        self.limiter.acquire()
+        first, first_position = self.limiter.acquire()
+        second, second_position = self.limiter.acquire()
+        self.assertEqual((first_position, second_position), (1, 2))
+        self.assertFalse(first.done())
+        self.limiter.release()
+        self.assertTrue(first.done())
+        self.assertFalse(second.done())
+        self.assertEqual(self.limiter.active, 2)
+        self.assertEqual(self.limiter.waiting(), 1)
+
+    def test_priority(self):
+        self.limiter.acquire()
+        self.limiter.acquire()
+        normal, normal_position = self.limiter.acquire()
+        staff, staff_position = self.limiter.acquire(priority=True)
+        # the staff goes before everybody else.
+        self.assertEqual((normal_position, staff_position), (1, 1))
+        self.limiter.release()
+        self.assertTrue(staff.done())
+        self.assertFalse(normal.done())
+
+    def test_queue_full(self):
+        for i in range(4):
+            self.limiter.acquire()
+        with self.assertRaises(admission.Rejected) as cm:
+            self.limiter.acquire()
+        self.assertEqual(cm.exception.position, 3)
+        self.assertEqual(self.counters('admission_rejected'), {'endpoint=endpoint,reason=queue_full': 1})
+        # the staff has its own queue.
+        future, position = self.limiter.acquire(priority=True)
+        self.assertEqual(position, 1)
+
+    @tornado.testing.gen_test
+    def test_timeout(self):
+        limiter = admission.Limiter('endpoint', 1, 2, 0.05, metrics=self.metrics)
+        limiter.acquire()
+        future, position = limiter.acquire()
+        with self.assertRaises(admission.Rejected):
+            yield future
+        self.assertEqual(limiter.waiting(), 0)
+        self.assertEqual(self.counters('admission_rejected'), {'endpoint=endpoint,reason=timeout': 1})
+
+    def test_cancel(self):
+        self.limiter.acquire()
+        self.limiter.acquire()
+        future, position = self.limiter.acquire()
+        self.limiter.cancel(future)
+        self.assertEqual(self.limiter.waiting(), 0)
+        self.assertRaises(admission.Rejected, future.result)
+        # the slot released is not given to the cancelled request.
+        self.limiter.release()
+        self.assertEqual(self.limiter.active, 1)
+
+    def test_retry_after(self):
+        self.assertEqual(self.limiter.retry_after(10), admission.RETRY_AFTER)
+        self.limiter.acquire()
+        self.limiter.release(1.0)
+        self.assertEqual(self.limiter.service_time, 1.0)
+        self.limiter.acquire()
+        self.limiter.release(2.0)
+        self.assertAlmostEqual(self.limiter.service_time, 1.0 + admission.SERVICE_TIME_WEIGHT)
+        # 10 requests before us, served 2 at a time.
+        self.assertEqual(self.limiter.retry_after(10), int(10 * self.limiter.service_time / 2) + 1)
+
+
+class TestAdmissionControl(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(TestAdmissionControl, self).setUp()
+        self.control = admission.AdmissionControl({'endpoint': (3, 10, 10), 'other': (2, 10, 10)},
+                                                  max_delay=5, metrics=Metrics())
+
+    def test_get(self):
+        self.assertIsNotNone(self.control.get('endpoint'))
+        self.assertIsNone(self.control.get('unknown'))
+        self.assertEqual(self.control.executor._max_workers, 5)
+
+    def test_check_delay(self):
+        self.control.check_delay('endpoint', 4)
+        self.assertRaises(admission.Rejected, self.control.check_delay, 'endpoint', 6)
+        # the requests waited in the buffers of the sockets while the loop was blocked.
+        self.control.loop_lag = 3
+        self.assertRaises(admission.Rejected, self.control.check_delay, 'endpoint', 4)
+
+    def test_no_max_delay(self):
+        control = admission.AdmissionControl({}, max_delay=0, metrics=Metrics())
+        control.check_delay('endpoint', 1000)
+
+    @tornado.testing.gen_test
+    def test_run_in_executor(self):
+        thread = yield self.control.run_in_executor(threading.get_ident)
+        self.assertNotEqual(thread, threading.get_ident())
+
+    @tornado.testing.gen_test
+    def test_loop_lag(self):
+        self.control.start(interval=0.02)
+        try:
+            yield gen.sleep(0.05)
+            self.assertLess(self.control.loop_lag, 0.1)
+            # block the loop.
+            self.io_loop.add_callback(time.sleep, 0.3)
+            yield gen.sleep(0.05)
+            self.assertGreater(self.control.loop_lag, 0.15)
+        finally:
+            self.control.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
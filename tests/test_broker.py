@@ -0,0 +1,129 @@
+"""EventMan(ager) tests of the WebSocket broker
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import unittest
+
+import tornado.testing
+from tornado import gen
+from tornado.concurrent import Future
+
+import broker
+from metrics import Metrics
+
+
+class FakeClient(object):
+    """A WebSocket client that receives a message only when the previous write is completed."""
+    def __init__(self):
+        self.messages = []
+        self.writes = []
+        self.closed = False
+
+    def write_message(self, message):
+        self.messages.append(message)
+        future = Future()
+        self.writes.append(future)
+        return future
+
+    def close(self):
+        self.closed = True
+
+
+class TestClientQueue(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(TestClientQueue, self).setUp()
+        self.metrics = Metrics()
+        self.broker = broker.LocalBroker(batch_window=0, metrics=self.metrics)
+        self.client = FakeClient()
+        self.broker.subscribe('a', self.client)
+
+    def make_queue(self, policy):
+        return broker.ClientQueue(self.broker, self.client, max_size=2, policy=policy)
+
+    def dropped(self):
+        return sum(self.metrics.to_dict()['counters'].get('ws_messages_dropped', {}).values())
+
+    def test_drop_oldest(self):
+        queue = self.make_queue('drop_oldest')
+        for message in ('1', '2', '3'):
+            queue.put('a', message)
+        self.assertEqual(list(queue.messages), [('a', '2'), ('a', '3')])
+        self.assertEqual(self.dropped(), 1)
+
+    def test_collapse(self):
+        self.broker._seqs['a'] = 7
+        queue = self.make_queue('collapse')
+        queue.put('a', '1')
+        queue.put('b', '2')
+        queue.put('c', '3')
+        # every queued message is replaced by a resync of its channel.
+        self.assertEqual(sorted([channel for channel, message in queue.messages]), ['a', 'b', 'c'])
+        resyncs = dict([(channel, json.loads(message)) for channel, message in queue.messages])
+        self.assertEqual(resyncs['a'], [{'action': 'resync', 'seq': 7, 'epoch': self.broker.epoch}])
+        self.assertEqual(resyncs['c'][0]['seq'], 0)
+        self.assertEqual(self.dropped(), 3)
+        self.assertFalse(self.client.closed)
+
+    def test_disconnect(self):
+        queue = self.make_queue('disconnect')
+        for message in ('1', '2', '3'):
+            queue.put('a', message)
+        self.assertTrue(queue.closed)
+        self.assertTrue(self.client.closed)
+        self.assertEqual(len(queue), 0)
+        self.assertNotIn(id(self.client), self.broker.channels.get('a', {}))
+        # a closed queue ignores new messages.
+        queue.put('a', '4')
+        self.assertEqual(len(queue), 0)
+
+    @tornado.testing.gen_test
+    def test_write_one_at_a_time(self):
+        queue = broker.ClientQueue(self.broker, self.client, max_size=10)
+        queue.put('a', '1')
+        queue.put('a', '2')
+        yield gen.moment
+        self.assertEqual(self.client.messages, ['1'])
+        self.client.writes[0].set_result(None)
+        yield gen.moment
+        yield gen.moment
+        self.assertEqual(self.client.messages, ['1', '2'])
+        self.client.writes[1].set_result(None)
+        yield gen.moment
+        yield gen.moment
+        self.assertFalse(queue.writing)
+
+    @tornado.testing.gen_test
+    def test_frame_message(self):
+        self.client.frame_message = lambda channel, message: '%s:%s' % (channel, message)
+        queue = broker.ClientQueue(self.broker, self.client)
+        queue.put('a', '1')
+        yield gen.moment
+        self.assertEqual(self.client.messages, ['a:1'])
+
+    @tornado.testing.gen_test
+    def test_write_error(self):
+        def write_message(message):
+            raise IOError('closed')
+        self.client.write_message = write_message
+        queue = broker.ClientQueue(self.broker, self.client)
+        queue.put('a', '1')
+        yield gen.moment
+        self.assertTrue(queue.closed)
+        self.assertTrue(self.client.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
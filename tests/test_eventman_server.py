@@ -0,0 +1,151 @@
+"""EventMan(ager) tests of the request handlers
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import datetime
+import threading
+import unittest
+
+import tornado.web
+import tornado.testing
+
+import monco
+import admission
+import eventman_server
+from metrics import Metrics
+
+
+class TestFilters(unittest.TestCase):
+    def setUp(self):
+        # build_filters and split_arguments don't need a request.
+        self.handler = object.__new__(eventman_server.CollectionHandler)
+        self.events = object.__new__(eventman_server.EventsHandler)
+        self.permissions = set()
+        self.events.has_permission = lambda permission: permission in self.permissions
+
+    def test_equality(self):
+        self.assertEqual(self.events.build_filters({'name': 'Mario'}, resource='tickets'), {'name': 'Mario'})
+
+    def test_booleans(self):
+        query = self.events.build_filters({'attended': 'true', 'cancelled': 'false', 'vip': '0'}, resource='tickets')
+        self.assertEqual(query, {'attended': {'$in': ['true', True]},
+                                 'cancelled': {'$in': ['false', False, None]},
+                                 'vip': {'$in': ['0', False]}})
+
+    def test_operators(self):
+        query = self.events.build_filters({'seq[gte]': '10', 'ticket_kind[in]': 'vip,staff',
+                                           'email[exists]': 'no', 'seq_hex[eq]': '0010',
+                                           'price[lt]': '9.5', 'company[ne]': 'ACME'}, resource='tickets')
+        self.assertEqual(query, {'seq': {'$gte': 10}, 'ticket_kind': {'$in': ['vip', 'staff']},
+                                 'email': {'$exists': False}, 'seq_hex': {'$eq': '0010'},
+                                 'price': {'$lt': 9.5}, 'company': {'$ne': 'ACME'}})
+
+    def test_dates(self):
+        query = self.handler.build_filters({'created_at[gte]': '2017-05-01', 'created_at[lt]': '2017-06-01'})
+        self.assertEqual(query, {'created_at': {'$gte': datetime.datetime(2017, 5, 1),
+                                                '$lt': datetime.datetime(2017, 6, 1)}})
+        self.assertRaises(eventman_server.InputException, self.handler.build_filters,
+                          {'created_at[gte]': 'not a date'})
+
+    def test_invalid(self):
+        for filters in ({'name[regex]': 'M.*'}, {'name[': 'x'}, {'$where': 'true'}):
+            self.assertRaises(eventman_server.InputException, self.events.build_filters, filters, resource='tickets')
+
+    def test_filter_fields(self):
+        self.assertEqual(self.events.build_filters({'title': 'PyCon', 'created_at[exists]': 'yes'}),
+                         {'title': 'PyCon', 'created_at': {'$exists': True}})
+        users = object.__new__(eventman_server.UsersHandler)
+        for handler, filters in ((self.events, {'stats.registered[gt]': '1'}), (self.events, {'secret': 'x'}),
+                                 (users, {'password[gte]': 'a'}), (users, {'permissions': 'admin|all'})):
+            self.assertRaises(eventman_server.InputException, handler.build_filters, filters)
+        # the events can be filtered on their tickets only by who can read them.
+        with self.assertRaises(eventman_server.InputException) as cm:
+            self.events.build_filters({'tickets.email[gte]': 'm'})
+        self.assertEqual(cm.exception.status, 401)
+        self.permissions.add('event:tickets-all|read')
+        self.assertEqual(self.events.build_filters({'tickets.email[gte]': 'm'}), {'tickets.email': {'$gte': 'm'}})
+
+    def test_split_arguments(self):
+        filters, options = self.handler.split_arguments({'name': 'Mario', '_limit': '10', '_skip': '5',
+                                                         '_sort': '-created_at, _id', '_fields': 'name,'})
+        self.assertEqual(filters, {'name': 'Mario'})
+        self.assertEqual(options, {'limit': 10, 'skip': 5, 'sort': ['-created_at', '_id'], 'fields': ['name']})
+
+    def test_sort_fields(self):
+        events = object.__new__(eventman_server.EventsHandler)
+        users = object.__new__(eventman_server.UsersHandler)
+        self.assertEqual(events.split_arguments({'_sort': 'title'})[1], {'sort': ['title']})
+        self.assertEqual(events.split_arguments({'_sort': '-surname'}, resource='tickets')[1], {'sort': ['-surname']})
+        # lists, subdocuments and secrets would end up in the cursor to the next page.
+        for handler, sort, resource in ((events, 'tickets', None), (events, '-tickets.email', None),
+                                        (events, 'surname', None), (events, 'stats', None),
+                                        (users, 'password', None), (users, 'permissions', None),
+                                        (events, 'title', 'unknown')):
+            self.assertRaises(eventman_server.InputException, handler.split_arguments, {'_sort': sort},
+                              resource=resource)
+
+    def test_split_arguments_cursor(self):
+        cursor = monco.encode_cursor({'_id': 'x', 'created_at': None}, ['created_at'])
+        filters, options = self.handler.split_arguments({'_sort': 'created_at', '_cursor': cursor})
+        self.assertEqual(options['cursor'], cursor)
+        for arguments in ({'_cursor': cursor}, {'_limit': 'ten'}, {'_skip': '-1'}):
+            self.assertRaises(eventman_server.InputException, self.handler.split_arguments, arguments)
+
+
+class FakeDB(object):
+    """The few methods of Monco used to read a user."""
+    def get(self, collection, id_):
+        return {'_id': id_, 'username': 'user', 'password': 'secret'}
+
+    def query(self, collection, query, **kwargs):
+        return []
+
+
+class PermittedUsersHandler(eventman_server.UsersHandler):
+    def has_permission(self, permission):
+        return True
+
+
+class TestAdmittedRequests(tornado.testing.AsyncHTTPTestCase):
+    """Requests admitted by a limiter, served by the threads of the admission control."""
+    def get_app(self):
+        self.admission = admission.AdmissionControl({'user|read': (2, 10, 10)}, metrics=Metrics())
+        params = dict(db=FakeDB(), data_dir='/tmp', listen_port=0, authentication=False, logger=None,
+                      triggers=None, broker=None, admission=self.admission)
+        return tornado.web.Application([(r'/users/?(?P<id_>[\w\d_-]+)?/?(?P<resource>[\w\d_-]+)?/?'
+                                         r'(?P<resource_id>[\w\d_-]+)?', PermittedUsersHandler, params)],
+                                       cookie_secret='secret')
+
+    def test_get_user(self):
+        response = self.fetch('/users/u1')
+        self.assertEqual(response.code, 200)
+        user = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(user['_id'], 'u1')
+        self.assertNotIn('password', user)
+        self.assertEqual(self.admission.get('user|read').active, 0)
+
+    @tornado.testing.gen_test
+    def test_call_on_ioloop(self):
+        handler = object.__new__(eventman_server.BaseHandler)
+        handler._ioloop = (self.io_loop, threading.get_ident())
+        thread = yield self.admission.run_in_executor(eventman_server.call_on_ioloop, handler, threading.get_ident)
+        self.assertEqual(thread, threading.get_ident())
+        with self.assertRaises(ZeroDivisionError):
+            yield self.admission.run_in_executor(eventman_server.call_on_ioloop, handler, lambda: 1 / 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
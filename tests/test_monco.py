@@ -0,0 +1,129 @@
+"""EventMan(ager) tests of the MongoDB connector
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import random
+import functools
+import unittest
+
+import pymongo
+
+import monco
+
+
+def sort_key(value):
+    # MongoDB sorts null (and missing) values before the numbers, and the numbers before the strings.
+    if value is None:
+        return (0, '')
+    if isinstance(value, (int, float)):
+        return (1, value)
+    return (2, value)
+
+
+def match(doc, query):
+    """Match a document against the subset of the query language used by cursor_query."""
+    for key, condition in query.items():
+        if key == '$or':
+            if not any(match(doc, sub) for sub in condition):
+                return False
+            continue
+        value = doc.get(key)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for operator, arg in condition.items():
+            if operator == '$ne':
+                if value == arg:
+                    return False
+            elif operator in ('$gt', '$lt'):
+                # $gt and $lt only compare values of the same type, and never match null.
+                if value is None or arg is None or sort_key(value)[0] != sort_key(arg)[0]:
+                    return False
+                if operator == '$gt' and not value > arg:
+                    return False
+                if operator == '$lt' and not value < arg:
+                    return False
+            else:
+                raise ValueError('unsupported operator: %s' % operator)
+    return True
+
+
+def sort_docs(docs, spec):
+    def compare(a, b):
+        for field, direction in spec:
+            x, y = sort_key(a.get(field)), sort_key(b.get(field))
+            if x != y:
+                return (-1 if x < y else 1) * direction
+        return 0
+    return sorted(docs, key=functools.cmp_to_key(compare))
+
+
+class TestSortSpec(unittest.TestCase):
+    def test_sort_spec(self):
+        self.assertEqual(monco.sort_spec(['name', '-created_at', '+surname']),
+                         [('name', pymongo.ASCENDING), ('created_at', pymongo.DESCENDING),
+                          ('surname', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+        self.assertEqual(monco.sort_spec(None), [('_id', pymongo.ASCENDING)])
+        self.assertEqual(monco.sort_spec([('_id', pymongo.DESCENDING)]), [('_id', pymongo.DESCENDING)])
+
+    def test_projection(self):
+        self.assertIsNone(monco.projection(None))
+        self.assertEqual(monco.projection(['name', '$where'], sort=['-seq']),
+                         {'name': True, 'seq': True, '_id': True})
+
+
+class TestCursor(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(42)
+        self.docs = []
+        for i in range(200):
+            doc = {'_id': '%03d' % i, 'company': rnd.choice([None, 'a', 'b', 'c']), 'n': rnd.choice([None, 1, 2])}
+            if doc['company'] is None and rnd.random() < 0.5:
+                # missing fields are sorted like null values.
+                del doc['company']
+            self.docs.append(doc)
+
+    def paginate(self, sort, page_size=7):
+        spec = monco.sort_spec(sort)
+        results = []
+        cursor = None
+        while True:
+            query = monco.cursor_query(cursor, sort) if cursor else {}
+            page = sort_docs([doc for doc in self.docs if match(doc, query)], spec)[:page_size]
+            results.extend(page)
+            if len(page) < page_size:
+                return results
+            cursor = monco.encode_cursor(page[-1], sort)
+
+    def test_pages(self):
+        for sort in (None, ['company'], ['-company'], ['-n', 'company'], ['n', '-company'], ['-_id']):
+            expected = [doc['_id'] for doc in sort_docs(self.docs, monco.sort_spec(sort))]
+            self.assertEqual([doc['_id'] for doc in self.paginate(sort)], expected, sort)
+
+    def test_nested_field(self):
+        cursor = monco.encode_cursor({'_id': 'x', 'stats': {'registered': 3}}, ['stats.registered'])
+        query = monco.cursor_query(cursor, ['stats.registered'])
+        self.assertEqual(query['$or'][0], {'stats.registered': {'$gt': 3}})
+
+    def test_invalid_cursor(self):
+        cursor = monco.encode_cursor({'_id': 'x', 'name': 'a'}, ['name'])
+        self.assertRaises(monco.MoncoError, monco.cursor_query, 'not a cursor!', ['name'])
+        # a cursor used with a different sort specification.
+        self.assertRaises(monco.MoncoError, monco.cursor_query, cursor, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""EventMan(ager) tests of the search of the tickets
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import unittest
+
+import search
+
+
+TICKETS = [
+    {'_id': 't1', 'name': 'Mario', 'surname': 'Rossi', 'email': 'mario@example.com', 'seq_hex': '000001'},
+    {'_id': 't2', 'name': 'Maria', 'surname': 'Bianchi', 'email': 'mb@example.com', 'seq_hex': '000002'},
+    {'_id': 't3', 'name': 'Nicolò', 'surname': 'De Rossi', 'seq_hex': '000003'},
+    {'name': 'no id'}
+]
+
+
+class TestTokenize(unittest.TestCase):
+    def test_tokenize(self):
+        self.assertEqual(search.tokenize('Nicolò De-Rossi_jr'), ['nicolo', 'de', 'rossi', 'jr'])
+        self.assertEqual(search.tokenize(''), [])
+        self.assertEqual(search.tokenize(None), [])
+
+
+class TestTicketsIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = search.TicketsIndex('e1')
+        self.index.build(TICKETS)
+
+    def ids(self, query, **kwargs):
+        return sorted([ticket['_id'] for ticket in self.index.search(query, **kwargs)])
+
+    def test_build(self):
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.channel, 'event/e1/tickets/updates')
+
+    def test_prefix(self):
+        self.assertEqual(self.ids('mari'), ['t1', 't2'])
+        self.assertEqual(self.ids('ROSS'), ['t1', 't3'])
+        self.assertEqual(self.ids('nicolo'), ['t3'])
+        self.assertEqual(self.ids('example'), ['t1', 't2'])
+        self.assertEqual(self.ids('zzz'), [])
+        self.assertEqual(self.ids(''), [])
+
+    def test_every_word(self):
+        self.assertEqual(self.ids('mari ross'), ['t1'])
+        self.assertEqual(self.ids('de ros'), ['t3'])
+        self.assertEqual(self.ids('maria rossi'), [])
+
+    def test_limit(self):
+        self.assertEqual(len(self.index.search('mari', limit=1)), 1)
+        self.assertEqual(self.index.search('mari', limit=0), [])
+
+    def test_result(self):
+        result = self.index.search('bianchi')[0]
+        self.assertEqual(result['_id'], 't2')
+        self.assertEqual(result['email'], 'mb@example.com')
+
+    def test_update_and_remove(self):
+        self.index.update({'_id': 't2', 'name': 'Anna', 'surname': 'Bianchi'})
+        self.assertEqual(self.ids('mari'), ['t1'])
+        self.assertEqual(self.ids('anna'), ['t2'])
+        self.index.update({'_id': 't4', 'name': 'Marianna'})
+        self.assertEqual(self.ids('mari'), ['t1', 't4'])
+        self.index.remove('t1')
+        self.assertEqual(self.ids('mari'), ['t4'])
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(len(self.index.entries), sum([len(tokens) for tokens in self.index.tokens.values()]))
+
+    def test_messages(self):
+        self.index.write_message(json.dumps([
+            {'action': 'add', 'ticket': {'_id': 't4', 'name': 'Giulia'}},
+            {'action': 'update', 'ticket': {'_id': 't1', 'name': 'Luigi', 'surname': 'Rossi'}},
+            {'action': 'delete', '_id': 't2'},
+            {'error': True, 'action': 'delete', '_id': 't3'}]))
+        self.assertEqual(self.ids('giu'), ['t4'])
+        self.assertEqual(self.ids('luigi'), ['t1'])
+        self.assertEqual(self.ids('mari'), [])
+        self.assertEqual(self.ids('nicolo'), ['t3'])
+        self.assertFalse(self.index.stale)
+        self.index.write_message('not json')
+        self.index.write_message(json.dumps({'action': 'resync', 'seq': 10}))
+        self.assertTrue(self.index.stale)
+
+
+if __name__ == '__main__':
+    unittest.main()
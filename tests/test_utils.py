@@ -0,0 +1,86 @@
+"""EventMan(ager) tests of the utilities
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import unittest
+
+import utils
+
+
+BOUNDARY = 'xYzZY'
+
+BODY = (b'preamble\r\n'
+        b'--xYzZY\r\n'
+        b'Content-Disposition: form-data; name="targetEvent"\r\n'
+        b'\r\n'
+        b'event-1\r\n'
+        b'--xYzZY\r\n'
+        b'Content-Disposition: form-data; name="file"; filename="persons.csv"\r\n'
+        b'Content-Type: text/csv\r\n'
+        b'\r\n'
+        b'name,surname\r\nJohn,Doe\r\n--xYz,not a boundary\r\n'
+        b'\r\n'
+        b'--xYzZY--\r\n')
+
+
+class TestMultipartStreamParser(unittest.TestCase):
+    def parse(self, body, chunk_size):
+        parser = utils.MultipartStreamParser(BOUNDARY)
+        self.addCleanup(parser.close)
+        for idx in range(0, len(body), chunk_size):
+            parser.feed(body[idx:idx + chunk_size])
+        return parser
+
+    def test_chunks(self):
+        # the delimiters can be split across any two chunks.
+        for chunk_size in (1, 2, 3, 7, 16, len(BODY)):
+            parser = self.parse(BODY, chunk_size)
+            self.assertTrue(parser.done, chunk_size)
+            self.assertEqual(parser.fields, {'targetEvent': 'event-1'})
+            self.assertEqual(len(parser.files), 1)
+            self.assertEqual(parser.files[0]['name'], 'file')
+            self.assertEqual(parser.files[0]['filename'], 'persons.csv')
+            self.assertEqual(parser.files[0]['fd'].read(),
+                             b'name,surname\r\nJohn,Doe\r\n--xYz,not a boundary\r\n')
+
+    def test_quoted_boundary(self):
+        parser = utils.MultipartStreamParser(b'"xYzZY"')
+        self.addCleanup(parser.close)
+        parser.feed(BODY)
+        self.assertTrue(parser.done)
+
+    def test_incomplete(self):
+        parser = self.parse(BODY[:-20], 5)
+        self.assertFalse(parser.done)
+
+    def test_data_after_the_end(self):
+        parser = self.parse(BODY + b'epilogue', 4)
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.fields, {'targetEvent': 'event-1'})
+
+    def test_field_too_long(self):
+        parser = utils.MultipartStreamParser(BOUNDARY)
+        parser.max_field_size = 10
+        body = BODY.replace(b'event-1', b'e' * 100)
+        self.assertRaises(ValueError, parser.feed, body)
+
+    def test_headers_too_long(self):
+        parser = utils.MultipartStreamParser(BOUNDARY)
+        parser.max_headers_size = 100
+        self.assertRaises(ValueError, parser.feed, b'--xYzZY\r\n' + b'X-Header: x\r\n' * 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""badges
+
+Render the badges of all the attendees of an event, packing them in sheets.
+
+Copyright 2017 Davide Alberani <da@erlug.linux.it>
+               RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import multiprocessing
+
+from PIL import Image
+
+import monco
+
+# The layout of the labels is the one used by the print_label.py trigger.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'data', 'triggers-available'))
+import print_label
+
+
+logger = logging.getLogger('badges')
+logging.basicConfig(level=logging.INFO)
+
+# Size of a sheet, in millimeters (A4).
+SHEET_WIDTH_MM = 210
+SHEET_HEIGHT_MM = 297
+SHEET_MARGIN_MM = 5
+
+# Seconds between two progress reports.
+PROGRESS_INTERVAL = 2
+
+# Sheets written to the PDF with a single save: Pillow loads all the images of a save before
+# writing them, so the sheets of a large event are appended to the file in more saves.
+SHEETS_PER_WRITE = 16
+
+# The renderer of each worker process.
+_renderer = None
+
+
+def iter_tickets(db, event_id):
+    """Stream the non-cancelled tickets of an event, sorted by sequence number."""
+    pipeline = [
+        {'$match': {'_id': monco.convert_obj(event_id)}},
+        {'$unwind': '$tickets'},
+        {'$match': {'tickets.cancelled': {'$ne': True}}},
+        {'$sort': {'tickets.seq': 1}},
+        {'$project': {'_id': False, 'name': '$tickets.name', 'surname': '$tickets.surname',
+                      'company': '$tickets.company', 'seq_hex': '$tickets.seq_hex'}}
+    ]
+    for ticket in db.connect()['events'].aggregate(pipeline, allowDiskUse=True):
+        yield ticket
+
+
+def count_tickets(db, event_id):
+    """Return the number of non-cancelled tickets of an event."""
+    pipeline = [
+        {'$match': {'_id': monco.convert_obj(event_id)}},
+        {'$unwind': '$tickets'},
+        {'$match': {'tickets.cancelled': {'$ne': True}}},
+        {'$count': 'count'}
+    ]
+    for res in db.connect()['events'].aggregate(pipeline):
+        return res['count']
+    return 0
+
+
+def chunks(iterable, size):
+    """Group the items of an iterable in lists of at most `size` items."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class SheetLayout(object):
+    """Position of the labels on a sheet."""
+    def __init__(self, dpi, per_sheet=None, sheet_mm=(SHEET_WIDTH_MM, SHEET_HEIGHT_MM), margin_mm=SHEET_MARGIN_MM):
+        self.dpi = dpi
+        self.label_w, self.label_h = print_label.label_size(dpi)
+        if per_sheet == 1:
+            # one label per page, e.g.: for label printers.
+            self.w, self.h = self.label_w, self.label_h
+            self.positions = [(0, 0)]
+            return
+        self.w = int(round(sheet_mm[0] * dpi / 25.4))
+        self.h = int(round(sheet_mm[1] * dpi / 25.4))
+        margin = int(round(margin_mm * dpi / 25.4))
+        columns = max((self.w - margin) // (self.label_w + margin), 1)
+        rows = max((self.h - margin) // (self.label_h + margin), 1)
+        self.positions = [(margin + c * (self.label_w + margin), margin + r * (self.label_h + margin))
+                          for r in range(rows) for c in range(columns)]
+        if per_sheet:
+            self.positions = self.positions[:per_sheet]
+
+    @property
+    def per_sheet(self):
+        return len(self.positions)
+
+
+def iter_sheets(layout, results, on_sheet=None):
+    """Yield the rendered sheets, in order, as 1-bit images."""
+    for page, (data, count) in enumerate(results):
+        sheet = Image.frombytes('1', (layout.w, layout.h), data)
+        if on_sheet is not None:
+            on_sheet(page, sheet, count)
+        yield sheet
+
+
+def write_pdf(sheets, output, dpi, sheets_per_write=SHEETS_PER_WRITE):
+    """Write the sheets to a multi-page PDF, appending them to the file a few at a time."""
+    append = False
+    for group in chunks(sheets, sheets_per_write):
+        group[0].save(output, format='pdf', resolution=dpi, save_all=True,
+                      append_images=iter(group[1:]), append=append)
+        append = True
+
+
+def _init_worker(dpi):
+    global _renderer
+    _renderer = print_label.LabelRenderer(dpi=dpi)
+
+
+def render_sheet(args):
+    """Render a sheet of labels, returning it as 1-bit raw data (to be cheaply sent back to the parent)."""
+    layout, tickets = args
+    sheet = Image.new('1', (layout.w, layout.h), 1)
+    for ticket, position in zip(tickets, layout.positions):
+        name = ' '.join([ticket.get('name') or '', ticket.get('surname') or ''])
+        label = _renderer.render(ticket.get('seq_hex') or '0', name, ticket.get('company') or '')
+        sheet.paste(label, position)
+    return sheet.tobytes(), len(tickets)
+
+
+def run(db, event_id, output, fmt='pdf', processes=None, per_sheet=None, dpi=print_label.DPI):
+    """Render the badges of an event, writing a multi-page PDF or a PNG for each sheet."""
+    layout = SheetLayout(dpi, per_sheet=per_sheet)
+    total = count_tickets(db, event_id)
+    logger.info('rendering %d badges, %d per sheet, using %d processes' %
+                (total, layout.per_sheet, processes or multiprocessing.cpu_count()))
+    if not total:
+        return
+    if fmt == 'png' and not os.path.isdir(output):
+        os.makedirs(output)
+    t0 = time.time()
+    progress = {'done': 0, 'last_report': t0}
+
+    def on_sheet(page, sheet, count):
+        if fmt == 'png':
+            sheet.save(os.path.join(output, 'badges_%04d.png' % (page + 1)), format='png', dpi=(dpi, dpi))
+        progress['done'] += count
+        done = progress['done']
+        now = time.time()
+        if now - progress['last_report'] >= PROGRESS_INTERVAL or done >= total:
+            progress['last_report'] = now
+            logger.info('%d/%d badges (%d%%), %.1f badges/second' %
+                        (done, total, done * 100 / total, done / ((now - t0) or 1)))
+
+    jobs = ((layout, chunk) for chunk in chunks(iter_tickets(db, event_id), layout.per_sheet))
+    pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(dpi,))
+    try:
+        # with small sheets, send more of them to a worker at once.
+        chunksize = max(32 // layout.per_sheet, 1)
+        sheets = iter_sheets(layout, pool.imap(render_sheet, jobs, chunksize), on_sheet=on_sheet)
+        if fmt == 'pdf':
+            write_pdf(sheets, output, dpi)
+        else:
+            for sheet in sheets:
+                pass
+    finally:
+        pool.close()
+        pool.join()
+    logger.info('%d badges written to %s in %.1f seconds' % (progress['done'], output, time.time() - t0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('event_id', help='ID of the event')
+    parser.add_argument('-o', '--output', help='output PDF file, or directory for PNG sheets (default: badges.pdf)',
+                        action='store', default=None)
+    parser.add_argument('-f', '--format', help='output format (default: pdf)', choices=['pdf', 'png'],
+                        action='store', default='pdf')
+    parser.add_argument('-p', '--processes', help='number of rendering processes (default: number of CPU cores)',
+                        action='store', type=int, default=None)
+    parser.add_argument('-n', '--per-sheet', help='number of badges per sheet (default: as many as fit on an A4 sheet; 1: one badge per page)',
+                        action='store', type=int, default=None)
+    parser.add_argument('--dpi', help='resolution (default: %d)' % print_label.DPI,
+                        action='store', type=int, default=print_label.DPI)
+    parser.add_argument('--mongo-url', help='URL to MongoDB server', action='store', default=None)
+    parser.add_argument('--db-name', help='name of the MongoDB database to use (default: eventman)',
+                        action='store', default='eventman')
+    args = parser.parse_args()
+
+    output = args.output or ('badges.pdf' if args.format == 'pdf' else 'badges')
+    db = monco.Monco(url=args.mongo_url, dbName=args.db_name)
+    try:
+        run(db, args.event_id, output, fmt=args.format, processes=args.processes,
+            per_sheet=args.per_sheet, dpi=args.dpi)
+    except KeyboardInterrupt:
+        logger.info('exiting...')
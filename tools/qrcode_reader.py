@@ -4,6 +4,9 @@
 
 Scan the output of a serial QR Code reader.
 
+The codes read from the serial port are put in a queue, and sent by a pool of threads
+that keep their connections alive: the reader is never blocked by the network.
+
 Copyright 2017 Davide Alberani <da@erlug.linux.it>
                RaspiBO <info@raspibo.org>
 
@@ -23,12 +26,14 @@ import io
 import sys
 import time
 import json
+import queue
 import serial
 import urllib
 import logging
 import argparse
 import datetime
 import requests
+import threading
 import configparser
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
@@ -39,6 +44,13 @@ logging.getLogger('requests').setLevel(logging.WARNING)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+# Number of check-ins sent at the same time.
+CONCURRENCY = 4
+# How many times a check-in is sent, if the server can't be reached.
+MAX_ATTEMPTS = 3
+# Seconds between two reports of the latency.
+REPORT_INTERVAL = 60
+
 
 def convert_obj(obj):
     try:
@@ -85,24 +97,42 @@ json._default_encoder = ImprovedEncoder()
 
 
 class Connector():
-    def __init__(self, cfg):
+    def __init__(self, cfg, concurrency=CONCURRENCY):
         self.cfg = cfg
         self.session = None
+        self.concurrency = concurrency
         self.url = cfg['eventman']['url']
         self.login_url = urllib.parse.urljoin(self.url, '/v1.0/login')
         self.checkin_url = urllib.parse.urljoin(self.url, os.path.join('/v1.0/events/',
                                                 cfg['event']['id'], 'tickets/'))
+        # every thread uses its own session, sharing the cookies of the login.
+        self._local = threading.local()
         self.login()
 
+    def new_session(self):
+        session = requests.Session()
+        session.verify = False
+        ca = self.cfg['eventman'].get('ca')
+        if ca and os.path.isfile(ca):
+            session.verify = ca
+        # keep the connections alive, to not pay a new TCP and TLS handshake for every code.
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get_session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self.new_session()
+            session.cookies.update(self.session.cookies)
+        return session
+
     def login(self):
         try:
-            self.session = requests.Session()
-            self.session.verify = False
-            ca = cfg['eventman'].get('ca')
-            if ca and os.path.isfile(ca):
-                self.session.verify = ca
-            username = cfg['eventman'].get('username')
-            password = cfg['eventman'].get('password')
+            self.session = self.new_session()
+            username = self.cfg['eventman'].get('username')
+            password = self.cfg['eventman'].get('password')
             params = {}
             if username:
                 params['username'] = username
@@ -110,32 +140,113 @@ class Connector():
                 params['password'] = password
             req = self.session.post(self.login_url, json=params)
             req.raise_for_status()
-            req.connection.close()
         except requests.exceptions.ConnectionError as ex:
             logger.error('unable to connect to %s: %s' % (self.login_url, ex))
             sys.exit(1)
 
-    def checkin(self, code):
+    def checkin(self, code, scanned_at=None):
+        """Check-in the ticket with a code; return True if the check-in was successful."""
+        if scanned_at is None:
+            scanned_at = time.time()
         msg = 'scanning code %s: ' % code
         limit_field = self.cfg['event'].getint('limit_field')
         if limit_field:
             code = code[:limit_field]
-        params = {cfg['event']['field']: code, '_errorMessage': 'code: %s' % code}
+        params = {self.cfg['event']['field']: code, '_errorMessage': 'code: %s' % code}
         checkin_url = self.checkin_url + '?' + urllib.parse.urlencode(params)
         json = convert(dict(self.cfg['actions']))
-        req = self.session.put(checkin_url, json=json)
+        session = self.get_session()
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                req = session.put(checkin_url, json=json)
+                break
+            except requests.exceptions.ConnectionError as ex:
+                if attempt + 1 >= MAX_ATTEMPTS:
+                    logger.error(msg + 'unable to connect: %s' % ex)
+                    return False
+                time.sleep(attempt + 1)
         error = False
         try:
             req.raise_for_status()
             msg += 'ok'
+            if req.json().get('already_attended'):
+                msg += ' (already attended)'
         except requests.exceptions.HTTPError as ex:
             error = True
-            msg += 'error: %s' % req.json().get('message')
+            try:
+                msg += 'error: %s' % req.json().get('message')
+            except ValueError:
+                msg += 'error: %s' % ex
+        except ValueError:
+            pass
+        msg += ' [%d ms]' % ((time.time() - scanned_at) * 1000)
         if not error:
             logger.info(msg)
         else:
             logger.warning(msg)
-        req.connection.close()
+        return not error
+
+
+class Sender():
+    """Send the check-ins from a queue, using more threads; the latency between the scan of a code
+    and the reply of the server is periodically reported."""
+    def __init__(self, connector, concurrency=CONCURRENCY, report_interval=REPORT_INTERVAL):
+        self.connector = connector
+        self.queue = queue.Queue()
+        self.report_interval = report_interval
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.last_report = time.time()
+        self.threads = [threading.Thread(target=self.run, daemon=True) for i in range(concurrency)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, code):
+        self.queue.put((code, time.time()))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            code, scanned_at = item
+            try:
+                ok = self.connector.checkin(code, scanned_at)
+            except Exception as ex:
+                logger.error('scanning code %s: %s' % (code, ex))
+                ok = False
+            self.record(time.time() - scanned_at, ok)
+            self.queue.task_done()
+
+    def record(self, latency, ok):
+        with self.lock:
+            self.latencies.append(latency)
+            if not ok:
+                self.errors += 1
+            if time.time() - self.last_report >= self.report_interval:
+                self.report()
+
+    def report(self):
+        """Log the latency of the check-ins since the last report (to be called holding the lock)."""
+        self.last_report = time.time()
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return
+        logger.info('%d check-ins (%d errors, %d queued): latency avg %d ms, median %d ms, max %d ms' %
+                    (len(latencies), self.errors, self.queue.qsize(), sum(latencies) * 1000 / len(latencies),
+                     latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000))
+        self.latencies = []
+        self.errors = 0
+
+    def close(self):
+        """Wait for the queued check-ins to be sent."""
+        for thread in self.threads:
+            self.queue.put(None)
+        self.queue.join()
+        with self.lock:
+            self.report()
 
 
 def scan(port):
@@ -170,18 +281,25 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--code', help='specify a single code', action='store')
     parser.add_argument('--config', help='user a different configuration file (default: qrcode_reader.ini)',
                         action='store', default='qrcode_reader.ini')
+    parser.add_argument('--concurrency', help='number of check-ins sent at the same time (default: the concurrency of the eventman section, or %d)' % CONCURRENCY,
+                        action='store', type=int, default=None)
     args = parser.parse_args()
 
     cfg = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
     cfg.read(args.config)
     if cfg['qrcode_reader'].getboolean('debug'):
         logging.basicConfig(level=logging.DEBUG)
-    connector = Connector(cfg)
+    concurrency = args.concurrency or cfg['eventman'].getint('concurrency') or CONCURRENCY
+    connector = Connector(cfg, concurrency=concurrency)
     if args.code:
         connector.checkin(args.code)
     else:
+        sender = Sender(connector, concurrency=concurrency)
         try:
             for code in scan(port=cfg['connection']['port']):
-                connector.checkin(code)
+                sender.put(code)
         except KeyboardInterrupt:
-            logger.info('exiting...')
+            logger.info('exiting, sending the queued codes...')
+        finally:
+            # also when the serial port is disconnected: don't lose the queued codes.
+            sender.close()
@@ -0,0 +1,456 @@
+"""EventMan(ager) triggers
+
+Execution of the scripts associated to an action.
+
+Copyright 2015-2017 Davide Alberani <da@erlug.linux.it>
+                    RaspiBO <info@raspibo.org>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import re
+import glob
+import json
+import time
+import uuid
+import logging
+import datetime
+
+import pymongo
+import tornado.ioloop
+from tornado import gen, process
+from tornado.concurrent import Future
+
+from metrics import metrics as default_metrics
+
+ENCODING = 'utf-8'
+PROCESS_TIMEOUT = 60
+
+# Default size of the time window (in seconds) used to coalesce the calls to batch triggers.
+BATCH_WINDOW = 1.0
+# Maximum number of items sent to a batch trigger in a single run.
+BATCH_SIZE = 500
+
+# Collection used to journal the jobs.
+QUEUE_COLLECTION = 'triggers_queue'
+# Maximum number of scripts running at the same time.
+CONCURRENCY = 4
+# How many times a failing job is tried, before giving up.
+MAX_ATTEMPTS = 5
+# Seconds to wait before the first retry; doubled at every attempt, up to RETRY_MAX.
+RETRY_BASE = 5
+RETRY_MAX = 600
+# Number of pending jobs over which low-priority actions are shed or delayed.
+HIGH_WATER = 1000
+# What to do with low-priority actions, over the high-water mark: 'delay' or 'shed'.
+OVERFLOW_POLICY = 'delay'
+# Seconds a low-priority action is delayed, over the high-water mark.
+OVERFLOW_DELAY = 60
+# Seconds between two scans of the queue.
+POLL_INTERVAL = 1
+# Scripts running for more than this number of seconds are logged.
+SLOW_THRESHOLD = 5
+
+# Actions that are never shed or delayed: the check-in of a person at the desk (e.g.: to print a label)
+# must not wait for the bulk ones, like the creation of thousands of tickets importing a CSV file.
+HIGH_PRIORITY_ACTIONS = ('attends',)
+
+re_env_key = re.compile('[^A-Z_]+')
+
+
+def dict2env(data):
+    """Convert a dictionary into a form suitable to be passed as environment variables.
+
+    :param data: dictionary to convert
+    :type data: dict
+
+    :returns: the environment
+    :rtype: dict"""
+    ret = {}
+    for key, value in (data or {}).items():
+        if isinstance(value, (list, tuple, dict)):
+            continue
+        try:
+            key = key.upper().encode('ascii', 'ignore').decode('ascii')
+            key = re_env_key.sub('', key)
+            if not key:
+                continue
+            ret[key] = str(value)
+        except:
+            continue
+    return ret
+
+
+class Triggers(object):
+    """Run the scripts associated to an action.
+
+    Scripts in the data_dir/triggers/{action}.d directory are run once for every
+    action, receiving information over stdin (in JSON) and in the environment.
+
+    Scripts in the data_dir/triggers/{action}.batch.d directory opted into batch mode:
+    actions are coalesced for up to `batch_window` seconds (or `batch_size` items)
+    and the script is run only once, receiving a JSON list on stdin; each item is the
+    dictionary a non-batch script would have received, plus an "env" key with
+    its environment.
+
+    Every run of a script is a job, journaled in the database before it's executed
+    and removed only after a successful exit, so that jobs survive a restart of the
+    server (at-least-once delivery); failing jobs are retried with an exponential backoff."""
+    def __init__(self, data_dir, db, timeout=PROCESS_TIMEOUT, batch_window=BATCH_WINDOW, batch_size=BATCH_SIZE,
+            concurrency=CONCURRENCY, max_attempts=MAX_ATTEMPTS, high_water=HIGH_WATER,
+            overflow_policy=OVERFLOW_POLICY, high_priority=HIGH_PRIORITY_ACTIONS, slow_threshold=SLOW_THRESHOLD,
+            metrics=None):
+        """Initialize the instance.
+
+        :param data_dir: the directory containing the triggers/ directory
+        :type data_dir: str
+        :param db: the database connector, used to journal the jobs
+        :type db: :class:`~monco.Monco`
+        :param timeout: seconds after which a running script is killed
+        :type timeout: int
+        :param batch_window: seconds to wait, coalescing items for batch scripts
+        :type batch_window: float
+        :param batch_size: maximum number of items sent to a batch script
+        :type batch_size: int
+        :param concurrency: maximum number of scripts running at the same time
+        :type concurrency: int
+        :param max_attempts: how many times a failing job is tried
+        :type max_attempts: int
+        :param high_water: number of pending jobs over which low-priority actions are shed or delayed
+        :type high_water: int
+        :param overflow_policy: 'shed' or 'delay'
+        :type overflow_policy: str
+        :param high_priority: actions that are never shed or delayed
+        :type high_priority: list
+        :param slow_threshold: scripts running for more than this number of seconds are logged
+        :type slow_threshold: float
+        :param metrics: registry used to collect execution metrics
+        :type metrics: :class:`~metrics.Metrics`
+        """
+        self.data_dir = data_dir
+        self.db = db
+        self.timeout = timeout
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.high_water = high_water
+        self.overflow_policy = overflow_policy
+        self.high_priority = set(high_priority or [])
+        self.slow_threshold = slow_threshold
+        self.metrics = metrics or default_metrics
+        self.metrics.gauge('triggers_running', lambda: self.running)
+        self.running = 0
+        self.shed = 0
+        # number of pending jobs, updated locally and periodically read from the database
+        # (other processes may use the same queue).
+        self.pending = 0
+        self._periodic = None
+        # number of batch items enqueued since the last run, for each (action, script).
+        self._batch_counts = {}
+
+    @property
+    def queue(self):
+        """The collection used to journal the jobs."""
+        return self.db.connect()[QUEUE_COLLECTION]
+
+    def start(self):
+        """Start processing the queue, resuming the jobs left by a previous run."""
+        self.queue.create_index([('status', pymongo.ASCENDING), ('priority', pymongo.DESCENDING),
+                                 ('next_run', pymongo.ASCENDING)])
+        self.refresh_pending()
+        self._periodic = tornado.ioloop.PeriodicCallback(self.poll, POLL_INTERVAL * 1000)
+        self._periodic.start()
+        tornado.ioloop.IOLoop.instance().spawn_callback(self.process_queue)
+
+    def refresh_pending(self):
+        """Read the number of pending jobs from the database."""
+        try:
+            self.pending = self.queue.count_documents({'status': 'pending'})
+        except Exception as e:
+            logging.error('unable to read the triggers queue: %s' % e)
+
+    @gen.coroutine
+    def poll(self):
+        """Periodically update the number of pending jobs and process the queue."""
+        self.refresh_pending()
+        yield self.process_queue()
+
+    def stop(self):
+        """Stop processing the queue."""
+        if self._periodic is not None:
+            self._periodic.stop()
+            self._periodic = None
+
+    def depth(self):
+        """Information about the queue, for monitoring.
+
+        :returns: number of pending, running and failed jobs and of shed actions
+        :rtype: dict
+        """
+        queue = self.queue
+        return {
+            'pending': queue.count_documents({'status': 'pending'}),
+            'running': queue.count_documents({'status': 'running'}),
+            'failed': queue.count_documents({'status': 'failed'}),
+            'running_here': self.running,
+            'shed': self.shed,
+            'high_water': self.high_water
+        }
+
+    def scripts(self, action, batch=False):
+        """Return the list of executable scripts for an action.
+
+        :param action: action name
+        :type action: str
+        :param batch: if True, return the scripts that run in batch mode
+        :type batch: bool
+
+        :returns: list of paths
+        :rtype: list
+        """
+        if not self.data_dir:
+            return []
+        dirname = '%s.%s' % (action, 'batch.d' if batch else 'd')
+        scripts = glob.glob(os.path.join(self.data_dir, 'triggers', dirname, '*'))
+        return sorted([s for s in scripts if os.path.isfile(s) and os.access(s, os.X_OK)])
+
+    @staticmethod
+    def _labels(action, cmd):
+        return {'action': action or '', 'script': os.path.basename(cmd[0])}
+
+    def on_timeout(self, cmd, pipe, action=None):
+        """Kill a process that is taking too long to complete."""
+        logging.warning('cmd %s is taking too long: killing it' % ' '.join(cmd))
+        self.metrics.incr('triggers_timeouts', **self._labels(action, cmd))
+        try:
+            pipe.proc.kill()
+        except:
+            pass
+
+    def on_exit(self, returncode, cmd, pipe, timeout):
+        """Callback executed when a subprocess execution is over."""
+        tornado.ioloop.IOLoop.instance().remove_timeout(timeout)
+        logging.debug('cmd: %s returncode: %d' % (' '.join(cmd), returncode))
+
+    @gen.coroutine
+    def run_subprocess(self, cmd, stdin_data=None, env=None, action=None):
+        """Execute the given command.
+
+        :param cmd: the command to be run with its command line arguments
+        :type cmd: list
+        :param stdin_data: data to be sent over stdin
+        :type stdin_data: str
+        :param env: environment of the process
+        :type env: dict
+        :param action: the action the command was run for, used for the metrics
+        :type action: str
+
+        :returns: the return code, stdout and stderr of the process
+        :rtype: tuple
+        """
+        ioloop = tornado.ioloop.IOLoop.instance()
+        labels = self._labels(action, cmd)
+        processed_env = dict2env(env)
+        stdin_data = (stdin_data or '').encode(ENCODING)
+        t0 = time.time()
+        p = process.Subprocess(cmd, close_fds=True, stdin=process.Subprocess.STREAM,
+                stdout=process.Subprocess.STREAM, stderr=process.Subprocess.STREAM, env=processed_env)
+        self.metrics.observe('triggers_spawn_seconds', time.time() - t0, **labels)
+        timeout = ioloop.add_timeout(datetime.timedelta(seconds=self.timeout),
+                lambda: self.on_timeout(cmd, p, action))
+        exit_future = Future()
+
+        def _on_exit(returncode):
+            self.on_exit(returncode, cmd, p, timeout)
+            exit_future.set_result(returncode)
+        p.set_exit_callback(_on_exit)
+        yield p.stdin.write(stdin_data)
+        p.stdin.close()
+        out, err = yield [p.stdout.read_until_close(), p.stderr.read_until_close()]
+        returncode = yield exit_future
+        run_time = time.time() - t0
+        self.metrics.incr('triggers_runs', **labels)
+        self.metrics.incr('triggers_exit_codes', returncode=returncode, **labels)
+        self.metrics.incr('triggers_stdin_bytes', len(stdin_data), **labels)
+        self.metrics.incr('triggers_stdout_bytes', len(out), **labels)
+        self.metrics.observe('triggers_run_seconds', run_time, **labels)
+        if self.slow_threshold and run_time >= self.slow_threshold:
+            logging.warning('slow trigger: cmd %s for action "%s" took %.3f seconds (returncode: %s)' %
+                            (' '.join(cmd), action, run_time, returncode))
+        logging.debug('cmd: %s' % ' '.join(cmd))
+        logging.debug('cmd stdout: %s' % out)
+        logging.debug('cmd strerr: %s' % err)
+        raise gen.Return((returncode, out, err))
+
+    def run(self, action, stdin_data=None, env=None):
+        """Journal the execution of the triggers for the given action; they are run asynchronously.
+
+        :param action: action name; scripts in directory ./data/triggers/{action}.d will be run
+        :type action: str
+        :param stdin_data: a python dictionary that will be serialized in JSON and sent to the process over stdin
+        :type stdin_data: dict
+        :param env: environment of the process
+        :type env: dict
+        """
+        self.run_many([(action, stdin_data, env)])
+
+    def run_many(self, actions):
+        """Journal the execution of the triggers for many actions, with a single write to the queue.
+
+        :param actions: list of (action, stdin_data, env) tuples (see the `run` method)
+        :type actions: list
+        """
+        now = datetime.datetime.utcnow()
+        pending = self.pending
+        jobs = []
+        batch_keys = []
+        for action, stdin_data, env in actions:
+            logging.debug('running triggers for action "%s"' % action)
+            scripts = self.scripts(action)
+            batch_scripts = self.scripts(action, batch=True)
+            if not (scripts or batch_scripts):
+                continue
+            priority = 1 if action in self.high_priority else 0
+            next_run = now
+            if not priority:
+                if pending >= self.high_water:
+                    if self.overflow_policy == 'shed':
+                        self.shed += len(scripts) + len(batch_scripts)
+                        self.metrics.incr('triggers_shed', len(scripts) + len(batch_scripts), action=action)
+                        logging.warning('triggers queue over the high-water mark: action "%s" shed' % action)
+                        continue
+                    next_run = now + datetime.timedelta(seconds=OVERFLOW_DELAY)
+            env = dict2env(env)
+            stdin_data = stdin_data or {}
+            try:
+                stdin_json = json.dumps(stdin_data)
+            except:
+                stdin_data = {}
+                stdin_json = '{}'
+            action_jobs = []
+            for script in scripts:
+                action_jobs.append({'action': action, 'script': script, 'batch': False,
+                                    'stdin': stdin_json, 'env': env, 'priority': priority})
+            batch_item = None
+            for script in batch_scripts:
+                if batch_item is None:
+                    batch_item = dict(stdin_data)
+                    batch_item['env'] = env
+                    try:
+                        batch_item = json.dumps(batch_item)
+                    except:
+                        batch_item = json.dumps({'env': env})
+                action_jobs.append({'action': action, 'script': script, 'batch': True,
+                                    'stdin': batch_item, 'env': {}, 'priority': priority})
+                batch_keys.append((action, script))
+            for job in action_jobs:
+                job.update({'status': 'pending', 'attempts': 0, 'created_at': now,
+                            'next_run': next_run + datetime.timedelta(seconds=self.batch_window if job['batch'] else 0)})
+            jobs.extend(action_jobs)
+            pending += len(action_jobs)
+        if not jobs:
+            return
+        self.queue.insert_many(jobs)
+        self.pending += len(jobs)
+        for key in batch_keys:
+            self._batch_counts[key] = self._batch_counts.get(key, 0) + 1
+            if self._batch_counts[key] >= self.batch_size:
+                # do not wait for the end of the time window.
+                self._batch_counts[key] = 0
+                self.queue.update_many({'action': key[0], 'script': key[1], 'batch': True, 'status': 'pending'},
+                                       {'$set': {'next_run': now}})
+        tornado.ioloop.IOLoop.instance().spawn_callback(self.process_queue)
+
+    def _claim(self):
+        """Atomically mark the next runnable job as running, returning the list of claimed jobs.
+
+        Jobs left running for too long (e.g.: by a crashed server) are claimed again."""
+        now = datetime.datetime.utcnow()
+        stale = now - datetime.timedelta(seconds=self.timeout * 2)
+        token = uuid.uuid4().hex
+        query = {'$or': [{'status': 'pending', 'next_run': {'$lte': now}},
+                         {'status': 'running', 'claimed_at': {'$lt': stale}}]}
+        job = self.queue.find_one_and_update(query,
+                {'$set': {'status': 'running', 'claimed_at': now, 'claim': token}},
+                sort=[('priority', pymongo.DESCENDING), ('next_run', pymongo.ASCENDING)],
+                return_document=pymongo.ReturnDocument.AFTER)
+        if job is None:
+            return []
+        if not job.get('batch'):
+            self.pending = max(self.pending - 1, 0)
+            return [job]
+        # collect the other items for the same batch script.
+        others = self.queue.find({'action': job['action'], 'script': job['script'], 'batch': True,
+                                  'status': 'pending', 'next_run': {'$lte': now + datetime.timedelta(seconds=self.batch_window)}},
+                                 {'_id': True}).sort('next_run', pymongo.ASCENDING).limit(self.batch_size - 1)
+        ids = [o['_id'] for o in others]
+        if ids:
+            self.queue.update_many({'_id': {'$in': ids}, 'status': 'pending'},
+                                   {'$set': {'status': 'running', 'claimed_at': now, 'claim': token}})
+        jobs = list(self.queue.find({'claim': token}).sort('next_run', pymongo.ASCENDING))
+        self.pending = max(self.pending - len(jobs), 0)
+        return jobs
+
+    @gen.coroutine
+    def process_queue(self):
+        """Start the execution of the runnable jobs, up to the concurrency limit."""
+        ioloop = tornado.ioloop.IOLoop.instance()
+        while self.running < self.concurrency:
+            try:
+                jobs = self._claim()
+            except Exception as e:
+                logging.error('unable to read the triggers queue: %s' % e)
+                return
+            if not jobs:
+                return
+            self.running += 1
+            ioloop.spawn_callback(self._execute, jobs)
+
+    @gen.coroutine
+    def _execute(self, jobs):
+        """Run a script for the claimed jobs, updating the journal."""
+        job = jobs[0]
+        try:
+            if job.get('batch'):
+                stdin_data = '[%s]' % ', '.join(j['stdin'] for j in jobs)
+                env = {'ACTION': job['action'], 'BATCH_SIZE': len(jobs)}
+            else:
+                stdin_data = job['stdin']
+                env = job.get('env') or {}
+            try:
+                returncode, out, err = yield self.run_subprocess([job['script']], stdin_data, env,
+                                                                 action=job['action'])
+            except Exception as e:
+                logging.error('unable to run %s: %s' % (job['script'], e))
+                returncode = -1
+            ids = [j['_id'] for j in jobs]
+            if returncode == 0:
+                self.queue.delete_many({'_id': {'$in': ids}})
+                return
+            attempts = job.get('attempts', 0) + 1
+            if attempts >= self.max_attempts:
+                logging.error('giving up on %s for action "%s" after %d attempts' %
+                              (job['script'], job['action'], attempts))
+                self.queue.update_many({'_id': {'$in': ids}}, {'$set': {'status': 'failed', 'attempts': attempts}})
+                return
+            delay = min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX)
+            logging.warning('%s for action "%s" exited with %s: retrying in %d seconds' %
+                            (job['script'], job['action'], returncode, delay))
+            self.queue.update_many({'_id': {'$in': ids}},
+                                   {'$set': {'status': 'pending', 'attempts': attempts,
+                                             'next_run': datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)},
+                                    '$unset': {'claim': True, 'claimed_at': True}})
+            self.pending += len(ids)
+        finally:
+            self.running -= 1
+            tornado.ioloop.IOLoop.instance().spawn_callback(self.process_queue)
@@ -16,6 +16,7 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import re
 import csv
 import json
 import string
@@ -23,37 +24,43 @@ import random
 import hashlib
 import datetime
 import io
+import tempfile
 from bson.objectid import ObjectId
 
 
 def csvParse(csvStr, remap=None, merge=None):
     """Parse a CSV file, optionally renaming the columns and merging other information.
+    The lines are parsed while the results are consumed, so that a large file is never loaded in memory.
 
-    :param csvStr: the CSV to parse, as a string
-    :type csvStr: str
+    :param csvStr: the CSV to parse, as a string or as a file object (text or binary)
+    :type csvStr: str or file
     :param remap: a dictionary used to rename the columns
     :type remap: dict
     :param merge: merge these information into each line
     :type merge: dict
 
-    :returns: tuple with a dict of total and valid lines and the data
+    :returns: tuple with a dict of total and valid lines (updated while the data is consumed) and an iterator over the data
     :rtype: tuple
     """
     if isinstance(csvStr, bytes):
         csvStr = csvStr.decode('utf-8')
-    fd = io.StringIO(csvStr)
-    reader = csv.reader(fd)
-    remap = remap or {}
-    merge = merge or {}
-    fields = 0
+    if isinstance(csvStr, str):
+        fd = io.StringIO(csvStr)
+    elif isinstance(csvStr, io.TextIOBase):
+        fd = csvStr
+    else:
+        fd = io.TextIOWrapper(csvStr, encoding='utf-8', newline='')
     reply = dict(total=0, valid=0)
-    results = []
+    return reply, _csvIterParse(fd, reply, remap or {}, merge or {})
+
+
+def _csvIterParse(fd, reply, remap, merge):
+    reader = csv.reader(fd)
     try:
         headers = next(reader)
-        fields = len(headers)
-    except (StopIteration, csv.Error):
-        return reply, {}
-
+    except (StopIteration, csv.Error, UnicodeDecodeError):
+        return
+    fields = len(headers)
     for idx, header in enumerate(headers):
         if header in remap:
             headers[idx] = remap[header]
@@ -61,20 +68,132 @@ def csvParse(csvStr, remap=None, merge=None):
             headers[idx] = header.lower().replace(' ', '_')
     try:
         for row in reader:
-            try:
-                reply['total'] += 1
-                if len(row) != fields:
-                    continue
-                values = dict(zip(headers, row))
-                values.update(merge)
-                results.append(values)
-                reply['valid'] += 1
-            except csv.Error:
+            reply['total'] += 1
+            if len(row) != fields:
                 continue
-    except csv.Error:
+            values = dict(zip(headers, row))
+            values.update(merge)
+            reply['valid'] += 1
+            yield values
+    except (csv.Error, UnicodeDecodeError):
         pass
-    fd.close()
-    return reply, results
+
+
+class MultipartStreamParser(object):
+    """Parse a multipart/form-data body while it's received.
+
+    The values of simple fields are collected in the `fields` dictionary, the files are written
+    to temporary files, listed in `files` as dictionaries with name, filename and fd (positioned
+    at the beginning, once the body is complete)."""
+    _re_name = re.compile(r'[\s;]name="(?P<value>[^"]*)"')
+    _re_filename = re.compile(r'[\s;]filename="(?P<value>[^"]*)"')
+
+    # maximum size of the headers of a part and of the value of a simple field.
+    max_headers_size = 16 * 1024
+    max_field_size = 64 * 1024
+
+    def __init__(self, boundary):
+        """Initialize the instance.
+
+        :param boundary: the boundary from the Content-Type header
+        :type boundary: bytes
+        """
+        if isinstance(boundary, str):
+            boundary = boundary.encode('utf-8')
+        self.delimiter = b'--' + boundary.strip(b'"')
+        self.buffer = b''
+        self.state = 'preamble'
+        self.fields = {}
+        self.files = []
+        self._part = None
+
+    @property
+    def done(self):
+        return self.state == 'done'
+
+    def feed(self, data):
+        """Parse a chunk of the body; raise ValueError if the body is not valid.
+
+        :param data: the chunk
+        :type data: bytes
+        """
+        if self.state == 'done':
+            return
+        self.buffer += data
+        while True:
+            if self.state == 'preamble':
+                idx = self.buffer.find(self.delimiter)
+                if idx == -1:
+                    self.buffer = self.buffer[-len(self.delimiter):]
+                    return
+                self.buffer = self.buffer[idx + len(self.delimiter):]
+                self.state = 'boundary'
+            if self.state == 'boundary':
+                if len(self.buffer) < 2:
+                    return
+                if self.buffer.startswith(b'--'):
+                    self.close_part()
+                    self.buffer = b''
+                    self.state = 'done'
+                    return
+                self.state = 'headers'
+            if self.state == 'headers':
+                idx = self.buffer.find(b'\r\n\r\n')
+                if idx == -1:
+                    if len(self.buffer) > self.max_headers_size:
+                        raise ValueError('headers of the part are too long')
+                    return
+                self.open_part(self.buffer[:idx].decode('utf-8', 'replace'))
+                self.buffer = self.buffer[idx + 4:]
+                self.state = 'body'
+            if self.state == 'body':
+                idx = self.buffer.find(b'\r\n' + self.delimiter)
+                if idx == -1:
+                    # keep what could be the beginning of the delimiter.
+                    keep = len(self.delimiter) + 1
+                    if len(self.buffer) > keep:
+                        self.write_part(self.buffer[:-keep])
+                        self.buffer = self.buffer[-keep:]
+                    return
+                self.write_part(self.buffer[:idx])
+                self.close_part()
+                self.buffer = self.buffer[idx + 2 + len(self.delimiter):]
+                self.state = 'boundary'
+
+    def open_part(self, headers):
+        name = self._re_name.search(headers)
+        filename = self._re_filename.search(headers)
+        self._part = {'name': name.group('value') if name else ''}
+        if filename:
+            self._part['filename'] = filename.group('value')
+            self._part['fd'] = tempfile.TemporaryFile()
+            self.files.append(self._part)
+        else:
+            self._part['value'] = b''
+
+    def write_part(self, data):
+        if self._part is None or not data:
+            return
+        if 'fd' in self._part:
+            self._part['fd'].write(data)
+            return
+        if len(self._part['value']) + len(data) > self.max_field_size:
+            raise ValueError('field %s is too long' % self._part['name'])
+        self._part['value'] += data
+
+    def close_part(self):
+        if self._part is None:
+            return
+        if 'fd' in self._part:
+            self._part['fd'].seek(0)
+        else:
+            self.fields[self._part['name']] = self._part['value'].decode('utf-8', 'replace')
+        self._part = None
+
+    def close(self):
+        """Remove the temporary files."""
+        for part in self.files:
+            part['fd'].close()
 
 
 def hash_password(password, salt=None):